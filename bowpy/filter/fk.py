@@ -6,20 +6,22 @@ from obspy.core.inventory.inventory import Inventory
 import sys
 
 import numpy as np
-import math
 import matplotlib.pyplot as plt
 import scipy as sp
 import scipy.signal as signal
 from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
 
 from bowpy.util.array_util import epidist2nparray, attach_epidist2coords,\
                                   alignon
 from bowpy.util.fkutil import ls2ifft_prep,\
                               slope_distribution, makeMask,\
-                              create_iFFT2mtx, pocs
-from bowpy.util.base import nextpow2, array2stream, stream2array,\
+                              create_iFFT2mtx, create_iFFT2operator, pocs,\
+                              pocs_batch
+from bowpy.util.base import array2stream, stream2array,\
                             line_cut, line_set_zero
 from bowpy.util.picker import get_polygon
+from bowpy.util.fft_backend import fft2, ifft2, fft_length
 
 
 def fk_filter(st, inv=None, event=None, ftype='eliminate',
@@ -128,7 +130,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     ArrayData = stream2array(st_tmp, normalize)
 
     ix = ArrayData.shape[0]
-    iK = int(math.pow(2, nextpow2(ix)))
+    iK = fft_length(ix)
 
     try:
         yinfo = epidist2nparray(attach_epidist2coords(inv, event, st_tmp))
@@ -155,7 +157,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
             k_axis=None
 
     it     = ArrayData.shape[1]
-    iF     = int(math.pow(2,nextpow2(it)))
+    iF     = fft_length(it)
     dt     = st_tmp[0].stats.delta
     f_axis = np.fft.fftfreq(iF,dt)
 
@@ -186,11 +188,11 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             array_filtered_fk = line_set_zero(array_fk, shape=fshape)
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             array_filtered_fk = line_set_zero(array_fk, shape=fshape)
 
     elif ftype in ("extract"):
@@ -201,23 +203,23 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             array_filtered_fk = line_cut(array_fk, shape=fshape)
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             array_filtered_fk = line_cut(array_fk, shape=fshape)
 
 
     elif ftype in ("eliminate-polygon"):
-        array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+        array_fk = fft2(ArrayData, s=(iK,iF))
         if phase:
             if not isinstance(event, Event) and not isinstance(inv, Inventory):
                 msg='For alignment on phase calculation inventory and event information is needed, not found.'
                 raise IOError(msg)
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             array_filtered_fk = _fk_eliminate_polygon(array_fk, polygon, ylabel=r'frequency domain f in Hz', \
                                                       yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
 
@@ -227,7 +229,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
 
     elif ftype in ("extract-polygon"):
-        array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+        array_fk = fft2(ArrayData, s=(iK,iF))
         if phase:
             if not isinstance(event, Event) and not isinstance(inv, Inventory):
                 msg='For alignment on phase calculation inventory and event information is needed, not found.'
@@ -235,7 +237,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             array_filtered_fk = _fk_extract_polygon(array_fk, polygon, ylabel=r'frequency domain f in Hz', \
                                                 yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
         else:
@@ -244,11 +246,11 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
 
     elif ftype in ("mask"):
-        array_fk = np.fft.fft2(ArrayData)
+        array_fk = fft2(ArrayData)
         M, prange, peaks = slope_distribution(array_fk, slopes, deltaslope, peakpick=None, mindist=dist, smoothing=smoothpicks, interactive=slopepicking)
         W = makeMask(array_fk, peaks[0], maskshape)
         array_filtered_fk =  array_fk * W
-        array_filtered = np.fft.ifft2(array_filtered_fk)
+        array_filtered = ifft2(array_filtered_fk)
         stream_filtered = array2stream(array_filtered, st_original=st.copy())
         return stream_filtered, array_fk, W
 
@@ -261,12 +263,12 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             ### BUILD DOUBLE TAPER ###
             #array_filtered_fk =
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fft2(ArrayData, s=(iK,iF))
             ### BUILD DOUBLE TAPER ###
             #array_filtered_fk =
 
@@ -275,7 +277,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
         print("No type of filter specified")
         raise TypeError
 
-    array_filtered = np.fft.ifft2(array_filtered_fk, s=(iK,iF)).real
+    array_filtered = ifft2(array_filtered_fk, s=(iK,iF)).real
 
 
     # Convert to Stream object.
@@ -291,7 +293,8 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 FFT FUNCTIONS
 """
 def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smoothpicks=False, dist=0.5, maskshape=['boxcar',None],
-                    method='denoise', solver="iterative",  mu=5e-2, tol=1e-12, fulloutput=False, peakinput=False, alpha=0.9):
+                    method='denoise', solver="iterative",  mu=5e-2, tol=1e-12, fulloutput=False, peakinput=False, alpha=0.9,
+                    operator='fft'):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros, and its Mask-array (see makeMask, and slope_distribution.
@@ -369,6 +372,11 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     :param peakinput: Chosen peaks of the distribution, insert here if the peaks are not to be meant to recalculated
     :type  peakinput: np.ndarray
 
+    :param operator: Representation of A for the solvers. 'fft' (default) uses a matrix-free
+                     LinearOperator (see create_iFFT2operator), 'matrix' builds the sparse
+                     iFFT2 matrix (see create_iFFT2mtx), which is only feasible for small arrays.
+    :type  operator: string
+
     ######  returns:
 
     :param st_rec: Stream with reconstructed signals on the missing traces
@@ -379,8 +387,9 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     :param st_rec: Stream with reconstructed signals on the missing traces
     :type  st_rec: obspy.core.stream.Stream
 
-    :param FH: 2DiFFT-matrix for column-wise ordered longvector of the f-k spectrum
-    :type  FH: scipy.sparse.csc.csc_matrix
+    :param FH: 2DiFFT-matrix for column-wise ordered longvector of the f-k spectrum,
+               a LinearOperator if operator='fft'
+    :type  FH: scipy.sparse.csc.csc_matrix or scipy.sparse.linalg.LinearOperator
 
     :param dv: Column-wise ordered longvector of the t-x data
     :type  dv: numpy.ndarray
@@ -424,8 +433,8 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     ArrayData	= stream2array(st_tmp, normalize=False)
     ADT 		= ArrayData.copy().transpose()
 
-    fkData 		= np.fft.fft2(ArrayData)
-    fkDT 		= np.fft.fft2(ADT)
+    fkData 		= fft2(ArrayData)
+    fkDT 		= fft2(ADT)
 
     # Look for missing Traces
     recon_list 	= []
@@ -528,16 +537,28 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
         Ts = sparse.diags(T)
 
 
-        # Create sparse-matrix with iFFT operations.
-        print("Creating iFFT2 operator as a %ix%i matrix ...\n" %(fkDT.shape[0]*fkDT.shape[1], fkDT.shape[0]*fkDT.shape[1]))
+        if operator in ("fft", "linearoperator"):
+            # Matrix-free operators, applying ifft2/fft2 to the longvectors.
+            print("Creating iFFT2 operator as a matrix-free %ix%i operator ...\n" %(fkDT.shape[0]*fkDT.shape[1], fkDT.shape[0]*fkDT.shape[1]))
+            FH = create_iFFT2operator(fkDT.shape[0], fkDT.shape[1])
+            A = create_iFFT2operator(fkDT.shape[0], fkDT.shape[1], Y, T)
+            print("Starting reconstruction...\n")
+
+        elif operator in ("matrix", "sparse"):
+            # Create sparse-matrix with iFFT operations.
+            print("Creating iFFT2 operator as a %ix%i matrix ...\n" %(fkDT.shape[0]*fkDT.shape[1], fkDT.shape[0]*fkDT.shape[1]))
+
+            FH = create_iFFT2mtx(fkDT.shape[0], fkDT.shape[1])
+            print("... finished\n")
 
-        FH = create_iFFT2mtx(fkDT.shape[0], fkDT.shape[1])
-        print("... finished\n")
+            # Create model matrix A.
+            print("Creating sparse %ix%i matrix A ...\n" %(FH.shape[0], FH.shape[1]))
+            A =  Ts.dot(FH.dot(Yw))
+            print("Starting reconstruction...\n")
 
-        # Create model matrix A.
-        print("Creating sparse %ix%i matrix A ...\n" %(FH.shape[0], FH.shape[1]))
-        A =  Ts.dot(FH.dot(Yw))
-        print("Starting reconstruction...\n")
+        else:
+            msg = "Unknown operator '%s', use 'fft' or 'matrix'" % operator
+            raise IOError(msg)
 
         if solver in ("lsqr", "leastsquares"):
             print(" ...using iterative least-squares solver...\n")
@@ -552,7 +573,7 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
 
         elif solver in ("ilsmr", "iterative"):
             print(" ...using iterative LSMR solver...\n")
-            x = sparse.linalg.lsmr(A,dv,mu, atol=tol, btol=tol, conlim=tol, maxiter=maxiter)
+            x = sparse.linalg.lsmr(A, dv.astype('complex'), mu, atol=tol, btol=tol, conlim=tol, maxiter=maxiter)
             print("istop = %i \n" % x[1])
             print("Used iterations = %i \n" % x[2])
             print("Misfit = %f \n " % x[3])
@@ -561,6 +582,13 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
             print("Norm of Dv = %f \n" % x[6])
             Dv_rec = x[0]
 
+        elif solver in ("cg") and isinstance(A, LinearOperator):
+            # Damped normal equations (A^H A + mu I) Dv = A^H dv.
+            B 		= A.H * A + mu * sparse.linalg.aslinearoperator(sparse.eye(A.shape[1]))
+            madj 	= A.H.dot(dv)
+            x 		= sparse.linalg.cg(B, madj, maxiter=maxiter)
+            Dv_rec 	= x[0]
+
         elif solver in ("cg"):
             A 		= Ts.dot(FH.dot(Yw))
             Ah 		= A.conjugate().transpose()
@@ -572,7 +600,8 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
             Dv_rec 	= x[0]
 
         elif solver in ('fmin'):
-            A 		= Ts.dot(FH.dot(Yw))
+            if not isinstance(A, LinearOperator):
+                A 	= Ts.dot(FH.dot(Yw))
             global arg1
             global arg2
             global arg3
@@ -586,7 +615,7 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
 
             Dv_rec = sp.optimize.fmin_cg(J, x0=Dv, maxiter=10)
 
-        data_rec = np.fft.ifft2(Dv_rec.reshape(fkData.shape)).real
+        data_rec = ifft2(Dv_rec.reshape(fkData.shape)).real
 
     elif solver in ("pocs"):
         pocs=True
@@ -594,13 +623,13 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
 
         for i in range(maxiter):
             data_tmp 								= ArrayData.copy()
-            fkdata 									= np.fft.fft2(data_tmp) * W.astype('complex')
+            fkdata 									= fft2(data_tmp) * W.astype('complex')
             fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
             threshold = threshold * alpha
             #if i % 10 == 0.:
             #	plt.imshow(abs(fkdata), aspect='auto', interpolation='none')
             #	plt.savefig("%s.png" % i)
-            data_tmp 								= np.fft.ifft2(fkdata).real.copy()
+            data_tmp 								= ifft2(fkdata).real.copy()
             ArrayData[recon_list] 					= data_tmp[recon_list]
 
         data_rec = ArrayData.copy()
@@ -626,7 +655,8 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
         return st_rec
 
 def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='linear', beta=None, peaks=None, maskshape=None,
-               dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, alpha_i_test=False, st_org=None, plotfeedback=False):
+               dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, alpha_i_test=False, st_org=None, plotfeedback=False,
+               ssa_batched=False, ssa_workers=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros. It applies the projection onto convex sets (pocs) algorithm in
@@ -643,6 +673,12 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
     :param nol: Number of loops
     :type  nol:
 
+    :param ssa_batched: method 'ssa' only, stacked SVD over frequencies, see fx_ssa
+    :type  ssa_batched: bool
+
+    :param ssa_workers: method 'ssa' only, number of threads for the frequencies, see fx_ssa
+    :type  ssa_workers: int
+
     returns:
 
     :param st_rec:
@@ -692,7 +728,8 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
         Qmax = 0.
         for i in i_range:
             for a in alpha_range:
-                ADrec = pocs(ArrayData, i, noft, a, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback)
+                ADrec = pocs(ArrayData, i, noft, a, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback,
+                             ssa_batched=ssa_batched, ssa_workers=ssa_workers)
                 Q = 10.*np.log( np.linalg.norm(ADref,2)**2. / np.linalg.norm(ADref - ADrec,2)**2. )
 
                 if Q >= Qmax: # and maxiter > i:
@@ -705,10 +742,12 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
                 print ('Progress of alpha-i test: %i %%, current Q: %f, current Qmax: %f' % ( int(progress),Q ,Qmax ), end='\r')
                 sys.stdout.flush()
 
-        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow)
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow,
+                       ssa_batched=ssa_batched, ssa_workers=ssa_workers)
 
     else:
-        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback)
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback,
+                       ssa_batched=ssa_batched, ssa_workers=ssa_workers)
 
     #datap = ADfinal.copy()
 
@@ -726,6 +765,76 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
 
     return st_rec
 
+def pocs_recon_batch(streams, maxiter, alpha=0.9, method='linear', batchsize=None):
+    """
+    Reconstructs missing signals of several events at once, using the batched pocs
+    algorithm (see bowpy.util.fkutil.pocs_batch). All streams need the same number
+    of traces and samples, e.g. event gathers of the same array and window length.
+
+    Reference: 3D interpolation of irregular data with a POCS algorithm, Abma & Kabir, 2006
+
+    :param streams: Streams with missing traces, filled with zeros
+    :type  streams: list of obspy.core.stream.Stream
+
+    :param maxiter: Number of iterations, for all events or for each event
+    :type  maxiter: int or array-like
+
+    :param alpha: Factor of threshold decrease after each iteration, for all events or
+                  for each event
+    :type  alpha: float or array-like
+
+    :param method: Threshold decrease, 'linear' or 'exp'
+    :type  method: string
+
+    :param batchsize: Number of events transformed at once, default is all events.
+    :type  batchsize: int
+
+    returns:
+
+    :param st_recs: Reconstructed streams
+    :type  st_recs: list of obspy.core.stream.Stream
+    """
+    cube 	= []
+    noft 	= []
+    for st in streams:
+        st_tmp 		= st.copy()
+        cube.append(stream2array(st_tmp, normalize=True))
+        recon_list 	= []
+        for i, trace in enumerate(st_tmp):
+            try:
+                if trace.stats.zerotrace in ['True']:
+                    recon_list.append(i)
+
+            except AttributeError:
+                if sum(trace.data) == 0. :
+                    recon_list.append(i)
+
+            except:
+                continue
+        noft.append(recon_list)
+
+    try:
+        cube = np.array(cube)
+    except ValueError:
+        raise IOError('All streams need the same number of traces and samples')
+
+    ADfinal = pocs_batch(cube, maxiter, noft, alpha, method, batchsize)
+
+    maxiter = np.broadcast_to(maxiter, (len(streams),))
+    alpha 	= np.broadcast_to(alpha, (len(streams),))
+
+    st_recs = []
+    for j, st in enumerate(streams):
+        st_rec 	= array2stream(ADfinal[j], st)
+        st_rec.normalize()
+        for trace in st_rec:
+            trace.stats.pocs =  {'alpha': alpha[j], 'iteration': maxiter[j]}
+        for trace in noft[j]:
+            st_rec[trace].stats.recon = True
+        st_recs.append(st_rec)
+
+    return st_recs
+
 def _fk_extract_polygon(data, polygon, xlabel=None, xticks=None, ylabel=None, yticks=None, eval_mean=1, fs=25):
     """
     Only use with the function fk_filter!
@@ -5,9 +5,8 @@ from numpy import dot
 import math
 from math import pi
 
-import scipy as sp
-from scipy import sparse
-from bowpy.util.base import nextpow2
+from scipy.linalg import solve_toeplitz
+from bowpy.util.fft_backend import fft, ifft, fft_length
 from bowpy.util.picker import get_polygon
 from bowpy.util.array_util import stream2array, attach_epidist2coords, epidist2nparray
 
@@ -59,7 +58,7 @@ def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperp
 	return Mpick, xticks, yticks
 
 
-def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyperparameters):
+def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyperparameters, fblock=None, solver='auto', tol=1e-3, maxiter=10):
 	"""
 	This function inverts move-out data to the Radon domain given the inputs:
 	:param st:
@@ -85,6 +84,18 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 								 'Cauchy'   - Non-linear regularization see Sacchi & Ulrych 1995
 	
 	:param hyperparameters: trades-off between fitting the data and chosen damping.
+
+	:param fblock:   -- number of frequencies, whose L2 problems are set up and solved at once.
+						Default is a block of about 2**24 matrix elements.
+
+	:param solver: 	select one of the following options for the L2 problems:
+					'auto'      - 'toeplitz' for an evenly sampled p, else 'direct' (default)
+					'toeplitz'  - Levinson recursion, AtA is Toeplitz for an evenly sampled p
+					'direct'    - batched LU solution of all frequencies of a block
+
+	:param tol:      -- relative change of the cost function, that stops the IRLS iterations of 'L1' and 'Cauchy'.
+
+	:param maxiter:  -- maximum number of IRLS iterations per frequency.
 	
 	returns: radon domain is ordered size(R)==[length(p),length(t)], time-axis and distance-axis.
 	
@@ -123,13 +134,15 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 	delta = np.array([ epi.copy() ])
 	ref_dist = np.mean(delta)
 
-	if not weights:
+	if weights is None:
 		weights = np.ones(delta.size)
+	weights = np.asarray(weights)
+	p = np.asarray(p, dtype='float')
 
 	t = np.linspace(0,st_tmp[0].stats.delta * st_tmp[0].stats.npts, st_tmp[0].stats.npts)
 	it=t.size
 	print(it)
-	iF=int(math.pow(2,nextpow2(it)+1)) # Double length
+	iF=fft_length(2*it) # Double length
 
    
 	iDelta=delta.size
@@ -148,7 +161,7 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 
 	#Exit if improper hyperparameters are entered.
 	if inversion_model in ["L1", "Cauchy"]:
-		if not len(hyperparameters == 2):
+		if not len(hyperparameters) == 2:
 			print("Improper number of trade-off parameters\n")
 			R=0
 			return(R)
@@ -161,91 +174,192 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 	#Preallocate space in memory.
 	R=np.zeros((ip,it)) 
 	Rfft=np.zeros((ip,iF)) + 0j
-	A=np.zeros((iDelta,ip)) + 0j
-	Tshift=np.zeros((iDelta,ip)) + 0j
-	AtA=np.zeros((ip,ip)) + 0j
-	AtM=np.zeros((ip,1)) + 0j
-	Ident=np.identity(ip)
 
 	#Define some values
 	Dist_array=delta-ref_dist
 	dF=1./(t[0]-t[1])
-	Mfft=np.fft.fft(M,iF,1)
-	W=sparse.spdiags(weights.conj().transpose(), 0, iDelta, iDelta).A
-	dCOST=0.
-	COST_curv=0.
-	COST_prev=0.
+	Mfft=fft(M,iF,1)
 
 	#Populate ray parameter then distance data in time shift matrix.
-	for j in range(iDelta):
-		if line_model == "parabolic":
-			Tshift[j]=p
-		else: #Linear is default
-			Tshift[j]=p
-	
-	for k in range(ip):
-		if line_model == 'parabolic':
-			Tshift[:,k]=(2. * ref_dist * Tshift[:,k] * Dist_array.conj().transpose()) + (Tshift[:,k] * (Dist_array**2).conj().transpose())
-		else: #Linear is default
-			Tshift[:,k]=Tshift[:,k] * Dist_array[0].conj().transpose()
+	if line_model == 'parabolic':
+		g = (2. * ref_dist * Dist_array[0]) + Dist_array[0]**2
+	else: #Linear is default
+		g = Dist_array[0]
+	Tshift = np.outer(g, p)
+
+	# Frequencies up to Nyquist, the negative ones follow from Hermitian symmetry.
+	nF = int(math.floor((iF+1)/2))
+	F = (np.arange(nF)/float(iF))*dF
+
+	# M = A R ---> AtM = AtA R
+	# Solve the weighted, L2 least-squares problem for an initial solution.
+	# The trace of AtA is ip * sum(weights) for all frequencies.
+	mu = abs(ip * np.sum(weights)) * hyperparameters[0]
+	Rfft[:,:nF] = _radon_l2(Mfft[:,:nF], weights, g, p, F, mu, fblock, solver)
+
+	#Non-linear methods use IRLS to solve, iterate until convergence to solution.
+	if inversion_model in ("Cauchy", "L1"):
+		Rfft[:,:nF] = _radon_irls(Mfft[:,:nF], weights, Tshift, F, mu, hyperparameters, inversion_model,
+								  Rfft[:,:nF], tol, maxiter)
+
+	#Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
+	Rfft[:,iF-nF+1:] = Rfft[:,nF-1:0:-1].conjugate()
+
+	R = ifft(Rfft, iF)
+	R = R[:,0:it]
+
+	return R, t, epi
+
+
+def _radon_l2(Mfft, weights, g, p, F, mu, fblock=None, solver='auto'):
+	"""
+	Solves the damped, weighted L2 problems (AtA + mu*I) R = AtM of all frequencies F,
+	with A = exp(i 2 pi f g p^T), in blocks of fblock frequencies.
 
-	# Loop through each frequency.
-	for i in range( int(math.floor((iF+1)/2)) ):
-		print('Step %i of %i' % (i, int(math.floor((iF+1)/2))) )
+	returns: Rfft of size (len(p), len(F))
+	"""
+	iDelta, nF = Mfft.shape
+	ip = p.size
+
+	# AtA[k,l] = sum_j w_j exp(i 2 pi f g_j (p_l - p_k)) only depends on l-k for an even p.
+	dp = p[1] - p[0] if ip > 1 else 0.
+	even = ip > 1 and np.all( abs(np.diff(p) - dp) <= 1e-6 * abs(dp) )
+	if solver == 'auto':
+		solver = 'toeplitz' if even else 'direct'
+	if solver == 'toeplitz' and not even:
+		msg = "solver 'toeplitz' needs an evenly sampled p"
+		raise IOError(msg)
+	elif solver not in ('toeplitz', 'direct'):
+		msg = "Unknown solver '%s', use 'auto', 'toeplitz' or 'direct'" % solver
+		raise IOError(msg)
+
+	if not fblock:
+		fblock = max(1, int(2**24 / (ip * max(ip, iDelta))))
+
+	Rfft = np.zeros((ip, nF)) + 0j
+	Tshift = np.outer(g, p)
+	lags = np.outer(g, np.arange(ip) * dp)
+	diag = np.arange(ip)
+
+	for i0 in range(0, nF, fblock):
+		f = F[i0:i0+fblock]
+		print('Step %i of %i' % (i0, nF) )
+
+		# Time-shift matrices of the block, size (len(f), iDelta, ip).
+		A = np.exp( (0.+1j)*2*pi*f[:,None,None] * Tshift )
+		AtW = A.conj().transpose(0,2,1) * weights
+		AtM = np.matmul( AtW, Mfft[:,i0:i0+f.size].transpose()[:,:,None] )[:,:,0]
+
+		if solver == 'toeplitz':
+			# First row of AtA, the first column is its complex conjugate.
+			h = np.matmul( np.exp( (0.+1j)*2*pi*f[:,None,None] * lags ).transpose(0,2,1), weights )
+			for k in range(f.size):
+				r = h[k].copy()
+				r[0] += mu
+				Rfft[:,i0+k] = solve_toeplitz( (r.conjugate(), r), AtM[k] )
+		else:
+			AtA = np.matmul(AtW, A)
+			AtA[:,diag,diag] += mu
+			Rfft[:,i0:i0+f.size] = np.linalg.solve(AtA, AtM[:,:,None])[:,:,0].transpose()
+
+	return Rfft
+
+def _radon_irls(Mfft, weights, Tshift, F, mu, hyperparameters, inversion_model, Rfft, tol=1e-3, maxiter=10):
+	"""
+	Iteratively reweighted least squares for the 'L1' and 'Cauchy' models, starting from the
+	L2 solution Rfft. Each iteration solves (lam*Q + AtWA) R = AtWM with conjugate gradients
+	on the matrix-free operator, from the current iterate. Each frequency starts from its
+	neighbour's solution, if that fits better than its own L2 solution.
+
+	returns: Rfft of size (len(p), len(F))
+	"""
+	ip, nF = Rfft.shape
+	Rfft = Rfft.copy()
+
+	#Initialize hyperparameters.
+	b=hyperparameters[1]
+	lam=mu*b
+
+	def cost(A, M, R):
+		if inversion_model == "Cauchy":
+			return np.linalg.norm( M - dot(A,R), 2 )**2 + lam*sum( np.log( abs(R)**2 + b ) - np.log(b) )
+		return np.linalg.norm( M - dot(A,R), 2 )**2 + lam*np.linalg.norm( abs(R) + b, 1 )
+
+	for i in range(nF):
+		print('Step %i of %i' % (i, nF) )
 		# Make time-shift matrix, A.
-		f = ((float(i)/float(iF))*dF)
-		A = np.exp( (0.+1j)*2*pi*f * Tshift )
-
-		# M = A R ---> AtM = AtA R
-		# Solve the weighted, L2 least-squares problem for an initial solution.
-		AtA = dot( dot(A.conj().transpose(), W), A )
-		AtM = dot( A.conj().transpose(), dot( W, Mfft[:,i] ) )
-		mu = abs(np.trace(AtA)) * hyperparameters[0]
-		Rfft[:,i] = sp.linalg.solve((AtA + mu*Ident), AtM)
-
-		#Non-linear methods use IRLS to solve, iterate until convergence to solution.
-		if inversion_model in ("Cauchy", "L1"):
-			
-			#Initialize hyperparameters.
-			b=hyperparameters[1]
-			lam=mu*b
-
-			#Initialize cost functions.
-			dCOST = float("Inf")
-			if inversion_model == "Cauchy":
-				COST_prev = np.linalg.norm( Mfft[:,i] - dot(A,Rfft[:,i]), 2 ) + lam*sum( np.log( abs(Rfft[:,i]**2 + b) ) )
-			elif inversion_model == "L1":
-				COST_prev = np.linalg.norm( Mfft[:,i] - dot(A,Rfft[:,i]), 2 ) + lam*np.linalg.norm( abs(Rfft[:,i]+1), 1 )
-			itercount=1
-			
-			#Iterate until negligible change to cost function.
-			while dCost > 0.001 and itercount < 10:
-				
-				#Setup inverse problem.
-				if inversion_model == "Cauchy":
-					Q = sparse.spdiags( 1./( abs(Rfft[:,i]**2) + b), 0, ip, ip).A
-				elif inversion_model == "L1":
-					Q = sparse.spdiags( 1./( abs(Rfft[:,i]) + b), 0, ip, ip).A
-				Rfft[:,i]=sp.linalg.solve( ( lam * Q + AtA ), AtM )
-				
-				#Determine change to cost function.
-				if inversion_model == "Cauchy":
-					COST_cur = np.linalg.norm( Mfft[:,i]-A*Rfft[:,i], 2 ) + lam*sum( np.log( abs(Rfft[:,i]**2 + b )-np.log(b) ) )
-				elif inversion_model == "L1":
-					COST_cur = np.linalg.norm( Mfft[:,i]-A*Rfft[:,i], 2 ) + lam*np.linalg.norm( abs(Rfft[:,i]+1) + b, 1 )
-				dCOST = 2*abs(COST_cur - COST_prev)/(abs(COST_cur) + abs(COST_prev))
-				COST_prev = COST_cur
-				
-				itercount += 1
+		A = np.exp( (0.+1j)*2*pi*F[i] * Tshift )
+		AtM = dot( A.conj().transpose(), weights * Mfft[:,i] )
+		AtWA = lambda x: dot( A.conj().transpose(), weights * dot(A, x) )
+		# Diagonal of AtWA, |A|=1.
+		wsum = abs(np.sum(weights))
 
-			#Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
-		if i != 0:
-			Rfft[:,iF-i] = Rfft[:,i].conjugate()
+		if i > 0:
+			Q = _irls_weights(Rfft[:,i], b, inversion_model)
+			matvec = lambda x: lam * Q * x + AtWA(x)
+			res_l2 = np.linalg.norm( AtM - matvec(Rfft[:,i]) )
+			res_nb = np.linalg.norm( AtM - matvec(Rfft[:,i-1]) )
+			x0 = Rfft[:,i-1] if res_nb < res_l2 else Rfft[:,i]
+		else:
+			x0 = Rfft[:,i]
 
-	R = np.fft.ifft(Rfft, iF)
-	R = R[:,0:it]
+		#Initialize cost functions.
+		COST_prev = cost(A, Mfft[:,i], Rfft[:,i])
+		dCOST = float("Inf")
+		itercount=0
 
-	return R, t, epi
+		#Iterate until negligible change to cost function.
+		while dCOST > tol and itercount < maxiter:
+
+			#Setup inverse problem.
+			Q = _irls_weights(Rfft[:,i], b, inversion_model)
+			matvec = lambda x: lam * Q * x + AtWA(x)
+			Rfft[:,i] = _cg(matvec, AtM, x0, lam * Q + wsum, 0.1 * tol, ip)
+			x0 = Rfft[:,i]
+
+			#Determine change to cost function.
+			COST_cur = cost(A, Mfft[:,i], Rfft[:,i])
+			dCOST = 2*abs(COST_cur - COST_prev)/(abs(COST_cur) + abs(COST_prev))
+			COST_prev = COST_cur
+
+			itercount += 1
+
+	return Rfft
+
+
+def _irls_weights(R, b, inversion_model):
+	if inversion_model == "Cauchy":
+		return 1./( abs(R)**2 + b )
+	return 1./( abs(R) + b )
+
+
+def _cg(matvec, b, x0, diag, tol, maxiter):
+	"""
+	Jacobi preconditioned conjugate gradients for a Hermitian, positive definite operator.
+	Stops if the residual is below tol relative to b.
+	"""
+	x = x0.copy()
+	r = b - matvec(x)
+	z = r / diag
+	d = z.copy()
+	rz = np.vdot(r, z).real
+	bnorm = np.linalg.norm(b)
+	if bnorm == 0:
+		return np.zeros_like(x)
+
+	for k in range(maxiter):
+		if np.linalg.norm(r) <= tol * bnorm:
+			break
+		Ad = matvec(d)
+		alpha = rz / np.vdot(d, Ad).real
+		x += alpha * d
+		r -= alpha * Ad
+		z = r / diag
+		rz_new = np.vdot(r, z).real
+		d = z + (rz_new / rz) * d
+		rz = rz_new
+
+	return x
 
 def radon_forward(t,p,R,delta,ref_dist,line_model):
 	"""
@@ -285,54 +399,125 @@ def radon_forward(t,p,R,delta,ref_dist,line_model):
 		raise TypeError
 
 	it=t.size
-	iF=int(math.pow(2,nextpow2(it)+1)) # Double length
-	iDelta=delta.size
 	ip=len(p)
 
 	#Exit if inconsistent data is input.
 	if R.shape != (ip, it):
-		print("Dimensions inconsistent!\nShape of M is not equal to (len(delta),len(t)) \nShape of M = (%i , %i)\n(len(delta),len(t)) = (%i, %i) \n" % (M.shape[0],  M.shape[1], iDelta, it) )
+		print("Dimensions inconsistent!\nShape of R is not equal to (len(p),len(t)) \nShape of R = (%i , %i)\n(len(p),len(t)) = (%i, %i) \n" % (R.shape[0],  R.shape[1], ip, it) )
 		M=0
 		return(M)
 
-	#Preallocate space in memory.
-	Mfft = np.zeros((iDelta, iF)) + 0j
-	A = np.zeros((iDelta, ip)) + 0j
-	Tshift = np.zeros((iDelta, ip)) + 0j
+	M = RadonOperator(t, p, delta, ref_dist, line_model).forward(R)
 
-	#Define some values.
-	Dist_array=delta-ref_dist
-	dF=1./(t[0]-t[1])
-	Rfft=np.fft.fft(R,iF,1)
+	return(M)
 
-	#Populate ray parameter then distance data in time shift matrix.
-	for j in range(iDelta):
-		if line_model == "parabolic":
-			Tshift[j,:]=p
-		else: #Linear is default
-			Tshift[j,:]=p
-	
-	for k in range(ip):
-		if line_model == 'parabolic':
-			Tshift[:,k]=(2. * ref_dist * Tshift[:,k] * Dist_array.conj().transpose()) + (Tshift[:,k] * (Dist_array**2).conj().transpose())
-		else: #Linear is default
-			Tshift[:,k]=Tshift[:,k] * Dist_array.conj().transpose()
 
-	# Loop through each frequency.
-	for i in range( int(math.floor((iF+1)/2))-1 ):
+class RadonOperator(object):
+	"""
+	Time-shift Radon operator A of a fixed geometry, and its adjoint A^H.
+	forward maps Radon data R, size (len(p),len(t)), to move-out data M, size
+	(len(delta),len(t)); adjoint maps M back. Both apply A or A^H to all frequencies
+	below Nyquist that radon_inverse solves for, in blocks of fblock frequencies, the
+	delay table is computed once.
 
-		# Make time-shift matrix, A.
-		f = ((float(i)/float(iF))*dF)
-		A = np.exp( (0.+1j)*2*pi*f * Tshift )
-		
-		# Apply Radon operator.
-		Mfft[:,i]=dot(A, Rfft[:,i])
+	:param t: vector of time axis, evenly sampled.
+	:type t: numpy.ndarray
 
-		# Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
-		if i != 0:
-			Mfft[:,iF-i] = Mfft[:,i].conjugate()
+	:param p: vector of slowness axis.
+	:type p: array_like
 
-	M = np.fft.ifft(Mfft, iF)
-	M = M[:,0:it]		
+	:param delta: vector of distance axis.
+	:type delta: array_like
 
-	return(M)
+	:param ref_dist: reference distance the path-function will shift about.
+	:type ref_dist: float
+
+	:param line_model: 'linear' (default) or 'parabolic' paths in the spatial domain.
+	:type line_model: string
+
+	:param fblock: number of frequencies per block, default is a block of about 2**24 elements.
+	:type fblock: int
+
+	example:	op = RadonOperator(t, P_axis, Delta_resampled, meandelta, 'linear')
+				M = op.forward(R)
+				R_adj = op.adjoint(M)
+	"""
+	def __init__(self, t, p, delta, ref_dist, line_model='linear', fblock=None):
+		self.t = np.asarray(t, dtype='float')
+		self.p = np.asarray(p, dtype='float')
+		self.delta = np.asarray(delta, dtype='float')
+		self.ref_dist = ref_dist
+
+		self.it = self.t.size
+		self.iF = fft_length(2*self.it) # Double length
+		self.dF = 1./(self.t[0]-self.t[1])
+		# Frequencies of the operator, the same as of radon_inverse; the negative ones
+		# follow from Hermitian symmetry.
+		self.nF = int(math.floor((self.iF+1)/2))
+		self.F = (np.arange(self.nF)/float(self.iF))*self.dF
+
+		#Populate ray parameter then distance data in time shift matrix.
+		Dist_array = self.delta - ref_dist
+		if line_model == 'parabolic':
+			g = (2. * ref_dist * Dist_array) + Dist_array**2
+		else: #Linear is default
+			g = Dist_array
+		self.Tshift = np.outer(g, self.p)
+
+		if not fblock:
+			fblock = max(1, int(2**24 / self.Tshift.size))
+		self.fblock = fblock
+
+	def forward(self, R):
+		"""
+		Applies A to the Radon data R, size (len(p),len(t)).
+
+		returns: move-out data M, size (len(delta),len(t))
+		"""
+		return self._apply(R, self.p.size, self.delta.size, False)
+
+	def adjoint(self, M):
+		"""
+		Applies A^H to the move-out data M, size (len(delta),len(t)).
+
+		returns: Radon data, size (len(p),len(t))
+		"""
+		return self._apply(M, self.delta.size, self.p.size, True)
+
+	def dot_test(self, seed=None):
+		"""
+		Dot-product test <A R, M> = <R, A^H M> with random R and M.
+
+		returns: relative difference of both products, close to machine precision.
+		"""
+		rng = np.random.RandomState(seed)
+		R = rng.standard_normal((self.p.size, self.it))
+		M = rng.standard_normal((self.delta.size, self.it))
+		lhs = np.vdot(self.forward(R), M)
+		rhs = np.vdot(R, self.adjoint(M))
+
+		return abs(lhs - rhs) / max(abs(lhs), abs(rhs))
+
+	def _apply(self, X, nin, nout, adjoint):
+		if X.shape != (nin, self.it):
+			msg = 'Input of shape %s, expected (%i, %i)' % (str(X.shape), nin, self.it)
+			raise IOError(msg)
+
+		iF, nF = self.iF, self.nF
+		Xfft = fft(X, iF, 1)
+		Yfft = np.zeros((nout, iF)) + 0j
+
+		for i0 in range(0, nF, self.fblock):
+			f = self.F[i0:i0+self.fblock]
+			# Make time-shift matrices, A.
+			A = np.exp( (0.+1j)*2*pi*f[:,None,None] * self.Tshift )
+			if adjoint:
+				A = A.conj().transpose(0,2,1)
+			Yfft[:,i0:i0+f.size] = np.matmul( A, Xfft[:,i0:i0+f.size].transpose()[:,:,None] )[:,:,0].transpose()
+
+		# Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate.
+		Yfft[:,iF-nF+1:] = Yfft[:,nF-1:0:-1].conjugate()
+
+		Y = ifft(Yfft, iF)
+
+		return Y[:,0:self.it].real
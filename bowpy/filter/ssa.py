@@ -1,19 +1,21 @@
 from __future__ import absolute_import, print_function
+from contextlib import contextmanager
 import numpy
 import numpy as np
 from numpy import dot
 import math
 import scipy as sp
-from bowpy.util.fkutil import nextpow2
+from scipy.sparse.linalg import LinearOperator, svds
+from bowpy.util.fft_backend import fft, ifft, fft_length
 from bowpy.util.base import stream2array, array2stream
 import sys
 
-def ssa_denoise_recon(st, p, flow, fhigh):
+def ssa_denoise_recon(st, p, flow, fhigh, svd_method='full', batched=False, nworkers=None):
 	"""
 	SSA method, that de-noises the data given in stream by a rank reduction of the singular values of the
 	Hankel matrix, created from the data in st and the sampling interval of the traces, to p.
 
- 	:param st:     Stream of data
+	:param st:     Stream of data
 	:type  st:
 
 	:param dt:     sampling interval
@@ -28,6 +30,15 @@ def ssa_denoise_recon(st, p, flow, fhigh):
 	:param fhigh:  max  freq. in the data in Hz
 	:type  fhigh:  float
 
+	:param svd_method: 'full', 'arpack' or 'randomized', see ssa
+	:type  svd_method: string
+
+	:param batched: Stacked SVD of the Hankel matrices of many frequencies, see fx_ssa
+	:type  batched: bool
+
+	:param nworkers: Number of threads for the frequencies, see fx_ssa
+	:type  nworkers: int
+
 
 	Example
 	st = stream
@@ -44,29 +55,34 @@ def ssa_denoise_recon(st, p, flow, fhigh):
 
 	dt = st_tmp[0].stats.delta
 
-	data_ssa = fx_ssa(data,dt,p,flow,fhigh)
+	data_ssa = fx_ssa(data,dt,p,flow,fhigh,svd_method,batched,nworkers)
 	
 	st_ssa = array2stream(data_ssa, st_tmp)
 	
 	return st_ssa
 
-def ssa(d,nw,p,ssa_flag):
+def ssa(d,nw,p,ssa_flag,svd_method='full'):
 	"""
 	SSA: 1D Singular Spectrum Analysis for snr enhancement
 
-	  dp,sing,R = ssa(d,nw,p,ssa_flag);
+	dp,sing,R = ssa(d,nw,p,ssa_flag);
 
-	  IN   d:   1D time series (column)
-	       nw:  view used to make the Hankel matrix
-	       p:   number of singular values used to reconstuct the data
-	       ssa_flag = 0 do not compute R
+	IN   d:   1D time series (column)
+	nw:  view used to make the Hankel matrix
+	p:   number of singular values used to reconstuct the data
+	ssa_flag = 0 do not compute R
+	svd_method: 'full' dense SVD of the Hankel matrix, 'arpack' truncated SVD
+	            (scipy.sparse.linalg.svds) or 'randomized' randomized SVD.
+	            'arpack' and 'randomized' compute products with the Hankel
+	            matrix by FFT and never form it, sing then contains the
+	            first p singular values only.
 
-	  OUT  dp:  predicted (clean) data
-	       R:   matrix consisting of the data predicted with
-	            the first eof (R[:,0]), the second eof (R[:,1]) etc
-	       sing: singular values of the Hankel matrix
+	OUT  dp:  predicted (clean) data
+	R:   matrix consisting of the data predicted with
+	the first eof (R[:,0]), the second eof (R[:,1]) etc
+	sing: singular values of the Hankel matrix
 
-	  Example:
+	Example:
 		from math import pi
 		import numpy as np
 		from numpy import cos
@@ -87,27 +103,27 @@ def ssa(d,nw,p,ssa_flag):
 		plt.show()
 		plt.ioff()
 
-	  Based on: 
+	Based on: 
 
-	  M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
-	                    http://www.geoconvention.org/2009abstracts/194.pdf
+	M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
+	http://www.geoconvention.org/2009abstracts/194.pdf
 
-	  Copyright (C) 2008, Signal Analysis and Imaging Group.
-	  For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
-	  Author: M.D.Sacchi
-	  Translated to Python by: S. Schneider, 2016
+	Copyright (C) 2008, Signal Analysis and Imaging Group.
+	For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
+	Author: M.D.Sacchi
+	Translated to Python by: S. Schneider, 2016
 
 
 
-	  This program is free software: you can redistribute it and/or modify
-	  it under the terms of the GNU General Public License as published
-	  by the Free Software Foundation, either version 3 of the License, or
-	  any later version.
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published
+	by the Free Software Foundation, either version 3 of the License, or
+	any later version.
 
-	  This program is distributed in the hope that it will be useful,
-	  but WITHOUT ANY WARRANTY; without even the implied warranty of
-	  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-	  GNU General Public License for more details: http://www.gnu.org/licenses/
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details: http://www.gnu.org/licenses/
 
 	"""
 
@@ -120,91 +136,100 @@ def ssa(d,nw,p,ssa_flag):
 
 	nt = d.size
 	N = int(nt-nw+1)
-	l = np.arange(0,nw,1)
-	R = np.zeros((nt,p))
 
- 	# Make Hankel Matrix.
-	M = np.zeros((N-1,N)).astype('complex')
-	Mp = np.zeros((N-1,N)).astype('complex')
+	if svd_method in ('arpack', 'randomized') and p < min(nw, N):
+		M = _hankel_operator(d, nw)
 
-	for k in range(N):
-		M[:,k] = d[k+l]
+		# Eigenimage decomposition, first p components
+		if svd_method == 'arpack':
+			U,S,V = svds(M, k=p)
+			order = np.argsort(S)[::-1]
+			U, S = U[:,order], S[order]
+		else:
+			U,S = _randomized_svd(M, p)
 
- 	# Eigenimage decomposition
+		Up = U[:,:p]
+		B = M.rmatmat(Up).conj().transpose()
 
-	U,S,V = sp.linalg.svd(M)
-	
+	elif svd_method in ('full', 'arpack', 'randomized'):
+		# Make Hankel Matrix.
+		l = np.arange(0,nw,1)
+		M = d[l[:,np.newaxis] + np.arange(N)].astype('complex')
 
+		# Eigenimage decomposition
+		U,S,V = sp.linalg.svd(M)
+		Up = U[:,:p]
+		B = dot(Up.conj().transpose(), M)
 
-	# Reconstruct with one oscillatory component at the time.
+	else:
+		msg = "Unknown svd_method '%s', use 'full', 'arpack' or 'randomized'" % svd_method
+		raise IOError(msg)
+
+	# Reconstruct from Up (Up^H M), the anti-diagonal sums of each component
+	# u_k b_k^T are the convolutions of u_k and b_k.
 	if not ssa_flag == 0:
-	 	for k in range(p):
-			u = np.zeros((N-1,2)).astype('complex')
-	 		u[:,0] = U[:,k]
-	 		Mp = dot( dot(u, u.conj().transpose()), M )
-	 		R[:,k] = average_anti_diag(Mp)
-	 	dp = sum(d)
+		R = _average_anti_diag_lowrank(Up, B, components=True).real
+		dp = sum(d)
 
 	else:
-	 	
-		for k in range(p):
-			u = np.zeros((N-1,2)).astype('complex')
-			u[:,0] = U[:,k]
-			Mp = Mp + dot( dot(u, u.conj().transpose()), M )
-
 		R = None
-		dp = average_anti_diag(Mp)
-		
+		dp = _average_anti_diag_lowrank(Up, B)
 
 	sing = S
 
 	return(dp,sing,R)
 
-def fx_ssa(data,dt,p,flow,fhigh):
+def fx_ssa(data,dt,p,flow,fhigh,svd_method='full',batched=False,nworkers=None):
 	"""
 	FX_SSA: Singular Spectrum Analysis in the fx domain for snr enhancement
 	
 	
-	 [data_f] = fx_ssa(data,dt,p,flow,fhigh);
+	[data_f] = fx_ssa(data,dt,p,flow,fhigh);
 	
-	  IN   data:      data (traces are columns)
-	       dt:     sampling interval
-	       p:      number of singular values used to reconstuct the data
-	       flow:   min  freq. in the data in Hz
-	       fhigh:  max  freq. in the data in Hz
+	IN   data:      data (traces are columns)
+	dt:     sampling interval
+	p:      number of singular values used to reconstuct the data
+	flow:   min  freq. in the data in Hz
+	fhigh:  max  freq. in the data in Hz
+	svd_method: 'full', 'arpack' or 'randomized', see ssa
+	batched: if True, the Hankel matrices of a block of frequencies are
+	         decomposed by one stacked np.linalg.svd ('full' only)
+	nworkers: number of threads the frequencies are distributed to, BLAS
+	          is limited to one thread per worker if threadpoolctl is
+	          installed
 	
 	
-	  OUT  data_f:  filtered data
+	OUT  data_f:  filtered data
 	
-	  Example:
+	Example:
 	
-	        d = linear_events;
-	        [df] = fx_ssa(d,0.004,4,1,120);
-	        wigb([d,df]);
+	d = linear_events;
+	[df] = fx_ssa(d,0.004,4,1,120);
+	wigb([d,df]);
 	
-	  Based on:
+	Based on:
 	
-	  M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
-	                    http://www.geoconvention.org/2009abstracts/194.pdf
+	M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
+	http://www.geoconvention.org/2009abstracts/194.pdf
 	
-	  Copyright (C) 2008, Signal Analysis and Imaging Group.
-	  For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
-	  Author: M.D.Sacchi
-	  Translated to Python by: S. Schneider 2016
+	Copyright (C) 2008, Signal Analysis and Imaging Group.
+	For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
+	Author: M.D.Sacchi
+	Translated to Python by: S. Schneider 2016
 	
-	  This program is free software: you can redistribute it and/or modify
-	  it under the terms of the GNU General Public License as published
-	  by the Free Software Foundation, either version 3 of the License, or
-	  any later version.
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published
+	by the Free Software Foundation, either version 3 of the License, or
+	any later version.
 	
-	  This program is distributed in the hope that it will be useful,
-	  but WITHOUT ANY WARRANTY; without even the implied warranty of
-	  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-	  GNU General Public License for more details: http://www.gnu.org/licenses/
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details: http://www.gnu.org/licenses/
 	
 	"""
 	nt, ntraces = data.shape
-	nf = 2 * 2 ** nextpow2(nt)
+	nf = fft_length(2 * nt)
 
 	# First and last samples of the DFT.
 
@@ -216,37 +241,263 @@ def fx_ssa(data,dt,p,flow,fhigh):
 	if ihigh > math.floor(nf/2)+1:
 		ihigh = int(math.floor(nf/2)+1)
 	
-	data_FX = np.fft.fft(data, nf, axis=0)
+	data_FX = fft(data, nf, axis=0)
 	data_FX_f = np.zeros(data_FX.shape).astype('complex')
 	
 	nw = int(math.floor(ntraces/2))
 
-	print("		Loop through frequencies \n")
-	i=1
-	rend = len(range(ilow,ihigh+1))
-	for k in range(ilow,ihigh+1):
-		
-		prcnt = 100*i/rend
-		print("		%i %% done" % (prcnt), end="\r")
-		sys.stdout.flush()
+	if batched or (nworkers and nworkers > 1):
+		freqs = np.arange(ilow-1, ihigh)
+		data_FX_f[freqs,:] = _fx_ssa_slices(data_FX[freqs,:], nw, p, svd_method, batched, nworkers)
 
-		tmp = data_FX[k-1,:].transpose()
-		
-		for j in range(10):
-			tmp_out = ssa(tmp,nw,p,0)[0]
-			tmp = tmp_out
-
-		data_FX_f[k-1,:] = tmp_out
-		i+=1
-
-	for k in range(nf/2+2, nf):
+	else:
+		print("		Loop through frequencies \n")
+		i=1
+		rend = len(range(ilow,ihigh+1))
+		for k in range(ilow,ihigh+1):
+			
+			prcnt = 100*i/rend
+			print("		%i %% done" % (prcnt), end="\r")
+			sys.stdout.flush()
+
+			data_FX_f[k-1,:] = _ssa_iterate(data_FX[k-1:k,:], nw, p, svd_method)[0]
+			i+=1
+
+	for k in range(nf//2+2, nf+1):
 		data_FX_f[k-1,:] = data_FX_f[nf-k+1,:].conj()
 		
-	data_f = np.fft.ifft(data_FX_f, axis=0)
+	data_f = ifft(data_FX_f, axis=0)
 	data_f = data_f[0:nt,:].real
 	
 	return data_f
 
+def _fx_ssa_slices(slices, nw, p, svd_method, batched, nworkers):
+	"""
+	SSA of the frequency slices (nfreq x ntraces) in blocks, optionally
+	on a thread pool.
+	"""
+	nfreq, ntraces = slices.shape
+	N = ntraces-nw+1
+
+	if batched and svd_method == 'full':
+		func = _ssa_iterate_batch
+		block = max(1, int(2**24 / (nw*N)))
+	else:
+		func = _ssa_iterate
+		block = nfreq
+	if nworkers and nworkers > 1:
+		block = min(block, max(1, -(-nfreq // (4*nworkers))))
+
+	blocks = [slice(i, min(i+block, nfreq)) for i in range(0, nfreq, block)]
+	out = np.empty(slices.shape, dtype='complex')
+
+	if not nworkers or nworkers <= 1:
+		for j, b in enumerate(blocks):
+			out[b] = func(slices[b], nw, p, svd_method)
+			print("		%i %% done" % (100*(j+1)/len(blocks)), end="\r")
+			sys.stdout.flush()
+		return out
+
+	from concurrent.futures import ThreadPoolExecutor
+
+	with _blas_threads(1):
+		with ThreadPoolExecutor(nworkers) as pool:
+			results = pool.map(lambda b: func(slices[b], nw, p, svd_method), blocks)
+			for j, (b, res) in enumerate(zip(blocks, results)):
+				out[b] = res
+				print("		%i %% done" % (100*(j+1)/len(blocks)), end="\r")
+				sys.stdout.flush()
+
+	return out
+
+def _ssa_iterate(slices, nw, p, svd_method):
+	"""
+	10 iterations of ssa on each row of slices.
+	"""
+	out = np.empty(slices.shape, dtype='complex')
+	for k in range(slices.shape[0]):
+		tmp = slices[k]
+		for j in range(10):
+			tmp = ssa(tmp,nw,p,0,svd_method)[0]
+		out[k] = tmp
+
+	return out
+
+def _ssa_iterate_batch(slices, nw, p, svd_method='full'):
+	"""
+	10 iterations of ssa on all rows of slices at once, with a stacked SVD of
+	the Hankel cube (nfreq x nw x N).
+	"""
+	ntraces = slices.shape[1]
+	N = ntraces-nw+1
+	idx = np.arange(nw)[:,np.newaxis] + np.arange(N)
+
+	tmp = slices
+	for j in range(10):
+		M = tmp[:,idx].astype('complex')
+		Up = np.linalg.svd(M, full_matrices=False)[0][:,:,:p]
+		B = np.matmul(Up.conj().transpose(0,2,1), M)
+		tmp = average_anti_diag_batch(np.matmul(Up, B))
+
+	return tmp
+
+@contextmanager
+def _blas_threads(limits):
+	"""
+	Limits the number of BLAS threads, if threadpoolctl is installed.
+	"""
+	try:
+		from threadpoolctl import threadpool_limits
+	except ImportError:
+		yield
+		return
+
+	with threadpool_limits(limits=limits, user_api='blas'):
+		yield
+
+def _average_anti_diag_lowrank(U, B, components=False):
+	"""
+	Anti-diagonal average of the matrix U B, computed from the factors
+	U (m x p) and B (p x n) by FFT convolution, without forming U B.
+	With components=True the averages of the single products U[:,k] B[k,:]
+	are returned as columns of an (m+n-1) x p array.
+	"""
+	m, n = U.shape[0], B.shape[1]
+	N = m+n-1
+	L = fft_length(N)
+
+	C = ifft(fft(U, L, axis=0) * fft(B.transpose(), L, axis=0), axis=0)[:N]
+	count = np.minimum(np.minimum(np.arange(1,N+1), np.arange(N,0,-1)), min(m,n))
+
+	if components:
+		return C / count[:,np.newaxis]
+
+	return C.sum(axis=1) / count
+
+def _hankel_operator(d, m):
+	"""
+	Hankel matrix M[i,k] = d[i+k] of shape (m, d.size-m+1) as LinearOperator.
+	Products with M and M^H are correlations with d, computed by FFT.
+	"""
+	nt = d.size
+	n = nt-m+1
+	L = fft_length(nt + max(m,n) - 1)
+	D = fft(d.astype('complex'), L)
+	Dc = fft(d.conj().astype('complex'), L)
+
+	def matmat(X):
+		X = np.asarray(X).reshape(n,-1)
+		return ifft(D[:,np.newaxis] * fft(X[::-1], L, axis=0), axis=0)[n-1:n-1+m]
+
+	def rmatmat(Y):
+		Y = np.asarray(Y).reshape(m,-1)
+		return ifft(Dc[:,np.newaxis] * fft(Y[::-1], L, axis=0), axis=0)[m-1:m-1+n]
+
+	return LinearOperator((m,n), matvec=lambda x: matmat(x).ravel(),
+						  rmatvec=lambda y: rmatmat(y).ravel(), matmat=matmat,
+						  rmatmat=rmatmat, dtype='complex')
+
+def _randomized_svd(M, p, oversample=10, niter=4):
+	"""
+	First p left singular vectors and singular values of the operator M by a
+	randomized range finder with niter power iterations (Halko et al., 2011).
+	"""
+	m, n = M.shape
+	k = min(p + oversample, m, n)
+	rng = np.random.RandomState(0)
+	Omega = rng.standard_normal((n,k)) + 1j*rng.standard_normal((n,k))
+
+	Q = np.linalg.qr(M.matmat(Omega))[0]
+	for i in range(niter):
+		Q = np.linalg.qr(M.rmatmat(Q))[0]
+		Q = np.linalg.qr(M.matmat(Q))[0]
+
+	B = M.rmatmat(Q).conj().transpose()
+	Ub,S,Vh = np.linalg.svd(B, full_matrices=False)
+
+	return dot(Q, Ub[:,:p]), S[:p]
+
+def fx_ssa_windowed(data,dt,p,flow,fhigh,nt_win=512,ntr_win=24,overlap=0.5,svd_method='full',batched=False,nworkers=None):
+	"""
+	FX_SSA in overlapping patches of the gather
+
+	[data_f] = fx_ssa_windowed(data,dt,p,flow,fhigh,nt_win,ntr_win);
+
+	The (time x trace) gather is tiled into patches of nt_win samples and
+	ntr_win traces, overlapping by the fraction overlap. Each patch is
+	filtered with fx_ssa and the patches are blended by tapered overlap-add,
+	normalized by the sum of the tapers. Within a patch, moveout is closer
+	to linear and the Hankel matrices are small.
+
+	IN   data:      data (traces are columns)
+	dt:     sampling interval
+	p:      number of singular values used to reconstuct each patch
+	flow:   min  freq. in the data in Hz
+	fhigh:  max  freq. in the data in Hz
+	nt_win: number of samples of a patch
+	ntr_win: number of traces of a patch, at least 4
+	overlap: overlap of neighbouring patches, 0 <= overlap < 1
+	svd_method, batched: see fx_ssa
+	nworkers: number of threads the patches are distributed to
+
+	OUT  data_f:  filtered data
+	"""
+	nt, ntraces = data.shape
+	nt_win = min(int(nt_win), nt)
+	ntr_win = min(int(ntr_win), ntraces)
+
+	if ntr_win < 4:
+		msg = 'Patches need at least 4 traces'
+		raise IOError(msg)
+	if not 0 <= overlap < 1:
+		msg = 'overlap has to be in [0, 1)'
+		raise IOError(msg)
+
+	tstarts = _patch_starts(nt, nt_win, overlap)
+	xstarts = _patch_starts(ntraces, ntr_win, overlap)
+	patches = [(t0, x0) for t0 in tstarts for x0 in xstarts]
+
+	# Tapers without zeros, the edges of the gather are covered by one patch
+	taper = np.outer(np.hanning(nt_win+2)[1:-1], np.hanning(ntr_win+2)[1:-1])
+
+	def process(patch):
+		t0, x0 = patch
+		return fx_ssa(data[t0:t0+nt_win, x0:x0+ntr_win], dt, p, flow, fhigh,
+					  svd_method, batched)
+
+	data_f = np.zeros((nt, ntraces))
+	weight = np.zeros((nt, ntraces))
+
+	if not nworkers or nworkers <= 1:
+		results = map(process, patches)
+		for (t0, x0), res in zip(patches, results):
+			data_f[t0:t0+nt_win, x0:x0+ntr_win] += taper * res
+			weight[t0:t0+nt_win, x0:x0+ntr_win] += taper
+
+	else:
+		from concurrent.futures import ThreadPoolExecutor
+
+		with _blas_threads(1):
+			with ThreadPoolExecutor(nworkers) as pool:
+				results = pool.map(process, patches)
+				for (t0, x0), res in zip(patches, results):
+					data_f[t0:t0+nt_win, x0:x0+ntr_win] += taper * res
+					weight[t0:t0+nt_win, x0:x0+ntr_win] += taper
+
+	return data_f / weight
+
+def _patch_starts(n, nwin, overlap):
+	"""
+	First indices of the patches of length nwin along an axis of length n,
+	the last patch ends at n.
+	"""
+	step = max(1, int(round(nwin * (1. - overlap))))
+	starts = list(range(0, n-nwin+1, step))
+	if starts[-1] + nwin < n:
+		starts.append(n-nwin)
+
+	return starts
+
 def average_anti_diag(A):
 	"""
 	Given a Hankel matrix A,  this program retrieves
@@ -269,43 +520,62 @@ def average_anti_diag(A):
 	[m,n] = size(A);
 	N = m+n-1;
 
-	 s = zeros(N,1);
+	s = zeros(N,1);
 
-	 for i = 1 : N
+	for i = 1 : N
 
-	  a = max(1,i-m+1);
-	  b = min(n,i);
+	a = max(1,i-m+1);
+	b = min(n,i);
 
-	   for k = a : b
-	    s(i,1) = s(i,1) + A(i-k+1,k);
-	   end
+	for k = a : b
+	s(i,1) = s(i,1) + A(i-k+1,k);
+	end
 
-	 s(i,1) = s(i,1)/(b-a+1);
+	s(i,1) = s(i,1)/(b-a+1);
 
-	 end;
- 	"""
+	end;
+	"""
 
- 	m,n = A.shape
+	m,n = A.shape
 
- 	N = m+n-1
+	N = m+n-1
 
- 	s = np.zeros(N).astype('complex')
+	# Flat index of the anti-diagonal of each element, A[i,k] -> i+k
+	idx = (np.arange(m)[:,np.newaxis] + np.arange(n)).ravel()
+	A = np.asarray(A)
 
- 	for i in range(N):
-		a = max(1,(i+1)-m+1)
-		b = min(n,(i+1))
-		
-		if a == b:
-			k = a
-			s[i] = s[i] + A[i-k+1,k-1]
-		else:
-	 		for k in range(a,b+1):
-	 			s[i] = s[i] + A[i-k+1,k-1]
+	s = np.bincount(idx, A.real.ravel(), N) + 1j*np.bincount(idx, A.imag.ravel(), N)
+	s /= np.bincount(idx, minlength=N)
 
-		s[i]= s[i]/(b-a+1)
- 		
 	return(s)
 
+def average_anti_diag_batch(A):
+	"""
+	Batched average_anti_diag, retrieves the signals of a stack of Hankel
+	matrices, e.g. of all frequencies, at once.
+
+	In    A: Hankel matrices, shape (..., m, n)
+
+	Out   s: signals, shape (..., m+n-1)
+	"""
+	A = np.asarray(A)
+	m,n = A.shape[-2:]
+	batch = A.shape[:-2]
+	nb = int(np.prod(batch))
+
+	N = m+n-1
+
+	# Flat index of the anti-diagonal of each element, offset per matrix
+	idx = (np.arange(m)[:,np.newaxis] + np.arange(n)).ravel()
+	count = np.bincount(idx, minlength=N)
+	idx = (np.arange(nb)[:,np.newaxis]*N + idx).ravel()
+
+	s = np.bincount(idx, A.real.ravel(), nb*N) + 1j*np.bincount(idx, A.imag.ravel(), nb*N)
+	s = s.reshape(batch + (N,)) / count
+
+	return(s)
+
+
 
 
 
@@ -22,11 +22,16 @@ import math
 import warnings
 from scipy.integrate import cumtrapz
 from obspy.core import Stream
-from obspy.signal.headers import clibsignal
 from obspy.signal.invsim import cosTaper
 #from obspy.clients.fdsn import Client
 from obspy.fdsn.client import Client
 
+from bowpy.util.beamformer import capon_inverse, cross_spectral_matrix, \
+    generalized_beamformer, slowness_whitened_power, steering_vectors
+from bowpy.util.scheduler import map_windows
+from bowpy.util.stacking import nthroot_stack, phase_weighted_stack
+from bowpy.util.timeshift import fractional_shift
+
 
 
 KM_PER_DEG = 111.1949
@@ -600,7 +605,8 @@ def beamforming(stream, sll_x, slm_x, sll_y, slm_y, sl_s, frqlow, frqhigh,
                 stime, etime,   win_len=-1, win_frac=0.5,
                 verbose=False, coordsys='lonlat', timestamp='mlabday',
                 method="DLS", nthroot=1, store=None, correct_3dplane=False,
-                static_3D=False, vel_cor=4.):
+                static_3D=False, vel_cor=4., gridblock=None, nworkers=None,
+                batchsize=None):
     """
     Method for Delay and Sum/Phase Weighted Stack/Whitened Slowness Power
 
@@ -660,11 +666,22 @@ def beamforming(stream, sll_x, slm_x, sll_y, slm_y, sl_s, frqlow, frqhigh,
             inc = asin(v_cor*slow)
     :type vel_cor: Float
     :param vel_cor: Velocity for the upper layer (static correction) in km/s
+    :type gridblock: int
+    :param gridblock: "DLS" and "PWS" only, number of slowness grid points
+        that are beamformed at once. The delayed windows of a block are held
+        in an array of size nstat x gridblock x nsamp, default is a block of
+        about 2**24 samples.
+    :type nworkers: int
+    :param nworkers: Number of processes the sliding windows are distributed
+        to, default None processes all windows in this process. The results
+        are passed to store in time order.
+    :type batchsize: int
+    :param batchsize: Number of windows per batch of the scheduler, see
+        bowpy.util.scheduler.map_windows
     :return: numpy.ndarray of timestamp, relative relpow, absolute relpow,
         backazimut, slowness, maximum beam (for DLS)
     """
     res = []
-    eotr = True
 
     # check that sampling rates do not vary
     fs = stream[0].stats.sampling_rate
@@ -718,114 +735,50 @@ def beamforming(stream, sll_x, slm_x, sll_y, slm_y, sl_s, frqlow, frqhigh,
     stream.detrend()
     newstart = stime
     slow = 0.
-    offset = 0
-    count = 0
-    while eotr:
-        max_beam = 0.
-        if method == 'DLS':
-            for x in xrange(grdpts_x):
-                for y in xrange(grdpts_y):
-                    singlet = 0.
-                    beam = np.zeros(nsamp, dtype='f8')
-                    shifted = np.zeros(nsamp, dtype='f8')
-                    for i in xrange(nstat):
-                        s = spoint[i]+int(time_shift_table[i, x, y] * fs + 0.5)
-                        try:
-                            shifted = stream[i].data[s + offset:s + nsamp + offset]
-                            if len(shifted) < nsamp:
-                                shifted = np.pad(shifted,(0,nsamp-len(shifted)),'constant',constant_values=(0,1))
-                            singlet += 1./nstat*np.sum(shifted*shifted)
-                            beam += 1. / nstat * np.power(np.abs(shifted), 1. / nthroot) * shifted/np.abs(shifted)
-                        except IndexError:
-                            break
-                    beam = np.power(np.abs(beam), nthroot) * beam / np.abs(beam)
-                    bs = np.sum(beam*beam)
-                    abspow_map[x, y] = bs / singlet
-                    if abspow_map[x, y] > max_beam:
-                        max_beam = abspow_map[x, y]
-                        beam_max = beam
-        if method == 'PWS':
-            for x in xrange(grdpts_x):
-                for y in xrange(grdpts_y):
-                    singlet = 0.
-                    beam = np.zeros(nsamp, dtype='f8')
-                    stack = np.zeros(nsamp, dtype='c8')
-                    phase = np.zeros(nsamp, dtype='f8')
-                    shifted = np.zeros(nsamp, dtype='f8')
-                    coh = np.zeros(nsamp, dtype='f8')
-                    for i in xrange(nstat):
-                        s = spoint[i] + int(time_shift_table[i, x, y] * fs +
-                                            0.5)
-                        try:
-                            shifted = sp.signal.hilbert(stream[i].data[
-                                s + offset: s + nsamp + offset])
-                            if len(shifted) < nsamp:
-                                shifted = np.pad(shifted,(0,nsamp-len(shifted)),'constant',constant_values=(0,1))
-                        except IndexError:
-                            break
-                        phase = np.arctan2(shifted.imag, shifted.real)
-                        stack.real += np.cos(phase)
-                        stack.imag += np.sin(phase)
-                    coh = 1. / nstat * np.abs(stack)
-                    for i in xrange(nstat):
-                        s = spoint[i]+int(time_shift_table[i, x, y] * fs + 0.5)
-                        shifted = stream[i].data[s+offset: s + nsamp + offset]
-                        singlet += 1. / nstat * np.sum(shifted * shifted)
-                        beam += 1. / nstat * shifted * np.power(coh, nthroot)
-                    bs = np.sum(beam*beam)
-                    abspow_map[x, y] = bs / singlet
-                    if abspow_map[x, y] > max_beam:
-                        max_beam = abspow_map[x, y]
-                        beam_max = beam
-        if method == 'SWP':
-            # generate plan for rfftr
-            nfft = nextpow2(nsamp)
-            deltaf = fs / float(nfft)
-            nlow = int(frqlow / float(deltaf) + 0.5)
-            nhigh = int(frqhigh / float(deltaf) + 0.5)
-            nlow = max(1, nlow)  # avoid using the offset
-            nhigh = min(nfft / 2 - 1, nhigh)  # avoid using nyquist
-            nf = nhigh - nlow + 1  # include upper and lower frequency
-
-            beam = np.zeros((grdpts_x, grdpts_y, nf), dtype='f16')
-            steer = np.empty((nf, grdpts_x, grdpts_y, nstat), dtype='c16')
-            spec = np.zeros((nstat, nf), dtype='c16')
-            time_shift_table *= -1.
-            clibsignal.calcSteer(nstat, grdpts_x, grdpts_y, nf, nlow,
-                                 deltaf, time_shift_table, steer)
-            try:
-                for i in xrange(nstat):
-                    dat = stream[i].data[spoint[i] + offset:
-                                         spoint[i] + offset + nsamp]
-                    dat = (dat - dat.mean()) * tap
-                    spec[i, :] = np.fft.rfft(dat, nfft)[nlow: nlow + nf]
-            except IndexError:
-                break
-
-            for i in xrange(grdpts_x):
-                for j in xrange(grdpts_y):
-                    for k in xrange(nf):
-                        for l in xrange(nstat):
-                            steer[k, i, j, l] *= spec[l, k]
-
-            beam = np.absolute(np.sum(steer, axis=3))
-            less = np.max(beam, axis=1)
-            max_buffer = np.max(less, axis=1)
-
-            for i in xrange(grdpts_x):
-                for j in xrange(grdpts_y):
-                    abspow_map[i, j] = np.sum(beam[:, i, j] / max_buffer[:],
-                                              axis=0) / float(nf)
-
-            beam_max = stream[0].data[spoint[0] + offset:
-                                      spoint[0] + nsamp + offset]
 
+    # Contiguous station x time matrix, the last column stays zero and
+    # is read for all samples outside of a trace.
+    npts = np.array([tr.stats.npts for tr in stream])
+    stmatrix = np.zeros((nstat, npts.max() + 1), dtype='f8')
+    for i, tr in enumerate(stream):
+        stmatrix[i, :tr.stats.npts] = tr.data
+
+    params = dict(method=method, nsamp=nsamp, spoint=spoint)
+    if method in ('DLS', 'PWS'):
+        ngrid = grdpts_x * grdpts_y
+        tsamp = (time_shift_table.reshape(nstat, ngrid) * fs + 0.5).astype('int')
+        tsamp += spoint[:, np.newaxis]
+
+        if not gridblock:
+            gridblock = max(1, int(2**24 / (nstat * nsamp)))
+        params.update(tsamp=tsamp, gridblock=gridblock, nthroot=nthroot,
+                      shape=(grdpts_x, grdpts_y))
+
+    if method == 'SWP':
+        # generate plan for rfftr
+        nfft = nextpow2(nsamp)
+        deltaf = fs / float(nfft)
+        nlow = int(frqlow / float(deltaf) + 0.5)
+        nhigh = int(frqhigh / float(deltaf) + 0.5)
+        nlow = max(1, nlow)  # avoid using the offset
+        nhigh = min(nfft // 2 - 1, nhigh)  # avoid using nyquist
+        nf = nhigh - nlow + 1  # include upper and lower frequency
+
+        params.update(nfft=nfft, nlow=nlow, nf=nf, deltaf=deltaf,
+                      time_shift_table=time_shift_table,
+                      tap=cosTaper(nsamp, p=0.22))
+
+    offsets = _window_offsets(stime, etime, fs, nsamp, nstep, spoint, npts,
+                              complete=(method == 'SWP'))
+    windows = map_windows(_beamforming_windows, stmatrix, offsets, params,
+                          nworkers=nworkers, batchsize=batchsize)
+
+    for count, (abspow_map, beam_max) in enumerate(windows):
         ix, iy = np.unravel_index(abspow_map.argmax(), abspow_map.shape)
         abspow = abspow_map[ix, iy]
         if store is not None:
             store(abspow_map, beam_max, count)
-        count += 1
-        print(count)
+        print(count + 1)
         # here we compute baz, slow
         slow_x = sll_x + ix * sl_s
         slow_y = sll_y + iy * sl_s
@@ -839,9 +792,6 @@ def beamforming(stream, sll_x, slm_x, sll_y, slm_y, sl_s, frqlow, frqhigh,
                              slow]))
         if verbose:
             print(newstart, (newstart + (nsamp / fs)), res[-1][1:])
-        if (newstart + (nsamp + nstep)/fs ) > etime:
-            eotr = False
-        offset += nstep
 
         newstart += nstep / fs
     res = np.array(res)
@@ -856,6 +806,130 @@ def beamforming(stream, sll_x, slm_x, sll_y, slm_y, sl_s, frqlow, frqhigh,
     return np.array(res)
 
 
+def _gather_windows(stmatrix, starts, nsamp):
+    """
+    Returns the windows stmatrix[i, starts[i, j]:starts[i, j] + nsamp] of all
+    stations i and grid points j as an array (nstat, nblock, nsamp). Samples
+    outside of the traces are read from the zero last column of stmatrix.
+    """
+    nstat, ncol = stmatrix.shape
+    index = starts[:, :, np.newaxis] + np.arange(nsamp)
+    index[(index < 0) | (index >= ncol - 1)] = ncol - 1
+    index += (np.arange(nstat) * ncol)[:, np.newaxis, np.newaxis]
+
+    return stmatrix.take(index)
+
+
+def _array_processing_windows(stmatrix, offsets, params):
+    """
+    Window function of array_processing, returns the relative and absolute
+    power map of each window at the sample offsets.
+    """
+    CAPON = 1
+    method, nsamp, spoint = params['method'], params['nsamp'], params['spoint']
+    nlow, nf, winblock = params['nlow'], params['nf'], params['winblock']
+    steer = steering_vectors(params['time_shift_table'], nlow, nf,
+                             params['deltaf'])
+    index = spoint[:, np.newaxis, np.newaxis] + np.arange(nsamp)
+    results = []
+
+    for k0 in range(0, len(offsets), winblock):
+        # spectra of a block of windows
+        block = np.asarray(offsets[k0:k0 + winblock])
+        dat = stmatrix[np.arange(len(spoint))[:, np.newaxis, np.newaxis],
+                       index + block[:, np.newaxis]]
+        dat = (dat - dat.mean(axis=-1)[:, :, np.newaxis]) * params['tap']
+        ft = np.fft.rfft(dat, params['nfft'], axis=-1)[:, :, nlow:nlow + nf]
+
+        # computing the covariances of the signal at different receivers
+        R, dpow = cross_spectral_matrix(np.swapaxes(ft, 0, 1),
+                                        normalize=(method == CAPON),
+                                        diag_load=params['diag_load'])
+        if method == CAPON:
+            # P(f) = 1/(e.H R(f)^-1 e)
+            R = capon_inverse(R, rcond=1e-6, loaded=bool(params['diag_load']))
+
+        for k in range(len(block)):
+            results.append(generalized_beamformer(
+                steer, R[k], method=method, prewhiten=params['prewhiten'],
+                dpow=dpow[k]))
+
+    return results
+
+
+def _beamforming_windows(stmatrix, offsets, params):
+    """
+    Window function of beamforming, returns the power map and the beam of
+    maximum power of each window at the sample offsets.
+    """
+    method, nsamp, spoint = params['method'], params['nsamp'], params['spoint']
+    nstat = len(spoint)
+    results = []
+
+    if method == 'SWP':
+        nlow, nf = params['nlow'], params['nf']
+        steer = steering_vectors(params['time_shift_table'], nlow, nf,
+                                 params['deltaf'], sign=1)
+        index = spoint[:, np.newaxis] + np.arange(nsamp)
+        for offset in offsets:
+            dat = stmatrix[np.arange(nstat)[:, np.newaxis], index + offset]
+            dat = (dat - dat.mean(axis=1)[:, np.newaxis]) * params['tap']
+            spec = np.fft.rfft(dat, params['nfft'], axis=1)[:, nlow: nlow + nf]
+
+            abspow_map = slowness_whitened_power(steer, spec)
+            beam_max = stmatrix[0, spoint[0] + offset:
+                                spoint[0] + offset + nsamp].copy()
+            results.append((abspow_map, beam_max))
+        return results
+
+    tsamp, gridblock = params['tsamp'], params['gridblock']
+    ngrid = tsamp.shape[1]
+    for offset in offsets:
+        abspow_flat = np.empty(ngrid)
+        best_power = -np.inf
+        best_beam = None
+        for g0 in range(0, ngrid, gridblock):
+            g1 = min(g0 + gridblock, ngrid)
+            shifted = _gather_windows(stmatrix, tsamp[:, g0:g1] + offset, nsamp)
+            singlet = np.sum(shifted * shifted, axis=(0, 2)) / nstat
+            if method == 'DLS':
+                beam = nthroot_stack(shifted, params['nthroot'], axis=0)
+            else:
+                beam = phase_weighted_stack(shifted, params['nthroot'], axis=0,
+                                            time_axis=-1)
+            abspow_flat[g0:g1] = np.sum(beam * beam, axis=1) / singlet
+
+            imax = abspow_flat[g0:g1].argmax()
+            if abspow_flat[g0 + imax] > best_power:
+                best_power = abspow_flat[g0 + imax]
+                best_beam = beam[imax].copy()
+        results.append((abspow_flat.reshape(params['shape']), best_beam))
+
+    return results
+
+
+def _window_offsets(stime, etime, fs, nsamp, nstep, spoint, npts,
+                    complete=True):
+    """
+    Sample offsets of the sliding windows between stime and etime. With
+    complete, the windows end before the first window that reaches past
+    the end of a trace.
+    """
+    offsets = []
+    newstart = stime
+    offset = 0
+    while True:
+        if complete and np.any(spoint + offset + nsamp > npts):
+            break
+        offsets.append(offset)
+        if (newstart + (nsamp + nstep) / fs) > etime:
+            break
+        offset += nstep
+        newstart += nstep / fs
+
+    return np.array(offsets, dtype='int')
+
+
 #    return(baz,slow,slow_x,slow_y,abspow_map,beam_max)
 
 def get_timeshift_baz(geometry, sll, slm, sls, baze, vel_cor=4.,
@@ -1023,7 +1097,9 @@ def array_processing(stream, win_len, win_frac, sll_x, slm_x, sll_y, slm_y,
                      sl_s, semb_thres, vel_thres, frqlow, frqhigh, stime,
                      etime, prewhiten, verbose=False, coordsys='lonlat',
                      timestamp='mlabday', method=0, correct_3dplane=False,
-                     vel_cor=4., static_3D=False, store=None):
+                     vel_cor=4., static_3D=False, store=None,
+                     diag_load=0., winblock=None, nworkers=None,
+                     batchsize=None):
     """
     Method for FK-Analysis/Capon
 
@@ -1080,12 +1156,25 @@ def array_processing(stream, win_len, win_frac, sll_x, slm_x, sll_y, slm_y,
         second arguments and the iteration number as third argument. Useful for
         storing or plotting the map for each iteration. For this purpose the
         dump function of this module can be used.
+    :type diag_load: Float
+    :param diag_load: Diagonal loading of the cross-spectral density matrix,
+        R(f) + diag_load * mean(diag(R(f))) * I. With diag_load > 0 the Capon
+        inverse is computed directly instead of the pseudo-inverse.
+    :type winblock: int
+    :param winblock: Number of sliding windows of which spectra and
+        cross-spectral density matrices are computed at once, default is a
+        block of about 2**22 matrix elements.
+    :type nworkers: int
+    :param nworkers: Number of processes the sliding windows are distributed
+        to, default None processes all windows in this process. The results
+        are passed to store in time order.
+    :type batchsize: int
+    :param batchsize: Number of windows per batch of the scheduler, see
+        bowpy.util.scheduler.map_windows
     :return: numpy.ndarray of timestamp, relative relpow, absolute relpow,
         backazimut, slowness
     """
-    BF, CAPON = 0, 1
     res = []
-    eotr = True
 
     # check that sampling rates do not vary
     fs = stream[0].stats.sampling_rate
@@ -1135,65 +1224,35 @@ def array_processing(stream, win_len, win_frac, sll_x, slm_x, sll_y, slm_y,
     nlow = int(frqlow / float(deltaf) + 0.5)
     nhigh = int(frqhigh / float(deltaf) + 0.5)
     nlow = max(1, nlow)  # avoid using the offset
-    nhigh = min(nfft / 2 - 1, nhigh)  # avoid using nyquist
+    nhigh = min(nfft // 2 - 1, nhigh)  # avoid using nyquist
     nf = nhigh - nlow + 1  # include upper and lower frequency
 
-    # to spead up the routine a bit we estimate all steering vectors in advance
-    steer = np.empty((nf, grdpts_x, grdpts_y, nstat), dtype='c16')
-    clibsignal.calcSteer(nstat, grdpts_x, grdpts_y, nf, nlow,
-                         deltaf, time_shift_table, steer)
-    R = np.empty((nf, nstat, nstat), dtype='c16')
-    ft = np.empty((nstat, nf), dtype='c16')
     newstart = stime
     tap = cosTaper(nsamp, p=0.22)  # 0.22 matches 0.2 of historical C bbfk.c
-    offset = 0
-    count = 0
-    relpow_map = np.empty((grdpts_x, grdpts_y), dtype='f8')
-    abspow_map = np.empty((grdpts_x, grdpts_y), dtype='f8')
-    while eotr:
-        try:
-            for i, tr in enumerate(stream):
-                dat = tr.data[spoint[i] + offset:
-                              spoint[i] + offset + nsamp]
-                dat = (dat - dat.mean()) * tap
-                ft[i, :] = np.fft.rfft(dat, nfft)[nlow:nlow + nf]
-        except IndexError:
-            break
-        ft = np.require(ft, 'c16', ['C_CONTIGUOUS'])
-        relpow_map.fill(0.)
-        abspow_map.fill(0.)
-        # computing the covariances of the signal at different receivers
-        dpow = 0.
-        for i in xrange(nstat):
-            for j in xrange(i, nstat):
-                R[:, i, j] = ft[i, :] * ft[j, :].conj()
-                if method == CAPON:
-                    R[:, i, j] /= np.abs(R[:, i, j].sum())
-                if i != j:
-                    R[:, j, i] = R[:, i, j].conjugate()
-                else:
-                    dpow += np.abs(R[:, i, j].sum())
-        dpow *= nstat
-        if method == CAPON:
-            # P(f) = 1/(e.H R(f)^-1 e)
-            for n in xrange(nf):
-                R[n, :, :] = np.linalg.pinv(R[n, :, :], rcond=1e-6)
 
-        # errcode = clibsignal.generalizedBeamformer(relpow_map,abspow_map,steer,R,
-        #                                            nsamp,nstat,prewhiten,grdpts_x,
-        #                                            grdpts_y,nfft,nf,dpow,method)
+    if not winblock:
+        winblock = max(1, int(2**22 / (nf * nstat * nstat)))
+
+    npts = np.array([tr.stats.npts for tr in stream])
+    stmatrix = np.zeros((nstat, npts.max()), dtype='f8')
+    for i, tr in enumerate(stream):
+        stmatrix[i, :tr.stats.npts] = tr.data
+
+    params = dict(method=method, prewhiten=prewhiten, diag_load=diag_load,
+                  winblock=winblock, nsamp=nsamp, spoint=spoint, tap=tap,
+                  nfft=nfft, nlow=nlow, nf=nf, deltaf=deltaf,
+                  time_shift_table=time_shift_table)
 
-        errcode = clibsignal.generalizedBeamformer(relpow_map,abspow_map,steer,R,nstat,prewhiten,
-                                                   grdpts_x,grdpts_y,nf,dpow,method)
+    # windows reaching past the end of a trace are dropped
+    offsets = _window_offsets(stime, etime, fs, nsamp, nstep, spoint, npts)
+    windows = map_windows(_array_processing_windows, stmatrix, offsets,
+                          params, nworkers=nworkers, batchsize=batchsize)
 
-        if errcode != 0:
-            msg = 'generalizedBeamforming exited with error %d'
-            raise Exception(msg % errcode)
+    for count, (relpow_map, abspow_map) in enumerate(windows):
         ix, iy = np.unravel_index(relpow_map.argmax(), relpow_map.shape)
         relpow, abspow = relpow_map[ix, iy], abspow_map[ix, iy]
         if store is not None:
             store(relpow_map, abspow_map, count)
-        count += 1
 
         # here we compute baz, slow
         slow_x = sll_x + ix * sl_s
@@ -1209,9 +1268,6 @@ def array_processing(stream, win_len, win_frac, sll_x, slm_x, sll_y, slm_y,
                                  slow]))
             if verbose:
                 print(newstart, (newstart + (nsamp / fs)), res[-1][1:])
-        if (newstart + (nsamp + nstep) / fs) > etime:
-            eotr = False
-        offset += nstep
 
         newstart += nstep / fs
     res = np.array(res)
@@ -1671,21 +1727,19 @@ def get_timeshift(geometry, sll_x, sll_y, sl_s, grdpts_x,
 
 def shifttrace_freq(stream, t_shift):
     if isinstance(stream, Stream):
+        # Traces of equal length and sampling rate are shifted in one call.
+        groups = defaultdict(list)
         for i, tr in enumerate(stream):
-            ndat = tr.stats.npts
-            samp = tr.stats.sampling_rate
+            groups[(tr.stats.npts, tr.stats.sampling_rate)].append(i)
+
+        for (ndat, samp), index in groups.items():
             nfft = nextpow2(ndat)
             nfft *= 2
-            tr1 = np.fft.rfft(tr.data, nfft)
-            for k in xrange(0, nfft / 2):
-                tr1[k] *= np.complex(
-                    np.cos((t_shift[i] * samp) * (k / float(nfft))
-                           * 2. * np.pi),
-                    -np.sin((t_shift[i] * samp) *
-                            (k / float(nfft)) * 2. * np.pi))
-
-            tr1 = np.fft.irfft(tr1, nfft)
-            tr.data = tr1[0:ndat]
+            data = np.array([stream[i].data for i in index])
+            delay = np.array([t_shift[i] for i in index]) * samp
+            data = fractional_shift(data, delay, nfft=nfft)
+            for i, tr_data in zip(index, data):
+                stream[i].data = tr_data
 
 
 """
@@ -24,13 +24,14 @@ from scipy.integrate import cumtrapz
 from obspy.core import Stream
 from obspy.signal.headers import clibsignal
 from obspy.signal.invsim import cosTaper
-from obspy.taup import TauPyModel
+from bowpy.util.traveltimes import get_model
+from bowpy.util.timeshift import fractional_shift
 from obspy.taup import getTravelTimes
 #from mpl_toolkits.basemap import Basemap
 
 KM_PER_DEG = 111.1949
 os.system('clear')  # clear screen
-model =  TauPyModel(model="ak135")
+model =  get_model("ak135")
 
 def vespagram(stream, ev, inv, method, scale, nthroot=4,
               static3D=False, vel_corr=4.8, sl=(0.0, 10.0, 0.1),
@@ -669,7 +670,7 @@ def get_taupy_points(center_lat,center_lon,ev_lat,ev_lon,ev_depth,
   distance = locations2degrees(center_lat,center_lon,ev_lat,ev_lon)
   #print(distance)
 
-  model =  TauPyModel(model="ak135")
+  model =  get_model("ak135")
   arrivals = model.get_pierce_points(ev_depth,distance)
   #arrivals = earthmodel.get_pierce_points(ev_depth,distance,phase_list=('PP','P^410P'))  
 
@@ -886,21 +887,19 @@ def align_phases(stream, event, inventory, phase_name, method="simple"):
 
 def shifttrace_freq(stream, t_shift):
     if isinstance(stream, Stream):
+        # Traces of equal length and sampling rate are shifted in one call.
+        groups = defaultdict(list)
         for i, tr in enumerate(stream):
-            ndat = tr.stats.npts
-            samp = tr.stats.sampling_rate
+            groups[(tr.stats.npts, tr.stats.sampling_rate)].append(i)
+
+        for (ndat, samp), index in groups.items():
             nfft = nextpow2(ndat)
             nfft *= 2
-            tr1 = np.fft.rfft(tr.data, nfft)
-            for k in xrange(0, nfft / 2):
-                tr1[k] *= np.complex(
-                    np.cos((t_shift[i] * samp) * (k / float(nfft))
-                           * 2. * np.pi),
-                    -np.sin((t_shift[i] * samp) *
-                            (k / float(nfft)) * 2. * np.pi))
-
-            tr1 = np.fft.irfft(tr1, nfft)
-            tr.data = tr1[0:ndat]
+            data = np.array([stream[i].data for i in index])
+            delay = np.array([t_shift[i] for i in index]) * samp
+            data = fractional_shift(data, delay, nfft=nfft)
+            for i, tr_data in zip(index, data):
+                stream[i].data = tr_data
 
 def attach_coordinates_to_traces(stream, inventory, event=None):
     """
@@ -3,7 +3,6 @@ from __future__ import absolute_import
 import numpy as np
 import math
 import fractions
-from scipy.signal import correlate
 import obspy
 
 import matplotlib.pyplot as plt
@@ -16,10 +15,13 @@ from obspy.core.inventory.network import Network
 from obspy.core import AttribDict
 from obspy.geodetics.base import locations2degrees, gps2dist_azimuth, \
     kilometer2degrees
-from obspy.taup import TauPyModel
 from obspy.taup.taup_geo import add_geo_to_arrivals
 
 from bowpy.util.base import nextpow2, stream2array, array2stream, array2trace
+from bowpy.util.fft_backend import rfft, irfft, fft_length
+from bowpy.util.stacking import linear_stack, nthroot_stack, segment_stack
+from bowpy.util.timeshift import fractional_shift, phase_ramp
+from bowpy.util.traveltimes import get_model, travel_times
 
 """
 Collection of useful functions for processing seismological array data
@@ -76,7 +78,6 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
     # Prepare Array of data.
     st_tmp = st.copy()
     data = stream2array(st_tmp)
-    shifttimes = np.zeros(data.shape[0])
 
     # Calculate depth and distance of receiver and event.
     # Set some variables.
@@ -92,9 +93,6 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
             print('No distance information found, add Inventory')
             return
 
-    tmin = 0
-    tmax = 0
-
     if not isinstance(event, Event) and isinstance(phase[0], int) and isinstance(phase[1], int):
         timewindow = True
 
@@ -117,11 +115,8 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
         except:
             isevent = False
 
-    m = TauPyModel(taup_model)
-
     if isevent:
         if isinstance(ref, int):
-            ref_dist = st_tmp[ref].stats.distance
             ref_start = st_tmp[ref].stats.starttime
             delta = st_tmp[ref].stats.delta
             iref = ref
@@ -130,7 +125,6 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
             for i, trace in enumerate(st_tmp):
                 if trace.stats['station'] != ref:
                     continue
-                ref_dist = trace.stats.distance
                 iref = i
                 ref_start = trace.stats.starttime
                 delta = float(trace.stats.delta)
@@ -140,66 +134,25 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
         elif isinstance(maxtimewindow, int):
             maxtimewindow = float(maxtimewindow)
 
+        # Travel times of all traces from one table lookup.
+        epidist = np.array([trace.stats.distance for trace in st_tmp])
+        ttimes = travel_times(depth, epidist, phase, taup_model)[0]
+        if np.isnan(ttimes).any():
+            msg = 'No arrival of %s at all distances' % str(phase)
+            raise IOError(msg)
+
         # Calculating reference arriving time/index of phase.
-        ref_t = origin + m.get_travel_times(depth, ref_dist, phase_list=phase)[0].time - ref_start
+        ref_t = origin + ttimes[iref] - ref_start
         ref_n = int(ref_t / delta)
 
-        if xcorr:
-            if isinstance(maxtimewindow, np.ndarray):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - abs(maxtimewindow[0]), ref_t + maxtimewindow[1])
-                reftrace = reftrace_tmp.data
-
-            elif isinstance(maxtimewindow, float):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - maxtimewindow, ref_t + maxtimewindow)
-                reftrace = reftrace_tmp.data
-
-            datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, ref_array=reftrace,
-                                                    mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
-
-
-        # First work on reference Trace:
-        else:
-            if isinstance(maxtimewindow, float) or isinstance(maxtimewindow, int) or isinstance(maxtimewindow,
-                                                                                                np.ndarray):
-                datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, mtw=maxtimewindow / delta,
-                                                        method=shiftmethod)
-
-        ref_n = ref_n - shift_index
-
-        data_tmp = data.copy()
-        for no_x, data_x in enumerate(data):
-            if no_x == iref:
-                continue
-
-            dist = st_tmp[no_x].stats.distance
-            t = m.get_travel_times(depth, dist, phase_list=phase)[0].time
-
-            # Calculate arrivals, and shift times/indicies.
-            phase_time = origin + t - st_tmp[no_x].stats.starttime
-            phase_n = int(phase_time / delta)
-            if not xcorr:
-                if isinstance(maxtimewindow, float) or isinstance(maxtimewindow, int) or isinstance(maxtimewindow,
-                                                                                                    np.ndarray):
-                    datashift, shift_index = shift2ref(data_x, ref_n, phase_n, mtw=maxtimewindow / delta,
-                                                       method=shiftmethod)
-
-            if xcorr:
-                datashift, shift_index = shift2ref(data_x, ref_n, phase_n, ref_array=reftrace,
-                                                   mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
-
-            shifttimes[no_x] = delta * shift_index
-            data_tmp[no_x, :] = datashift
-            if verbose:
-                print('Trace no %i was shifted by %f seconds' % (no_x, delta * shift_index))
-            # Positive shift_index indicates positive shift in time and vice versa.
-            if shift_index > 0 and shift_index > tmin: tmin = shift_index
-            if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
+        # Calculate arrivals indicies of all traces.
+        phase_time = np.array([origin - trace.stats.starttime for trace in st_tmp]) + ttimes
+        phase_n = (phase_time / delta).astype('int')
 
     # Alignment of timewindow around
     elif timewindow:
 
         if isinstance(ref, int):
-            ref_dist = st_tmp[ref].stats.distance
             ref_start = st_tmp[ref].stats.starttime
             delta = st_tmp[ref].stats.delta
             iref = ref
@@ -211,56 +164,46 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
                 iref = i
                 delta = float(trace.stats.delta)
 
+        ref_t = phase[0]
         ref_n = int(phase[0] / delta)
         maxtimewindow = np.array([0, phase[1] - phase[0]])
+        phase_n = np.zeros(data.shape[0], dtype='int') + int(phase[0] / delta)
 
-        if xcorr:
-            if isinstance(maxtimewindow, np.ndarray):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - abs(maxtimewindow[0]), ref_t + maxtimewindow[1])
-                reftrace = reftrace_tmp.data
+    else:
+        print('No valid input defined, please use event-file or time-window defined in phases')
+        return
 
-            elif isinstance(maxtimewindow, float):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - maxtimewindow, ref_t + maxtimewindow)
-                reftrace = reftrace_tmp.data
+    reftrace = None
+    if xcorr:
+        if isinstance(maxtimewindow, np.ndarray):
+            reftrace_tmp = cut(st_tmp[iref], ref_t - abs(maxtimewindow[0]), ref_t + maxtimewindow[1])
+            reftrace = reftrace_tmp.data
 
-            datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, ref_array=reftrace,
-                                                    mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
+        elif isinstance(maxtimewindow, float):
+            reftrace_tmp = cut(st_tmp[iref], ref_t - maxtimewindow, ref_t + maxtimewindow)
+            reftrace = reftrace_tmp.data
 
+    # First work on reference Trace:
+    shift_index = align_shifts(data[iref, :], ref_n, ref_n, ref_array=reftrace, mtw=maxtimewindow / delta,
+                               xcorr=xcorr)[0]
+    ref_n = ref_n - shift_index
 
-        # First work on reference Trace:
-        else:
-            if isinstance(maxtimewindow, float) or isinstance(maxtimewindow, int) or isinstance(maxtimewindow,
-                                                                                                np.ndarray):
-                datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, mtw=maxtimewindow / delta,
-                                                        method=shiftmethod)
-
-        ref_n = ref_n - shift_index
-        phase_n = int(phase[0] / delta)
-        data_tmp = data.copy()
-        for no_x, data_x in enumerate(data):
+    # All other traces at once, the reference trace stays in place.
+    shift_index = align_shifts(data, ref_n, phase_n, ref_array=reftrace, mtw=maxtimewindow / delta, xcorr=xcorr)
+    shift_index[iref] = 0
+    data_tmp = shift_traces(data, shift_index, method=shiftmethod)
+    data_tmp[iref, :] = data[iref, :]
+    shifttimes = delta * shift_index
+
+    if verbose:
+        for no_x in range(data.shape[0]):
             if no_x == iref:
                 continue
+            print('Trace no %i was shifted by %f seconds' % (no_x, shifttimes[no_x]))
 
-            if not xcorr:
-                if isinstance(maxtimewindow, float) or isinstance(maxtimewindow, int) or isinstance(maxtimewindow,
-                                                                                                    np.ndarray):
-                    datashift, shift_index = shift2ref(data_x, ref_n, phase_n, mtw=maxtimewindow / delta,
-                                                       method=shiftmethod)
-
-            else:
-                datashift, shift_index = shift2ref(data_x, ref_n, phase_n, ref_array=reftrace,
-                                                   mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
-
-            shifttimes[no_x] = delta * shift_index
-            data_tmp[no_x, :] = datashift
-            if verbose:
-                print('Trace no %i was shifted by %f seconds' % (no_x, delta * shift_index))
-            # Positive shift_index indicates positive shift in time and vice versa.
-            if shift_index > 0 and shift_index > tmin: tmin = shift_index
-            if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
-    else:
-        print('No valid input defined, please use event-file or time-window defined in phases')
-        return
+    # Positive shift_index indicates positive shift in time and vice versa.
+    tmin = max(0, shift_index.max())
+    tmax = max(0, -shift_index.min())
 
     data_trunc = truncate(data_tmp, tmin, tmax)
     st_align = array2stream(data_trunc, st_tmp)
@@ -495,9 +438,7 @@ def corr_stat(stream, inv, phase):
         distance = trace.stats.distance
         delta = trace.stats.delta
 
-    m = TauPyModel('ak135')
-    arrival = m.get_travel_times(depth, distance, phase_list=[phase])
-    slo = arrival[0].ray_param_sec_degree
+    slo = travel_times(depth, distance, [phase])[1]
 
     for i, trace in enumerate(data):
         shift = int(slo * (distance - st[i].stats.distance) / delta)
@@ -840,7 +781,7 @@ def plot_map(inventory, event, stream=None, phases=['P^410P', 'P^660P'], savefig
     Documantation follows, still working on. What kind of information would be useful to plot?
     Have to add a legend.
     """
-    model = TauPyModel('ak135')
+    model = get_model('ak135')
     slat = event.origins[0].latitude
     slon = event.origins[0].longitude
     depth = event.origins[0].depth / 1000.
@@ -1021,7 +962,7 @@ def plot_vespa(data, st, inv=None, event=None, markphases=['ttall', 'P^410P', 'P
             origin = event.origins[0]['time']
             depth = event.origins[0]['depth'] / 1000.
 
-        m = TauPyModel('ak135')
+        m = get_model('ak135')
         dist = st[sref].stats.distance
         arrival = m.get_travel_times(depth, dist, phase_list=markphases)
 
@@ -1029,7 +970,9 @@ def plot_vespa(data, st, inv=None, event=None, markphases=['ttall', 'P^410P', 'P
     # Check if it is a relative plot to an aligned Phase.
     if refphase:
         try:
-            p_ref = m.get_travel_times(depth, dist, refphase)[0].ray_param_sec_degree
+            p_ref = float(travel_times(depth, dist, refphase)[1])
+            if np.isnan(p_ref):
+                p_ref = 0
             ax.set_ylabel(r'Relative $p$ in $\pm \frac{s}{deg}$  to %s arrival' % refphase, fontsize=fs)
             try:
                 ax.set_title(r'Relative %ith root Vespagram' % (power), fontsize=fs)
@@ -1187,7 +1130,6 @@ def resample_distance(stream, inv=None, event=None, shiftmethod='fft', taup_mode
     """
     Function reorganizes the traces in a equidistant manner.
     """
-    m = TauPyModel(taup_model)
     st_tmp = stream.copy()
     data = stream2array(st_tmp)
     stream_resample = Stream()
@@ -1217,20 +1159,27 @@ def resample_distance(stream, inv=None, event=None, shiftmethod='fft', taup_mode
     ilist = []
     tstart_new_list = []
 
+    distances = np.array([trace.stats.distance for trace in st_tmp])
+    if stacking:
+        index_resampled_all = np.abs(yresample[np.newaxis, :] - distances[:, np.newaxis]).argmin(axis=1)
+    else:
+        index_resampled_all = np.arange(len(st_tmp))
+
+    # Shift all traces at once.
+    if refphase:
+        torg_all = travel_times(depth, distances, [refphase], taup_model)[0]
+        tres_all = travel_times(depth, yresample, [refphase], taup_model)[0]
+        tdelta_all = torg_all - tres_all[index_resampled_all]
+        shiftvalue = (tdelta_all / np.array([trace.stats.delta for trace in st_tmp])).astype('int')
+        data_shift = shift_traces(data, -shiftvalue, method=shiftmethod)
+
     # Shifting takes place
     for no, trace in enumerate(st_tmp):
 
-        if stacking:
-            index_resampled = np.abs(yresample - trace.stats.distance).argmin()
-        else:
-            index_resampled = no
+        index_resampled = index_resampled_all[no]
         if refphase:
-            torg = m.get_travel_times(depth, trace.stats.distance, phase_list=[refphase])[0].time
-            tres = m.get_travel_times(depth, yresample[index_resampled], phase_list=[refphase])[0].time
-            tdelta = torg - tres
-            shiftvalue = int(tdelta / trace.stats.delta)
-            trace.data, shift_index = shift2ref(data[no], 0, shiftvalue, method=shiftmethod)
-            trace.stats.starttime = trace.stats.starttime + tdelta
+            trace.data = data_shift[no]
+            trace.stats.starttime = trace.stats.starttime + tdelta_all[no]
 
         tstart_new_list.append(trace.stats.starttime)
 
@@ -1293,7 +1242,7 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
                            taup_model='ak135'):
     """
     Will sort the traces into equally distributed bins and stack the bins.
-    The stacking is just an addition of the traces, more advanced schemes might follow.
+    Each bin is a linear or Nth-root stack of its traces, see order.
     The uniform distribution is useful for FK-filtering, SSA and every method that requires
     a uniform distribution.
 
@@ -1325,8 +1274,9 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
     :param taup_model:
 
     returns:
-    :param bin_data: partial stacked data of the array in bins uniform distributed stacks
-    :type bin_data: array
+    :param st_binned: partial stacked data of the array in bins uniform distributed stacks,
+                      trace.stats.fold is the number of traces stacked in each bin
+    :type st_binned: obspy.core.stream.Stream
 
     Author: S. Schneider, 2016
     Reference: Rost, S. & Thomas, C. (2002). Array seismology: Methods and Applications
@@ -1363,18 +1313,13 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
                 break
 
     else:
-        no_of_bins = math.ceil( ( epidist.max()-epidist.min() ) / bin_size )
+        no_of_bins = int(math.ceil( ( epidist.max()-epidist.min() ) / bin_size ))
         L = np.linspace(min(epidist), max(epidist), no_of_bins + 1)
-        L = zip(L, np.roll(L, -1))
-        L = L[0:len(L) - 1]
+        L = list(zip(L[:-1], L[1:]))
 
         # Resample the y-axis information to new, equally distributed ones.
-        y_resample = np.linspace(min(min(L)) + bin_size / 2., max(max(L)) - bin_size / 2., no_of_bins)
-        bin_distribution = np.zeros(len(y_resample))
+        y_resample = np.linspace(epidist.min() + bin_size / 2., epidist.max() - bin_size / 2., no_of_bins)
 
-    # Preallocate some space in memory.
-    bin_data = np.zeros((len(y_resample), data.shape[1]))
-    m = TauPyModel(taup_model)
     depth = st_tmp[0].stats.depth
     delta = st_tmp[0].stats.delta
 
@@ -1401,57 +1346,43 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
     yi_sampleindex = np.zeros(len(epidist)).astype('int')
 
     if refphase:
-        try:
-            for i, res_distance in enumerate(y_resample):
-                yr_sampleindex[i] = int(m.get_travel_times(depth, res_distance, phase_list=[refphase])[0].time / delta)
-
-            for i, epi_distance in enumerate(epidist):
-                yi_sampleindex[i] = int(m.get_travel_times(depth, epi_distance, phase_list=[refphase])[0].time / delta)
-        except:
-            for i, res_distance in enumerate(y_resample):
-                yr_sampleindex[i] = int(m.get_travel_times(depth, res_distance, phase_list=[refphase+'diff'])[0].time / delta)
-
-            for i, epi_distance in enumerate(epidist):
-                yi_sampleindex[i] = int(m.get_travel_times(depth, epi_distance, phase_list=[refphase+'diff'])[0].time / delta)
-
-    # Loop through all bins.
-    for i, bins in enumerate(L):
-
-        # Loop through all traces.
-        for j, trace in enumerate(data):
-
-            # First bin.
-            if i == 0:
-                if epidist[j] <= bins[1]:
-                    if refphase:
-                        trace_shift, shif_index = shift2ref(trace, yr_sampleindex[i], yi_sampleindex[j], mtw,
-                                                            method=shiftmethod)
-                    else:
-                        trace_shift = trace
-                    stack_arr = np.vstack([bin_data[i], trace_shift])
-                    bin_data[i] = stack(stack_arr, order)
-
-            # Check if current trace is inside bin-boundaries.
-            if epidist[j] > bins[0] and epidist[j] <= bins[1]:
-                if refphase:
-                    trace_shift, shif_index = shift2ref(trace, yr_sampleindex[i], yi_sampleindex[j], mtw,
-                                                        method=shiftmethod)
-                else:
-                    trace_shift = trace
-
-                stack_arr = np.vstack([bin_data[i], trace_shift])
-                bin_data[i] = stack(stack_arr, order)
-
-            if overlap:
-                if i == len(L):
-                    if refphase:
-                        trace_shift, shif_index = shift2ref(trace, yr_sampleindex[i], yi_sampleindex[j], mtw,
-                                                            method=shiftmethod)
-                    else:
-                        trace_shift = trace
+        # Diffracted phase where refphase has no arrival.
+        y_all = np.concatenate((y_resample, epidist))
+        t_all = travel_times(depth, y_all, [refphase], taup_model)[0]
+        nodiff = np.isnan(t_all)
+        if nodiff.any():
+            t_all[nodiff] = travel_times(depth, y_all[nodiff], [refphase + 'diff'], taup_model)[0]
+        if np.isnan(t_all).any():
+            msg = 'No arrival of %s or %sdiff at all distances' % (refphase, refphase)
+            raise IOError(msg)
+        yr_sampleindex = (t_all[:len(y_resample)] / delta).astype('int')
+        yi_sampleindex = (t_all[len(y_resample):] / delta).astype('int')
+
+    # Traces of each bin, lower < distance <= upper, the first bin includes its lower border.
+    lower = np.array([bins[0] for bins in L])
+    upper = np.array([bins[1] for bins in L])
+    order_dist = np.argsort(epidist, kind='mergesort')
+    epidist_sorted = epidist[order_dist]
+    first = np.searchsorted(epidist_sorted, lower, side='right')
+    first[0] = 0
+    last = np.searchsorted(epidist_sorted, upper, side='right')
+    fold = np.maximum(last - first, 0)
+
+    # All (bin, trace) pairs, ordered by bin.
+    offsets = np.cumsum(fold) - fold
+    bin_index = np.repeat(np.arange(len(L)), fold)
+    trace_index = order_dist[np.repeat(first, fold) + np.arange(fold.sum()) - np.repeat(offsets, fold)]
+
+    # Shift each pair from the arrival at the trace to the arrival at the bin, the picks in
+    # the maximum timewindow only depend on the trace.
+    if refphase:
+        pick_shift = align_shifts(data, 0, yi_sampleindex, mtw=mtw)
+        pair_data = shift_traces(data[trace_index], yr_sampleindex[bin_index] + pick_shift[trace_index],
+                                 method=shiftmethod)
+    else:
+        pair_data = data[trace_index]
 
-                    stack_arr = np.vstack([bin_data[i], trace_shift])
-                    bin_data[i] = stack(stack_arr, order)
+    bin_data, fold = segment_stack(pair_data, offsets, order)
 
     st_binned = array2stream(bin_data)
     st_binned.normalize()
@@ -1463,6 +1394,7 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
         trace.stats.sampling_rate = st_tmp[0].stats.sampling_rate
         trace.stats.depth = st_tmp[0].stats.depth
         trace.stats.distance = y_resample[i]
+        trace.stats.fold = fold[i]
         trace.stats.origin = st_tmp[0].stats.origin
         try:
             trace.stats.processing = st_tmp[0].stats.processing
@@ -1505,127 +1437,164 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
     Author: S. Schneider, 2016
     Source: Gubbins, D., 2004 Time series analysis and inverse theory for geophysicists
     """
-    trace = array.copy()
+    shift_value = align_shifts(array, tref, tshift, ref_array=ref_array, mtw=mtw, xcorr=xcorr)[0]
+    shift_trace = shift_traces(array, [shift_value], method=method)[0]
+
+    return shift_trace, shift_value
+
+
+def align_shifts(data, tref, tshift, ref_array=None, mtw=0, xcorr=False):
+    """
+    Shift values tref - tshift of shift2ref for all traces of data at once. If mtw is given,
+    tshift of each trace is moved to its maximum amplitude (minimum for negative mtw) in the
+    timewindow, or, with xcorr, to the lag of the maximum cross-correlation with ref_array.
+
+    :param data: array-like traces, 2D (traces x samples) or 1D
+
+    :param tref: Reference index
+
+    :param tshift: Nondimensional shift value of each trace
+    :type tshift: int or array-like
+
+    :param ref_array: Reference trace for the cross-correlation
+
+    :param mtw: Maximum nondimensional timewindow, float symmetrical around tshift,
+                or array with the samples before and after tshift.
+
+    :param xcorr: Use cross correlation with ref_array.
+    :type xcorr: bool
+
+    returns:
+    :param shift_value: Shift of each trace
+    :type shift_value: numpy.ndarray of int
+
+    Author: S. Schneider, 2016
+    """
+    data = np.atleast_2d(data)
+    ntr, npts = data.shape
+    tshift = np.zeros(ntr, dtype='int') + np.asarray(tshift).astype('int')
+    rows = np.arange(ntr)[:, np.newaxis]
     if isinstance(mtw, float) and mtw == 0: mtw = None
 
-    # if mtw is set
-    if isinstance(mtw, float) and not xcorr:
-        if mtw > 0:
-            tmin = tshift - int(abs(mtw) / 2.)
-            tmax = tshift + int(abs(mtw) / 2.)
-            stmax = trace[tshift]
-            mtw_index = tshift
-            for k in range(tmin, tmax + 1):
-                if trace[k] > stmax:
-                    stmax = trace[k]
-                    mtw_index = k
-            shift_value = tref - mtw_index
-
-        elif mtw < 0:
-            tmin = tshift - int(abs(mtw) / 2.)
-            tmax = tshift + int(abs(mtw) / 2.)
-            stmax = trace[tshift]
-            mtw_index = tshift
-            for k in range(tmin, tmax + 1):
-                if trace[k] < stmax:
-                    stmax = trace[k]
-                    mtw_index = k
-            shift_value = tref - mtw_index
-
-
-
-    elif isinstance(mtw, np.ndarray) and not xcorr:
-        if mtw[0] >= 0:
-            tmin = tshift - int(mtw[0])
-            tmax = tshift + int(mtw[1])
-            stmax = trace[tmin]
-            mtw_index = tshift
-            for k in np.arange(tmin, tmax + 1).astype('int'):
-                if trace[k] > stmax:
-                    stmax = trace[k]
-                    mtw_index = k
-            shift_value = tref - mtw_index
-
-        elif mtw[0] < 0:
-            tmin = tshift - abs(int(mtw[0]))
-            tmax = tshift + abs(int(mtw[1]))
-            stmax = trace[tmin]
-            mtw_index = tshift
-            for k in np.arange(tmin, tmax + 1).astype('int'):
-                if trace[k] < stmax:
-                    stmax = trace[k]
-                    mtw_index = k
-            shift_value = tref - mtw_index
-
-    elif xcorr:
+    if xcorr:
         if not isinstance(ref_array, np.ndarray):
-            msg('No reference Trace for X-Correlation found!')
+            msg = 'No reference Trace for X-Correlation found!'
             raise IOError(msg)
 
         if isinstance(mtw, float):
-            tw = truncate(trace, tshift - mtw, tshift + mtw, absolute=True)
-
+            before, after = int(abs(mtw)), int(abs(mtw))
         elif isinstance(mtw, np.ndarray):
-            tw = truncate(trace, tshift - mtw[0], tshift + mtw[1], absolute=True)
+            before, after = abs(int(mtw[0])), int(mtw[1])
+        else:
+            msg = 'X-Correlation needs a timewindow mtw'
+            raise IOError(msg)
+
+        # Windows of all traces, correlated with the reference in one batched FFT.
+        index = np.clip(tshift[:, np.newaxis] + np.arange(-before, after), 0, npts - 1)
+        tw = data[rows, index]
+        ncorr = ref_array.size + tw.shape[1] - 1
+        iF = fft_length(ncorr)
+        corr = irfft(rfft(ref_array, iF)[np.newaxis, :] * rfft(tw[:, ::-1], iF, axis=1), iF, axis=1)[:, :ncorr]
+
+        return tref - tshift - (corr.argmax(axis=1) + 1 - tw.shape[1])
 
-        shift_value = tref - tshift - (
-        correlate(ref_array, tw).argmax() + 1 - tw.size)  # tref - (correlate(ref_array, tw).argmax()+1 - tw.size)
+    if isinstance(mtw, float):
+        half = int(abs(mtw) / 2.)
+        window = np.arange(-half, half + 1)
+        sign = 1. if mtw > 0 else -1.
+        # Maxima have to exceed the value at tshift.
+        first = tshift
+
+    elif isinstance(mtw, np.ndarray):
+        if mtw[0] >= 0:
+            window = np.arange(-int(mtw[0]), int(mtw[1]) + 1)
+            sign = 1.
+        else:
+            window = np.arange(-abs(int(mtw[0])), abs(int(mtw[1])) + 1)
+            sign = -1.
+        # Maxima have to exceed the value at the start of the window.
+        first = tshift + window[0] if window.size else tshift
 
     else:
-        shift_value = tref - tshift
+        return tref - tshift
 
-    if method in ("normal", "Normal"):
-        shift_trace = np.roll(trace, shift_value)
-    if method in ("FFT", "fft", "Fft", "fFt", "ffT", "FfT"):
-        it = trace.size
-        iF = int(math.pow(2, nextpow2(it)))
-        dft = np.fft.fft(trace, iF)
+    if window.size == 0:
+        return tref - tshift
 
-        arg = -2. * np.pi * shift_value / float(iF)
-        dft_shift = np.zeros(dft.size).astype('complex')
+    # Negative indicies wrap around as in python indexing.
+    values = sign * data[rows, (tshift[:, np.newaxis] + window) % npts]
+    imax = values.argmax(axis=1)
+    found = values[np.arange(ntr), imax] > sign * data[np.arange(ntr), first % npts]
+    mtw_index = np.where(found, tshift + window[imax], tshift)
 
-        for i, ampl in enumerate(dft):
-            dft_shift[i] = ampl * np.complex(np.cos(i * arg), np.sin(i * arg))
+    return tref - mtw_index
 
-        shift_trace = np.fft.ifft(dft_shift, iF)
-        shift_trace = shift_trace[0:it].real
 
-    return shift_trace, shift_value
+def shift_traces(data, shift_value, method='normal'):
+    """
+    Shifts each trace of data by its integer shift_value, with method 'normal' as circular
+    shift (np.roll) or 'fft' in the frequency domain, with zero padding to the next power of 2.
 
+    :param data: array-like traces, 2D (traces x samples) or 1D
 
-def stack(data, order=None):
+    :param shift_value: Shift of each trace in samples
+
+    :param method: 'normal' or 'fft'
+
+    returns:
+    :param shift_data: Shifted traces, 2D
+
+    Author: S. Schneider, 2016
+    """
+    data = np.atleast_2d(data)
+    ntr, it = data.shape
+    shift_value = np.zeros(ntr, dtype='int') + np.asarray(shift_value).astype('int')
+
+    if method in ("normal", "Normal"):
+        index = (np.arange(it)[np.newaxis, :] - shift_value[:, np.newaxis]) % it
+        shift_data = data[np.arange(ntr)[:, np.newaxis], index]
+
+    elif method.lower() == "fft":
+        iF = int(math.pow(2, nextpow2(it)))
+        shift_data = fractional_shift(data, shift_value, nfft=iF)
+
+    else:
+        msg = "Unknown shift method '%s', use 'normal' or 'fft'" % method
+        raise IOError(msg)
+
+    return shift_data
+
+
+def stack(data, order=None, axis=0, weights=None, out=None):
     """
     :param data: Array of data, that should be stacked.
-                   Stacking is performed over axis = 1
+                   Stacking is performed over axis = 0 by default, e.g. over
+                   the traces of an array (traces x samples).
     :type data: array_like
 
-    :param order: Order of the stack
+    :param order: Order of the stack, if None a linear stack is performed.
     :type order: int
 
-    Author: S. Schneider, 2016
-    Reference: Rost, S. & Thomas, C. (2002). Array seismology: Methods and Applications
-    """
+    :param axis: Axis to stack over
+    :type axis: int
 
-    vNth = 0
-    v = 0
-    # if order is not None
-    try:
-        order = float(order)
+    :param weights: Weight of each element along axis
+    :type weights: array_like
 
-        datasgn = np.sign(data)
-        dataNth = abs(data) ** (1. / order)
+    :param out: Array for the result, shape of data without axis
+    :type out: numpy.ndarray
 
-        for i, trNth in enumerate(dataNth):
-            vNth = vNth + datasgn[i] * trNth
+    See bowpy.util.stacking for the kernels, including the phase-weighted stack.
 
-        vNth = vNth / data.shape[0]
-        vsgn = np.sign(vNth)
-        v = vsgn * abs(vNth) ** order
+    Author: S. Schneider, 2016
+    Reference: Rost, S. & Thomas, C. (2002). Array seismology: Methods and Applications
+    """
 
-    except TypeError:
-        for trace in data:
-            v = v + trace
-        v = v / data.shape[0]
+    if order is None:
+        v = linear_stack(data, axis=axis, weights=weights, out=out)
+    else:
+        v = nthroot_stack(data, float(order), axis=axis, weights=weights,
+                          out=out)
 
     return v
 
@@ -1676,7 +1645,7 @@ def truncate(data, tmin, tmax, absolute=False):
 def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
               power=4, plot=False, cmap='seismic', sref=0,
               markphases=None, method='fft',
-              tw=None, zoom=1, savefig=False, dpi=400, fs=25):
+              tw=None, zoom=1, savefig=False, dpi=400, fs=25, chunksize=None, fractional=False):
     """
     Creates a vespagram for the given slownessrange and slownessstepsize. Returns the vespagram as numpy array
     and if set a plot.
@@ -1712,6 +1681,17 @@ def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
     :param method: Shift method, to be used 'FFT' or 'normal'
     :type  method: string
 
+    :param chunksize: Number of slownesses shifted and stacked at once, limits the memory to
+                      about traces x chunksize x nfft complex values ('fft') or traces x
+                      chunksize x samples values ('normal'). Default is a chunksize of about
+                      2**24 values.
+    :type  chunksize: int
+
+    :param fractional: Method 'normal' only, if True the traces are shifted by fractional
+                       samples using linear interpolation, otherwise by whole samples.
+                       Samples shifted in from outside the trace are zero.
+    :type  fractional: bool
+
 
     returns:
 
@@ -1763,70 +1743,65 @@ def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
     uN = int((slomax - slomin) / slostep + 1)
     urange = np.linspace(slomin, slomax, uN)
     it = data.shape[1]
-    iF = int(math.pow(2, nextpow2(it)))
-    dft = np.fft.fft(data, iF, axis=1)
+    iF = fft_length(it)
     vespa = np.zeros((uN, data.shape[1]))
     taxis = np.arange(data.shape[1]) * dsample
 
-    if method in ("fft"):
-        # Calculate timeshift-table as a tensor, see shift2ref method "fft" as guide.
-        timeshift_table = np.zeros((data.shape[0], urange.size, dft.shape[1])).astype('complex')
+    # Timeshift in samples for every station (rows) and slowness (columns),
+    # positive for stations further away than the reference station.
+    sdelay = abs(epidist[sref] - epidist)[:, np.newaxis] * urange / dsample
+    sdirection = np.sign(epidist - epidist[sref])[:, np.newaxis]
 
-        # Slowness-Loop
-        for j, slo in enumerate(urange):
-
-            # Station-Loop
-            for i in range(timeshift_table.shape[0]):
-                sshift = int(abs(epidist[sref] - epidist[i]) * slo / dsample)
-                if epidist[i] > epidist[sref]:
-                    timeshift_table[i][j] = np.exp(
-                        (0. + 1j) * (2. * np.pi * sshift / float(iF)) * np.arange(dft.shape[1]))
-                elif epidist[i] < epidist[sref]:
-                    timeshift_table[i][j] = np.exp(
-                        (0. + 1j) * (-2. * np.pi * sshift / float(iF)) * np.arange(dft.shape[1]))
-                elif epidist[i] == epidist[sref]:
-                    timeshift_table[i][j] = 1.  # np.exp((0.+ 1j) * 0) = 1.
-
-        # Transpose the tensor in right
-        tst = timeshift_table.transpose(1, 0, 2)
+    if method in ("fft"):
+        sshift = sdirection * np.trunc(sdelay)
 
-        # Slownesses
-        for i, shifttable in enumerate(tst):
-            dftshift = np.zeros(dft.shape).astype('complex')
-            dftshift = dft * shifttable
+        # The phase ramps, see bowpy.util.timeshift, are computed for
+        # blocks of slownesses only, so memory is bounded by chunksize.
+        if not chunksize:
+            chunksize = max(1, int(2**24 / (data.shape[0] * iF)))
+        dft = rfft(data, iF, axis=1)
 
-            shiftdata = np.fft.ifft(dftshift, iF)
-            vespatrace = shiftdata.real.copy()
+        for j in range(0, uN, chunksize):
+            block = slice(j, min(j + chunksize, uN))
+            shifttable = phase_ramp(-sshift[:, block], iF)
 
-            # Put it in the right size again.
-            vespatrace = np.delete(vespatrace, np.s_[it:], 1)
+            shiftdata = irfft(dft[:, np.newaxis, :] * shifttable, iF, axis=-1)
 
-            vespa[i] = stack(vespatrace, power)
+            # Put it in the right size again and stack over the stations.
+            vespa[block] = stack(shiftdata[:, :, :it], power)
 
     if method in ("normal"):
-        shift_data_tmp = np.zeros(data.shape)
-
-        tmin = 0
-        tmax = 0
-        # Loop over all slownesses.
-        for i, u in enumerate(urange):
-            for j, trace in enumerate(data):
-                sshift = int(abs(epidist[sref] - epidist[j]) * u / dsample)
-                if epidist[j] > epidist[sref]:
-                    shift_data_tmp[j, :], shift_index = shift2ref(trace, 0, sshift, method="normal")
-
-                elif epidist[j] < epidist[sref]:
-                    shift_data_tmp[j, :], shift_index = shift2ref(trace, 0, -sshift, method="normal")
-
-                elif epidist[j] == epidist[sref]:
-                    shift_data_tmp[j, :] = trace
-                # Positive shift_index indicates positive shift in time and vice versa.
-                # if shift_index > 0 and shift_index > tmin: tmin = shift_index
-                # if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
-
-            vespa[i, :] = stack(shift_data_tmp, order=power)
-
-        # vespa = truncate(vespa, tmin, tmax)
+        # Delay-and-sum: the shifted traces are gathered from a zero-padded copy
+        # of the data, trace j is read at samples t + shift[j].
+        if fractional:
+            sshift = sdirection * sdelay
+        else:
+            sshift = sdirection * np.trunc(sdelay)
+
+        pad = int(np.ceil(abs(sshift).max())) + 1
+        width = it + 2 * pad
+        data_pad = np.zeros((data.shape[0], width))
+        data_pad[:, pad:pad + it] = data
+        data_pad = data_pad.ravel()
+
+        if not chunksize:
+            chunksize = max(1, int(2**24 / (data.shape[0] * it)))
+        rows = (np.arange(data.shape[0]) * width + pad)[:, np.newaxis, np.newaxis]
+        samples = np.arange(it)
+
+        for j in range(0, uN, chunksize):
+            block = slice(j, min(j + chunksize, uN))
+            ishift = np.floor(sshift[:, block, np.newaxis])
+            index = rows + ishift.astype(int) + samples
+
+            shift_data_tmp = data_pad.take(index)
+            if fractional:
+                # Linear interpolation between neighbouring samples.
+                weight = sshift[:, block, np.newaxis] - ishift
+                shift_data_tmp *= 1. - weight
+                shift_data_tmp += weight * data_pad.take(index + 1)
+
+            vespa[block] = stack(shift_data_tmp, order=power)
 
     vespa = vespa / abs(vespa).max()
 
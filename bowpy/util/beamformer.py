@@ -0,0 +1,253 @@
+from __future__ import absolute_import, print_function
+from collections import OrderedDict
+import hashlib
+import numpy as np
+
+"""
+Frequency-domain beamforming on a slowness grid.
+
+Steering vectors are built with a broadcast exponential from the time-shift
+table of an array (see get_timeshift in bowpy.misc.Muenster_Array_Seismology)
+and are cached per table, frequency band and sign. The beam power of all grid
+points and frequencies is computed with batched matrix products.
+
+    cross_spectral_matrix       Cross-spectral density matrices R(f) of one
+                                or many windows, with diagonal loading
+    capon_inverse               Stacked inverse of R(f) for Capon
+    generalized_beamformer      Bartlett ('bf') and Capon power from the
+                                cross-spectral density matrix R(f)
+    slowness_whitened_power     Slowness whitened power (SWP) from spectra
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+_steer_cache = OrderedDict()
+_steer_cache_size = 4
+
+
+def capon_inverse(R, rcond=1e-6, loaded=False):
+    """
+    Inverse of a stack of cross-spectral density matrices, in one call.
+
+    :param R: Cross-spectral density matrices
+    :type R: numpy.ndarray, shape (..., nstat, nstat)
+
+    :param rcond: Cutoff of the pseudo-inverse for small singular values
+    :type rcond: float
+
+    :param loaded: If True, R is assumed to be positive definite (e.g. after
+                   diagonal loading) and is inverted directly, otherwise the
+                   pseudo-inverse is computed.
+    :type loaded: bool
+
+    returns:
+
+    :param Rinv: Inverse of R
+    :type Rinv: numpy.ndarray, shape (..., nstat, nstat)
+    """
+    if loaded:
+        return np.linalg.inv(R)
+
+    return np.linalg.pinv(R, rcond=rcond, hermitian=True)
+
+
+def clear_steering_cache():
+    """
+    Empties the cache of steering vectors.
+    """
+    _steer_cache.clear()
+
+
+def cross_spectral_matrix(ft, normalize=False, diag_load=0.):
+    """
+    Cross-spectral density matrices R[n, i, j] = ft[i, n] * ft[j, n].conj()
+    as batched outer products, for one or many windows.
+
+    :param ft: Spectra of the stations in the frequency band
+    :type ft: numpy.ndarray, shape (..., nstat, nf)
+
+    :param normalize: If True, each element R[:, i, j] is normalized by
+                      the absolute value of its sum over frequency (Capon).
+    :type normalize: bool
+
+    :param diag_load: Diagonal loading, R(f) + diag_load * mean(diag(R(f))) * I,
+                      default 0 is no loading.
+    :type diag_load: float
+
+    returns:
+
+    :param R: Cross-spectral density matrices
+    :type R: numpy.ndarray, shape (..., nf, nstat, nstat)
+
+    :param dpow: Power normalization of the unloaded R, nstat * sum_i |sum_f R_ii|
+    :type dpow: numpy.ndarray, shape (...)
+    """
+    ft = np.asarray(ft)
+    nstat = ft.shape[-2]
+    ftn = np.swapaxes(ft, -1, -2)
+    R = ftn[..., :, np.newaxis] * ftn[..., np.newaxis, :].conj()
+
+    if normalize:
+        R /= abs(R.sum(axis=-3))[..., np.newaxis, :, :]
+
+    diag = np.diagonal(R, axis1=-2, axis2=-1)
+    dpow = nstat * abs(diag.sum(axis=-2)).sum(axis=-1)
+
+    if diag_load:
+        load = diag_load * diag.real.mean(axis=-1)
+        idx = np.arange(nstat)
+        R[..., idx, idx] += load[..., np.newaxis]
+
+    return R, dpow
+
+
+def generalized_beamformer(steer, R, method='bf', prewhiten=False, dpow=None):
+    """
+    Beam power P(f) = |e.H R(f) e| ('bf') or P(f) = 1 / |e.H R(f) e| ('capon')
+    for all grid points, summed over frequency.
+
+    :param steer: Steering vectors e, as returned by steering_vectors
+    :type steer: numpy.ndarray, shape (nf, grdpts_x, grdpts_y, nstat)
+
+    :param R: Cross-spectral density matrix for 'bf', its inverse for 'capon'
+    :type R: numpy.ndarray, shape (nf, nstat, nstat)
+
+    :param method: 'bf' (Bartlett) or 'capon', also accepts 0 and 1
+    :type method: string
+
+    :param prewhiten: If True, the power of each frequency is normalized by its
+                      maximum over the grid before summation
+    :type prewhiten: bool
+
+    :param dpow: Normalization of the relative power without prewhitening,
+                 ignored for 'capon'
+    :type dpow: float
+
+    returns:
+
+    :param relpow_map: Relative power
+    :type relpow_map: numpy.ndarray, shape (grdpts_x, grdpts_y)
+
+    :param abspow_map: Absolute power
+    :type abspow_map: numpy.ndarray, shape (grdpts_x, grdpts_y)
+    """
+    if method in ('bf', 'bartlett', 0):
+        capon = False
+    elif method in ('capon', 1):
+        capon = True
+    else:
+        msg = "Unknown method '%s', use 'bf' or 'capon'" % str(method)
+        raise IOError(msg)
+
+    nf, grdpts_x, grdpts_y, nstat = steer.shape
+    e = steer.reshape(nf, grdpts_x * grdpts_y, nstat)
+
+    # e.H R e for all grid points, Re[n, g, i] = sum_j R[n, i, j] e[n, g, j]
+    Re = np.matmul(e, np.swapaxes(R, 1, 2))
+    power = abs(np.einsum('ngi,ngi->ng', e.conj(), Re))
+    if capon:
+        power = 1. / power
+        dpow = 1.
+
+    abspow_map = power.sum(axis=0)
+    if prewhiten:
+        white = power.max(axis=1)
+        relpow_map = (power / white[:, np.newaxis]).sum(axis=0) / (nf * nstat)
+    else:
+        if dpow is None:
+            msg = 'dpow is needed without prewhitening'
+            raise IOError(msg)
+        relpow_map = abspow_map / dpow
+
+    return (relpow_map.reshape(grdpts_x, grdpts_y),
+            abspow_map.reshape(grdpts_x, grdpts_y))
+
+
+def slowness_whitened_power(steer, spec):
+    """
+    Slowness whitened power, the beam amplitude |sum_i e_i(f) s_i(f)| of each
+    frequency normalized by its maximum over the grid and averaged over
+    frequency.
+
+    :param steer: Steering vectors e, as returned by steering_vectors
+    :type steer: numpy.ndarray, shape (nf, grdpts_x, grdpts_y, nstat)
+
+    :param spec: Spectra of the stations in the frequency band
+    :type spec: numpy.ndarray, shape (nstat, nf)
+
+    returns:
+
+    :param abspow_map: Slowness whitened power
+    :type abspow_map: numpy.ndarray, shape (grdpts_x, grdpts_y)
+    """
+    nf, grdpts_x, grdpts_y, nstat = steer.shape
+    e = steer.reshape(nf, grdpts_x * grdpts_y, nstat)
+
+    beam = abs(np.matmul(e, spec.T[:, :, np.newaxis])[:, :, 0])
+    beam /= beam.max(axis=1)[:, np.newaxis]
+    abspow_map = beam.sum(axis=0) / float(nf)
+
+    return abspow_map.reshape(grdpts_x, grdpts_y)
+
+
+def steering_vectors(time_shift_table, nlow, nf, deltaf, sign=-1, cache=True):
+    """
+    Steering vectors e = exp(sign * i 2 pi f_n t) of all stations and grid
+    points, with f_n = (nlow + n) * deltaf.
+
+    :param time_shift_table: Time shifts in s of each station and grid point
+    :type time_shift_table: numpy.ndarray, shape (nstat, grdpts_x, grdpts_y)
+
+    :param nlow: Index of the lowest frequency
+    :type nlow: int
+
+    :param nf: Number of frequencies
+    :type nf: int
+
+    :param deltaf: Frequency sampling in Hz
+    :type deltaf: float
+
+    :param sign: Sign of the exponent, -1 or 1
+    :type sign: int
+
+    :param cache: If True, the vectors are taken from or stored in a cache of
+                  the last few tables. Cached arrays are read-only.
+    :type cache: bool
+
+    returns:
+
+    :param steer: Steering vectors
+    :type steer: numpy.ndarray, shape (nf, grdpts_x, grdpts_y, nstat)
+    """
+    tst = np.ascontiguousarray(time_shift_table)
+    nlow, nf, deltaf, sign = int(nlow), int(nf), float(deltaf), int(sign)
+
+    if cache:
+        key = (hashlib.md5(tst.tobytes()).hexdigest(), tst.shape, tst.dtype.str,
+               nlow, nf, deltaf, sign)
+        if key in _steer_cache:
+            _steer_cache.move_to_end(key)
+            return _steer_cache[key]
+
+    omega = 2. * np.pi * (nlow + np.arange(nf)) * deltaf
+    wtau = omega[:, np.newaxis, np.newaxis, np.newaxis] * \
+        np.moveaxis(tst.astype('float64'), 0, -1)[np.newaxis]
+    steer = np.exp(sign * 1j * wtau)
+
+    if cache:
+        steer.flags.writeable = False
+        _steer_cache[key] = steer
+        while len(_steer_cache) > _steer_cache_size:
+            _steer_cache.popitem(last=False)
+
+    return steer
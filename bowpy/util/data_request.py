@@ -1,15 +1,16 @@
 from __future__ import absolute_import, print_function
+import numpy as np
 import matplotlib.pyplot as plt
 from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
 from obspy import Stream
 from obspy.geodetics import locations2degrees, gps2dist_azimuth
-from obspy.taup import TauPyModel
 from obspy.core.event import Catalog, Event, Magnitude, Origin, MomentTensor
 import sys
 from bowpy.util.array_util import (center_of_gravity, attach_network_to_traces,
                                    attach_coordinates_to_traces,
                                    geometrical_center)
+from bowpy.util.traveltimes import travel_times
 from nmpy.util.writeah import _write_ah1
 try:
     import instaseis
@@ -190,7 +191,6 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
 
     print("Following events found: \n")
     print(catalog)
-    m = TauPyModel(model="ak135")
     for event in catalog:
         if inv:
             origin_t = event.origins[0].time
@@ -237,19 +237,22 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
             elon = event.origins[0].longitude
             depth = event.origins[0].depth/1000.
 
+            # First arrival times at all stations of the network.
+            epidists = np.array([locations2degrees(station.latitude,
+                                                   station.longitude,
+                                                   elat, elon)
+                                 for station in net])
+            Ptimes = travel_times(depth, epidists, 'ttall')[0]
+
             array_fits = True
             if azimuth or baz:
                 cog = center_of_gravity(net)
                 slat = cog['latitude']
                 slon = cog['longitude']
                 epidist = locations2degrees(slat, slon, elat, elon)
-                arr_time = m.get_travel_times(source_depth_in_km=depth,
-                                              distance_in_degree=epidist)
 
                 # Checking for first arrival time
-                P_arrival_time = arr_time[0]
-
-                Ptime = P_arrival_time.time
+                Ptime = float(travel_times(depth, epidist, 'ttall')[0])
                 tstart = UTCDateTime(event.origins[0].time + Ptime -
                                      t_before_first_arrival * 60)
                 tend = UTCDateTime(event.origins[0].time + Ptime +
@@ -282,16 +285,9 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
             no_of_stations = 0
             if array_fits:
 
-                for station in net:
+                for i, station in enumerate(net):
 
-                    epidist = locations2degrees(station.latitude,
-                                                station.longitude,
-                                                elat, elon)
-                    arr_time = m.get_travel_times(source_depth_in_km=depth,
-                                                  distance_in_degree=epidist)
-                    P_arrival_time = arr_time[0]
-
-                    Ptime = P_arrival_time.time
+                    Ptime = Ptimes[i]
                     tstart = UTCDateTime(event.origins[0].time + Ptime -
                                          t_before_first_arrival * 60)
                     if normal_mode_data:
@@ -350,16 +346,9 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
 
             # If not, checking each station individually.
             else:
-                for station in net:
-                    epidist = locations2degrees(station.latitude,
-                                                station.longitude, elat, elon)
-                    arr_time = m.get_travel_times(source_depth_in_km=depth,
-                                                  distance_in_degree=epidist)
-
+                for i, station in enumerate(net):
                     # Checking for first arrival time
-                    P_arrival_time = arr_time[0]
-
-                    Ptime = P_arrival_time.time
+                    Ptime = Ptimes[i]
                     tstart = UTCDateTime(event.origins[0].time + Ptime -
                                          t_before_first_arrival * 60)
                     tend = UTCDateTime(event.origins[0].time + Ptime +
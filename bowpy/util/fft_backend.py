@@ -0,0 +1,225 @@
+from __future__ import absolute_import, print_function
+import numpy as np
+import os
+import atexit
+import pickle
+
+from bowpy.util.base import nextpow2
+
+"""
+Central FFT layer for the fk, ssa, radon and vespagram routines.
+
+The backend is selected at runtime with set_backend:
+
+    'numpy'   numpy.fft (default)
+    'scipy'   scipy.fft, multithreaded with workers
+    'pyfftw'  pyFFTW through its scipy.fft interface, with plan caching
+              and optional wisdom persisted to disk
+
+rfft2 and irfft2 accept an out array of the result. It is written in
+place by numpy >= 2.0, the other backends copy their result into it;
+irfft2 may also overwrite its input with overwrite_x.
+
+Padded transform lengths are chosen by fft_length, following the padding
+policy set with set_padding:
+
+    'pow2'    next power of 2 (default, as with nextpow2)
+    'fast'    next fast length of scipy.fft (products of 2, 3, 5, ...)
+
+Example:
+            import bowpy.util.fft_backend as fftb
+            fftb.set_backend('scipy', workers=32)
+            fftb.set_padding('fast')
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+# numpy.fft writes into out= since numpy 2.0
+_NUMPY_OUT = int(np.__version__.split('.')[0]) >= 2
+
+_config = {'backend': 'numpy', 'workers': None, 'padding': 'pow2',
+           'wisdom': None, 'module': np.fft}
+
+
+def fft(a, n=None, axis=-1):
+    return _transform('fft', a, n=n, axis=axis)
+
+
+def fft2(a, s=None, axes=(-2, -1)):
+    return _transform('fft2', a, s=s, axes=axes)
+
+
+def fft_length(n, policy=None):
+    """
+    Returns the padded length of a transform of n samples, according
+    to the padding policy.
+
+    :param n: Number of samples
+    :type n: int
+
+    :param policy: 'pow2' or 'fast', default is the policy set with set_padding
+    :type policy: string
+
+    returns:
+
+    :param nfft: Length of the transform, nfft >= n
+    :type nfft: int
+    """
+    if not policy:
+        policy = _config['padding']
+
+    if policy in ('pow2', 'nextpow2'):
+        nfft = int(2**nextpow2(n))
+    elif policy in ('fast', 'next_fast_len'):
+        from scipy.fft import next_fast_len
+        nfft = int(next_fast_len(int(n)))
+    else:
+        msg = "Unknown padding policy '%s', use 'pow2' or 'fast'" % policy
+        raise IOError(msg)
+
+    return nfft
+
+
+def get_backend():
+    """
+    Returns the current settings as a dictionary with the keys
+    backend, workers, padding and wisdom.
+    """
+    return {'backend': _config['backend'], 'workers': _config['workers'],
+            'padding': _config['padding'], 'wisdom': _config['wisdom']}
+
+
+def ifft(a, n=None, axis=-1):
+    return _transform('ifft', a, n=n, axis=axis)
+
+
+def ifft2(a, s=None, axes=(-2, -1)):
+    return _transform('ifft2', a, s=s, axes=axes)
+
+
+def irfft(a, n=None, axis=-1):
+    return _transform('irfft', a, n=n, axis=axis)
+
+
+def irfft2(a, s=None, axes=(-2, -1), out=None, overwrite_x=False):
+    return _transform('irfft2', a, out=out, overwrite_x=overwrite_x, s=s,
+                      axes=axes)
+
+
+def rfft(a, n=None, axis=-1):
+    return _transform('rfft', a, n=n, axis=axis)
+
+
+def rfft2(a, s=None, axes=(-2, -1), out=None):
+    return _transform('rfft2', a, out=out, s=s, axes=axes)
+
+
+def save_wisdom(filename=None):
+    """
+    Writes the accumulated pyFFTW wisdom to filename, default is the
+    file given to set_backend.
+    """
+    if not filename:
+        filename = _config['wisdom']
+    if not filename or _config['backend'] != 'pyfftw':
+        return
+
+    import pyfftw
+    with open(filename, 'wb') as fh:
+        pickle.dump(pyfftw.export_wisdom(), fh)
+
+
+def set_backend(backend='numpy', workers=None, wisdom=None):
+    """
+    Selects the FFT implementation used by bowpy.
+
+    :param backend: 'numpy', 'scipy' or 'pyfftw'
+    :type backend: string
+
+    :param workers: Number of threads for 'scipy' and 'pyfftw', -1 uses all cores.
+    :type workers: int
+
+    :param wisdom: 'pyfftw' only, path of a wisdom file. Existing wisdom is loaded
+                   and the wisdom is written back on exit of the interpreter.
+    :type wisdom: string
+    """
+    if backend in ('numpy', 'np'):
+        module = np.fft
+        backend = 'numpy'
+
+    elif backend in ('scipy', 'scipy.fft'):
+        import scipy.fft as module
+        backend = 'scipy'
+
+    elif backend in ('pyfftw', 'fftw'):
+        try:
+            import pyfftw
+            import pyfftw.interfaces.scipy_fft as module
+        except ImportError:
+            msg = "Backend 'pyfftw' requires the pyFFTW package"
+            raise ImportError(msg)
+
+        # Keep plans of repeated transforms alive.
+        pyfftw.interfaces.cache.enable()
+        pyfftw.interfaces.cache.set_keepalive_time(60)
+        backend = 'pyfftw'
+
+        if wisdom:
+            if os.path.isfile(wisdom):
+                with open(wisdom, 'rb') as fh:
+                    pyfftw.import_wisdom(pickle.load(fh))
+            if not _config['wisdom']:
+                atexit.register(save_wisdom)
+    else:
+        msg = "Unknown FFT backend '%s', use 'numpy', 'scipy' or 'pyfftw'" % backend
+        raise IOError(msg)
+
+    _config['backend'] = backend
+    _config['module'] = module
+    _config['workers'] = workers
+    _config['wisdom'] = wisdom if backend == 'pyfftw' else None
+
+
+def set_padding(policy='pow2'):
+    """
+    Sets the padding policy of fft_length, 'pow2' or 'fast'.
+    """
+    if policy not in ('pow2', 'nextpow2', 'fast', 'next_fast_len'):
+        msg = "Unknown padding policy '%s', use 'pow2' or 'fast'" % policy
+        raise IOError(msg)
+
+    _config['padding'] = policy
+
+
+def _transform(name, a, out=None, overwrite_x=False, **kwargs):
+    if _config['backend'] != 'numpy':
+        if _config['workers']:
+            kwargs['workers'] = _config['workers']
+        if overwrite_x:
+            kwargs['overwrite_x'] = True
+
+    func = getattr(_config['module'], name)
+    if out is None:
+        return func(a, **kwargs)
+
+    if _config['backend'] == 'numpy' and _NUMPY_OUT:
+        # numpy.fft.irfft2 does not pass out on, the n-dimensional
+        # transforms do
+        res = getattr(np.fft, name.replace('2', 'n'))(a, out=out, **kwargs)
+    else:
+        res = func(a, **kwargs)
+
+    if res is not out:
+        out[...] = res
+
+    return out
@@ -1,23 +1,25 @@
 from __future__ import absolute_import, print_function
 import numpy
 import numpy as np
-import math
 
 import sys
+from functools import lru_cache
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import obspy.signal.filter as obsfilter
-from obspy.taup import TauPyModel
 from obspy.core.event.event import Event
 from obspy import Stream, Trace, Inventory
-from bowpy.util.base import nextpow2, stream2array
+from bowpy.util.base import stream2array, create_filter
+from bowpy.util.fft_backend import fft2, ifft2, rfft2, irfft2, fft_length
 from bowpy.util.array_util import (attach_coordinates_to_traces,
                                    attach_network_to_traces)
 from bowpy.util.picker import pick_data
+from bowpy.util.traveltimes import get_model
 from bowpy.filter.ssa import fx_ssa
 import time
 import scipy as sp
 from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
 
 # If using a Mac Machine, otherwitse comment the next line out:
 mpl.use('TkAgg')
@@ -174,6 +176,58 @@ def create_iFFT2mtx(nx, ny):
     return sparse_iFFT2mtx
 
 
+def create_iFFT2operator(nx, ny, Y=None, T=None):
+    """
+    Matrix-free counterpart of create_iFFT2mtx. Instead of building the NxN
+    matrix, the operator applies ifft2 (matvec) and its adjoint
+    fft2 / N (rmatvec) to the column-wise ordered longvector directly.
+    If given, the diagonals Y (mask) and T (sampling) are applied elementwise,
+    so the operator represents
+
+            A = diags(T) * create_iFFT2mtx(nx, ny) * diags(Y)
+
+    with O(N) memory and O(N log N) operations per matvec.
+
+    :param nx: Number of samples in t-direction (fkDT.shape[0])
+    :type nx: int
+
+    :param ny: Number of traces (fkDT.shape[1])
+    :type ny: int
+
+    :param Y: Column-wise ordered longvector of the mask-function
+    :type Y: numpy.ndarray
+
+    :param T: Column-wise ordered longvector of the sampling-matrix
+    :type T: numpy.ndarray
+
+    returns
+    :param iFFT2op: 2D iFFT operator for the column-wise ordered longvector
+    :type iFFT2op: scipy.sparse.linalg.LinearOperator
+    """
+    N = nx * ny
+
+    if Y is None:
+        Y = np.ones(N)
+    if T is None:
+        T = np.ones(N)
+
+    Y = np.asarray(Y).reshape(ny, nx)
+    T = np.asarray(T).reshape(ny, nx)
+
+    def matvec(x):
+        x = np.asarray(x).reshape(ny, nx)
+        return (T * ifft2(Y * x)).ravel()
+
+    def rmatvec(x):
+        x = np.asarray(x).reshape(ny, nx)
+        return (Y.conj() * fft2(T.conj() * x) / float(N)).ravel()
+
+    iFFT2op = LinearOperator((N, N), matvec=matvec, rmatvec=rmatvec,
+                             dtype='complex')
+
+    return iFFT2op
+
+
 def dcg_solver(A, b, mu,niter,x0=None):
     """
     Damped conjugate gradient solver for Ax = b lstsqs problems, as shown in Tomographic
@@ -359,11 +413,11 @@ def fktrafo(stream, normalize=True):
     ArrayData = stream2array(st_tmp, normalize)
 
     ix = ArrayData.shape[0]
-    iK = int(math.pow(2,nextpow2(ix)))
+    iK = fft_length(ix)
     it = ArrayData.shape[1]
-    iF = int(math.pow(2,nextpow2(it)))
+    iF = fft_length(it)
 
-    fkdata = np.fft.fft2(ArrayData, s=(iK,iF))
+    fkdata = fft2(ArrayData, s=(iK,iF))
 
     return fkdata
 
@@ -375,13 +429,13 @@ def ifktrafo(fkdata, stream, normalize=True):
     """
     StreamData= stream2array(stream)
     ix   = StreamData.shape[0]
-    iK   = int(math.pow(2,nextpow2(ix)))
+    iK   = fft_length(ix)
     it   = StreamData.shape[1]
-    iF   = int(math.pow(2,nextpow2(it)))
+    iF   = fft_length(it)
 
     fk_tmp = fkdata.copy()
 
-    ArrayData = np.fft.ifft2(fkdata, s=(iK,iF))
+    ArrayData = ifft2(fkdata, s=(iK,iF))
     ArrayData = ArrayData[0:ix, 0:it]
 
     return ArrayData
@@ -460,73 +514,80 @@ def makeMask(fkdata, slope, shape, rth=0.4, expl_cutoff=False):
     :type  maskshape: list
 
     :param rth =  Resamplethreshhold, marks the border between 0 and 1 for the resampling
+
+    Masks are cached for each combination of fk-shape, slopes (rounded to
+    6 decimals), shape, rth and expl_cutoff, so repeated calls for the same
+    array geometry and window length return without rebuilding the mask.
+
     Returns
 
     :param W: Mask function W
     """
-    M 			= fkdata.copy()
+    slope = np.round(np.atleast_1d(np.asarray(slope, dtype=float)), 6)
+
+    W = _mask_template(fkdata.shape, tuple(slope), tuple(shape), rth, expl_cutoff)
+
+    return W.copy()
+
+
+@lru_cache(maxsize=64)
+def _mask_template(fkshape, slope, shape, rth, expl_cutoff):
+    """
+    Builds the mask for makeMask. All sheared lobes of the slopes are
+    computed at once with broadcast index arithmetic on the 2x upsampled
+    mask, which is widened along k and resampled to the original size.
+    """
+    slope 		= np.array(slope)
+    nk 			= fkshape[0]
+    nf 			= 2 * fkshape[1]
 
     # Because of resolution issues, upsampling to double size
-    pnorm 		= 1/2. * ( float(M.shape[0]+1)/float(2. * M.shape[1]) )
+    pnorm 		= 1/2. * ( float(nk+1)/float(nf) )
 
     prange 		= slope * pnorm
-    Mask 		= np.zeros((M.shape[0], 2.*M.shape[1]))
-    maskshape 	= np.zeros((M.shape[0], 2.*M.shape[1]))
-    W 			= np.zeros((M.shape[0], 2.*M.shape[1]))
     name 		= shape[0]
     arg 		= shape[1]
 
-    if name in ['butterworth', 'Butterworth', 'taper', 'Taper']:
+    # Shift of each lobe for every slope and frequency, rows: slopes, columns: f
+    fshift 		= np.trunc(np.outer(prange, np.arange(nf))).astype(int)
+
+    if name in ['boxcar']:
+        W = np.zeros((nk, nf))
+        W[np.mod(fshift, nk), np.arange(nf)] = 1.
+        if np.any(prange == 0.):
+            W[1,:] = 1.
+            W[nk-1,:] = 1.
+
+        # Convolving each frequency slice of the mask with a boxcar
+        # of size L. Widens the the maskfunction along k-axis.
+        if arg:
+            L = int(arg)
+        else:
+            L = slope.size
+        csum = np.zeros((nk+1, nf))
+        csum[1:] = np.cumsum(W, axis=0)
+        lower = np.clip(np.arange(nk) - L//2, 0, nk)
+        upper = np.clip(np.arange(nk) + (L-1)//2 + 1, 0, nk)
+        W = (csum[upper] - csum[lower] > 0).astype(float)
+
+    else:
         if not expl_cutoff:
             cutoff 	= slope.size/2
         else:
             cutoff 	= expl_cutoff
 
         if cutoff < 1: cutoff = 1
-        maskshape_tmp 	= create_filter(name, Mask.shape[0]/2, cutoff, arg)
-        maskshape_lh 	= np.tile(maskshape_tmp, Mask.shape[1]).reshape(Mask.shape[1], maskshape_tmp.size).transpose()
-        maskshape_rh 	= np.flipud(maskshape_lh)
-
-        maskshape[:maskshape.shape[0]/2,:] = maskshape_lh
-        maskshape[maskshape.shape[0]/2:,:] = maskshape_rh
-
-
-    for m in prange:
-        if m == 0.:
-            Mask[0,:] = 1.
-            Mask[1,:] = 1.
-            Mask[Mask.shape[0]-1,:] = 1.
-
-        for f in range(Mask.shape[1]):
-            Mask[:,f] = np.roll(Mask[:,f], -int(math.floor(f*m)))
-
-        if name in ['boxcar']:
-            Mask[0,:] = 1.
-        else:
-            Mask = maskshape.copy()
-
-        for f in range(Mask.shape[1]):
-            Mask[:,f] = np.roll(Mask[:,f], int(f*m))
-
-        W += Mask
-        Mask =  np.zeros((M.shape[0], 2.*M.shape[1]))
-
-    # Convolving each frequency slice of the mask with a boxcar
-    # of size L. Widens the the maskfunction along k-axis.
-    if name in ['boxcar']:
-        if arg:
-            b = sp.signal.boxcar(arg)
-        else:
-            b = sp.signal.boxcar(slope.size)
-        for i, fslice in enumerate(W.conj().transpose()):
-            W[:,i] = sp.signal.convolve(fslice, b, mode=1)
-
-        W[np.where(W!=0)]=1.
+        # Half of the taper, mirrored to length nk; for odd nk the middle
+        # sample is not repeated.
+        maskshape_tmp 	= create_filter(name, nk - nk//2, cutoff, arg)
+        maskshape 		= np.hstack((maskshape_tmp, maskshape_tmp[nk//2-1::-1]))
 
-        W[np.where(W > 1.)]=1.
+        # Every column of maskshape is rolled by the shift of the lobe.
+        kidx = np.mod(np.arange(nk)[np.newaxis,:,np.newaxis] - fshift[:,np.newaxis,:], nk)
+        W = maskshape[kidx].sum(axis=0)
 
     # Resample it to original size
-    Wr = np.flipud(sp.signal.resample(W, M.shape[1], axis=1))
+    Wr = np.flipud(sp.signal.resample(W, fkshape[1], axis=1))
     Wr[ np.where(Wr > 1 ) ] = 1.
     Wr[ np.where(Wr < 0 ) ] = 0.
     if name in ['boxcar']:
@@ -534,12 +595,13 @@ def makeMask(fkdata, slope, shape, rth=0.4, expl_cutoff=False):
         Wr[ np.where(Wr < rth ) ] = 0.
 
 
-    Wlhs	= np.roll(Wr[:,0:Wr.shape[1]/2-1], shift=1, axis=0)
-    Wrhs	= Wr[:,1:Wr.shape[1]/2+1]
+    Wlhs	= np.roll(Wr[:,0:Wr.shape[1]//2-1], shift=1, axis=0)
+    Wrhs	= Wr[:,1:Wr.shape[1]//2+1]
     Wrhs 	= np.roll(np.flipud(np.fliplr(Wrhs)), shift=0, axis=0)
 
-    Wr[:,0:Wr.shape[1]/2-1] = Wlhs
-    Wr[:,Wr.shape[1]/2:] = Wrhs
+    Wr[:,0:Wr.shape[1]//2-1] = Wlhs
+    Wr[:,Wr.shape[1]//2:] = Wrhs
+    Wr.flags.writeable = False
     return Wr
 
 
@@ -698,7 +760,7 @@ def plot(st, inv=None, event=None, zoom=1, yinfo=False, stationlabel=True, epidi
                 origin = st[0].stats.origin
                 depth = st[0].stats.depth
 
-            m = TauPyModel('ak135')
+            m = get_model('ak135')
 
 
 
@@ -979,7 +1041,7 @@ def plot(st, inv=None, event=None, zoom=1, yinfo=False, stationlabel=True, epidi
                 origin = st.stats.origin
                 depth = st.stats.depth
 
-            m = TauPyModel('ak135')
+            m = get_model('ak135')
             arrivals = m.get_travel_times(depth, y_dist, phase_list=markphases)
             timetable = [ [], [] ]
             for k, phase in enumerate(arrivals):
@@ -1117,7 +1179,8 @@ def plotfk(data, fs=15, savefig=False, dpi=400, logscale=False, hold=False, cmap
             plt.show()
 
 
-def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='denoise', peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, overlap=0.5, plotfeedback=False):
+def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='denoise', peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, overlap=0.5, plotfeedback=False,
+         ssa_batched=False, ssa_workers=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros. It applies the projection onto convex sets (pocs) algorithm in
@@ -1144,6 +1207,12 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
     :param maskshape: Shape of the corners of mask, see makemask
 
+    :param ssa_batched: 'ssa' only, stacked SVD over frequencies, see fx_ssa
+    :type  ssa_batched: bool
+
+    :param ssa_workers: 'ssa' only, number of threads for the frequencies, see fx_ssa
+    :type  ssa_workers: int
+
     returns:
 
     :param datap:
@@ -1155,10 +1224,10 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
     ArrayData 	= data.copy()
     ix = ArrayData.shape[0]
-    iK = int(math.pow(2,nextpow2(ix)))
+    iK = fft_length(ix)
     it = ArrayData.shape[1]
-    iF = int(math.pow(2,nextpow2(it)))
-    fkdata = np.fft.fft2(ArrayData, s=(iK,iF))
+    iF = fft_length(it)
+    fkdata = fft2(ArrayData, s=(iK,iF))
     threshold = abs(fkdata.max())
 
     ADold = ArrayData.copy()
@@ -1178,15 +1247,15 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
                     for i in range(maxiter):
                         data_tmp 	= ADtemp.copy()
-                        fkdata 		= np.fft.fft2(data_tmp, s=(iK,iF))
+                        fkdata 		= fft2(data_tmp, s=(iK,iF))
                         fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
 
                         if method in ('linear'):
                             threshold 	= threshold * alpha
                         elif method in ('exp'):
-                            threshold 	= threshold * sp.exp(-(i+1) * alpha)
+                            threshold 	= threshold * np.exp(-(i+1) * alpha)
 
-                        data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
+                        data_tmp 	= ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
                         ADtemp[noft] 	= data_tmp[noft][:,curr_win:curr_win+w_length].copy()
 
 
@@ -1198,7 +1267,7 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
                         ADfinal[:,curr_win-int(overlap*w_length):int(curr_win)] = ( ADold[:,int((1-overlap)*w_length):] + ADtemp[:,:int(overlap*w_length)] ) / 2.
 
                     ADold = ADtemp.copy()
-                    threshold = abs(np.fft.fft2(ADold, s=(iK,iF)).max())
+                    threshold = abs(fft2(ADold, s=(iK,iF)).max())
 
                     loc += overlap * w_length
                     print(loc)
@@ -1229,18 +1298,36 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
                 # threshold = abs(np.fft.fft2(ADfinal, s=(iK,iF)).max())
 
             elif dmethod in ('reconstruct', 'Reconstruct'):
-                ADtemp = ArrayData.copy()
+                # The gathers are real, so the iterations work on the half spectrum
+                # (rfft2/irfft2). Spectrum, magnitude, mask and output are allocated
+                # once and written with out=. ADtemp is a view into the zero-padded
+                # buffer, hence the padding is never copied.
+                ADpad 	= np.zeros((iK, iF))
+                ADtemp 	= ADpad[0:ix, 0:it]
+                ADtemp[:] = ArrayData
+                ADinv 	= np.empty((iK, iF))
+                data_tmp = ADinv[0:ix, 0:it]
+                fkhalf 	= np.empty((iK, iF//2+1), dtype=complex)
+                fkmag 	= np.empty((iK, iF//2+1))
+                fkkeep 	= np.empty((iK, iF//2+1), dtype=bool)
+
+                # Threshold of the half spectrum, so that its largest value is kept
+                rfft2(ADpad, out=fkhalf)
+                threshold = abs(fkhalf.max())
+
                 for i in range(maxiter):
-                    data_tmp 	= ADtemp.copy()
-                    fkdata 		= np.fft.fft2(data_tmp, s=(iK,iF))
-                    fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
+                    if i > 0:
+                        rfft2(ADpad, out=fkhalf)
+                    np.abs(fkhalf, out=fkmag)
+                    np.greater_equal(fkmag, threshold, out=fkkeep)
+                    np.multiply(fkhalf, fkkeep, out=fkhalf)
+                    irfft2(fkhalf, s=(iK,iF), out=ADinv, overwrite_x=True)
 
                     if method in ('linear'):
                         threshold 	= threshold * alpha
                     elif method in ('exp'):
-                        threshold 	= threshold * sp.exp(-(i+1) * alpha)
+                        threshold 	= threshold * np.exp(-(i+1) * alpha)
 
-                    data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
                     ADtemp[noft] 	= data_tmp[noft]
                     if plotfeedback:
                         print('plotting')
@@ -1250,7 +1337,7 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
                 ADfinal = ADtemp.copy()
 
-                threshold = abs(np.fft.fft2(ADfinal, s=(iK,iF)).max())
+                threshold = abs(fft2(ADfinal, s=(iK,iF)).max())
 
 
 
@@ -1259,13 +1346,13 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
         ADfinal = ArrayData.copy()
         for n in noft:
             ADtemp 	= ArrayData.copy()
-            threshold = abs(W*np.fft.fft2(ADfinal, s=(iK,iF))).max()
+            threshold = abs(W*fft2(ADfinal, s=(iK,iF))).max()
             for i in range(maxiter):
                 data_tmp 	=ADtemp.copy()
-                fkdata 		= W * np.fft.fft2(data_tmp, s=(iK,iF))
+                fkdata 		= W * fft2(data_tmp, s=(iK,iF))
                 fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
                 threshold 	= threshold * alpha
-                data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
+                data_tmp 	= ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
                 ADtemp[n] 	= data_tmp[n]
 
             ADfinal[n] = ADtemp[n].copy()
@@ -1275,23 +1362,24 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
         for n in noft:
             for i in range(maxiter):
                 data_tmp 		= ArrayData.copy()
-                data_ssa 		= fx_ssa(data_tmp,dt,p,flow,fhigh)
+                data_ssa 		= fx_ssa(data_tmp,dt,p,flow,fhigh,batched=ssa_batched,
+                                         nworkers=ssa_workers)
                 ArrayData 		= alpha * ArrayData
                 ArrayData[n] 	= (1. - alpha) * data_ssa[n]
 
             ADfinal[n] = ArrayData[n].copy()
 
     elif method in ('average'):
-        threshold = beta * abs(np.fft.fft2(ArrayData, s=(iK,iF)).max())
+        threshold = beta * abs(fft2(ArrayData, s=(iK,iF)).max())
         ADtemp = ArrayData.copy()
         for n in noft:
             for i in range(maxiter):
                 data_tmp 	= ADtemp.copy()
-                fkdata 		= np.fft.fft2(data_tmp, s=(iK,iF))
+                fkdata 		= fft2(data_tmp, s=(iK,iF))
                 fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
 
-                ADtemp 		= alpha*data_tmp + (1. - alpha) * np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it]
-                ADtemp[n] 	= (1. - alpha) * np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it][n]
+                ADtemp 		= alpha*data_tmp + (1. - alpha) * ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it]
+                ADtemp[n] 	= (1. - alpha) * ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it][n]
 
             ADfinal = ADtemp.copy()
 
@@ -1304,8 +1392,8 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
             for i in range(maxiter):
                 W 			= makeMask(fkdata, peaks, shape=maskshape, expl_cutoff=i)
                 data_tmp 	= ADtemp.copy()
-                fkdata 		= W * np.fft.fft2(data_tmp, s=(iK,iF))
-                data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
+                fkdata 		= W * fft2(data_tmp, s=(iK,iF))
+                data_tmp 	= ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
                 ADtemp[n]	= alpha * ArrayData[n].copy()
                 ADtemp[n]  += (1. - alpha) * data_tmp[n]
 
@@ -1320,6 +1408,99 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
     return datap
 
 
+def pocs_batch(data, maxiter, noft, alpha=0.9, method='linear', batchsize=None):
+    """
+    Batched version of the pocs reconstruction (dmethod='reconstruct', method 'linear'
+    or 'exp') for a stack of equally shaped gathers. The threshold and projection steps
+    are applied to the whole (event x trace x time) cube at once, using fft2 over the
+    last two axes.
+
+    Reference: 3D interpolation of irregular data with a POCS algorithm, Abma & Kabir, 2006
+
+    :param data: Stack of gathers, missing traces filled with zeros
+    :type  data: numpy.ndarray, shape (events, traces, samples)
+
+    :param maxiter: Number of iterations, for all events or for each event
+    :type  maxiter: int or array-like
+
+    :param noft: Missing traces of each event, either as boolean mask of shape
+                 (events, traces) or as a list with a list of trace indices for each event
+    :type  noft: numpy.ndarray or list
+
+    :param alpha: Factor of threshold decrease after each iteration, for all events or
+                  for each event
+    :type  alpha: float or array-like
+
+    :param method: Threshold decrease, 'linear' or 'exp'
+    :type  method: string
+
+    :param batchsize: Number of events transformed at once, default is all events.
+                      Limits the memory used by the spectra.
+    :type  batchsize: int
+
+    returns:
+
+    :param datap: Reconstructed gathers
+    :type  datap: numpy.ndarray, shape (events, traces, samples)
+    """
+    if method not in ('linear', 'exp'):
+        msg = "method has to be 'linear' or 'exp'"
+        raise IOError(msg)
+
+    datap 	= np.array(data, dtype='float', copy=True)
+    if datap.ndim != 3:
+        msg = 'data has to be a 3D array of shape (events, traces, samples)'
+        raise IOError(msg)
+
+    nev, ix, it = datap.shape
+    iK = fft_length(ix)
+    iF = fft_length(it)
+
+    if isinstance(noft, np.ndarray) and noft.dtype == bool:
+        recon = noft.copy()
+    else:
+        recon = np.zeros((nev, ix), dtype=bool)
+        for i, traces in enumerate(noft):
+            recon[i, list(traces)] = True
+
+    maxiter = np.broadcast_to(np.asarray(maxiter, dtype=int), (nev,))
+    alpha 	= np.broadcast_to(np.asarray(alpha, dtype=float), (nev,))
+
+    if not batchsize:
+        batchsize = nev
+
+    for start in range(0, nev, batchsize):
+        ev 		= slice(start, min(start + batchsize, nev))
+        cube 	= datap[ev]		# view, updated in place
+        mask 	= recon[ev]
+        niter 	= maxiter[ev]
+        a 		= alpha[ev]
+
+        # Initial threshold of each event, taken as in pocs.
+        fkdata 		= fft2(cube, s=(iK,iF), axes=(-2,-1))
+        threshold 	= np.array([abs(fkmax) for fkmax in fkdata.reshape(fkdata.shape[0], -1).max(axis=1)])
+
+        for i in range(niter.max()):
+            active = np.where(niter > i)[0]
+            if active.size == cube.shape[0]:
+                fkdata 	= fft2(cube, s=(iK,iF), axes=(-2,-1))
+            else:
+                fkdata 	= fft2(cube[active], s=(iK,iF), axes=(-2,-1))
+
+            fkdata *= abs(fkdata) >= threshold[active, np.newaxis, np.newaxis]
+
+            if method in ('linear'):
+                threshold[active] 	= threshold[active] * a[active]
+            elif method in ('exp'):
+                threshold[active] 	= threshold[active] * np.exp(-(i+1) * a[active])
+
+            data_tmp 	= ifft2(fkdata, axes=(-2,-1)).real[:, 0:ix, 0:it]
+            sub 		= mask[active]
+            cube[active] = np.where(sub[:,:,np.newaxis], data_tmp, cube[active])
+
+    return datap
+
+
 def shift_array(array, shift_value=0, y_dist=False):
     array_shift = array
     try:
@@ -1331,7 +1512,8 @@ def shift_array(array, shift_value=0, y_dist=False):
     return(array_shift)
 
 
-def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0, smoothing=False, interactive=False):
+def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0, smoothing=False, interactive=False,
+                       cache=True):
     """
     Generates a distribution of slopes in a range given in prange.
     Needs fkdata as input.
@@ -1374,6 +1556,10 @@ def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0,
     :param interactive: If True, picking by hand is enabled.
     :type interactive: boolean
 
+    :param cache: If True, the index table of the sheared lines is cached
+                  for each combination of fk-shape and slope grid.
+    :type cache: boolean
+
     returns:
 
     :param MD: Magnitude distribution of the slopes p
@@ -1388,29 +1574,19 @@ def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0,
     """
 
     M = fkdata.copy()
-    Mt = M.conj().transpose()
-    fk_shift =	np.zeros(M.shape).astype('complex')
-
-    pnorm = 1/2. * ( float(M.shape[0])/float(M.shape[1]) )
 
     pmin = prange[0]
     pmax = prange[1]
-    N = abs(pmax - pmin) / pdelta + 1
-    MD = np.zeros(N)
+    N = int(round(abs(pmax - pmin) / pdelta)) + 1
     srange = np.linspace(pmin,pmax,N)
 
-    rend = float( len(srange) )
-    for i, delta in enumerate(srange):
-
-        p = delta*pnorm
-        for j, trace in enumerate(Mt):
-            shift = int(math.floor(p*j))
-            fk_shift[:,j] = np.roll(trace, shift)
-        MD[i] = sum(abs(fk_shift[0,:])) / len(fk_shift[0,:])
-
-        prcnt = 100*(i+1) / rend
-        print("%i %% done" % prcnt, end="\r")
-        sys.stdout.flush()
+    # Gather |fk| along the sheared lines of all slopes at once, the row
+    # index for slope i and column j is -floor(p_i * j) mod k.
+    if cache:
+        kidx = _slope_index_table(M.shape, pmin, pmax, N)
+    else:
+        kidx = _slope_index_table.__wrapped__(M.shape, pmin, pmax, N)
+    MD = abs(M)[kidx, np.arange(M.shape[1])].mean(axis=1)
 
     if interactive:
 
@@ -1445,3 +1621,19 @@ def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0,
         else:
             peaks = peaks_tmp
     return MD, srange, peaks
+
+
+@lru_cache(maxsize=32)
+def _slope_index_table(shape, pmin, pmax, N):
+    """
+    Returns the k-indices of the sheared lines for all slopes of the grid
+    linspace(pmin, pmax, N) in a f-k spectrum of shape (k, f), as used
+    by slope_distribution. The table has the shape (N, f).
+    """
+    pnorm = 1/2. * ( float(shape[0])/float(shape[1]) )
+    p = np.linspace(pmin, pmax, N) * pnorm
+    shift = np.floor(np.outer(p, np.arange(shape[1]))).astype(int)
+    kidx = np.mod(-shift, shape[0])
+    kidx.flags.writeable = False
+
+    return kidx
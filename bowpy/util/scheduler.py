@@ -0,0 +1,134 @@
+from __future__ import absolute_import, print_function
+from collections import deque
+import numpy as np
+
+"""
+Scheduler for sliding-window analyses of long continuous records.
+
+The windows of an analysis are given by their sample offsets into a station
+matrix (stations x samples). map_windows splits the offsets into batches and
+runs a window function on each batch, either in the calling process or on a
+process pool. With a pool, the station matrix is copied once into shared
+memory and read zero-copy by all workers. Results are always returned in
+time order.
+
+Example:
+            for result in map_windows(func, stmatrix, offsets, params,
+                                      nworkers=8):
+                ...
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+_worker = {}
+
+
+def map_windows(func, stmatrix, offsets, params, nworkers=None, batchsize=None):
+    """
+    Applies func(stmatrix, offsets_batch, params) to batches of window offsets
+    and yields the results of the single windows in time order.
+
+    :param func: Window function, returns a sequence with one result per offset
+                 of the batch. With nworkers > 1 it has to be a module level
+                 function, as it is sent to the workers by reference.
+    :type func: function
+
+    :param stmatrix: Station matrix, the data of all windows
+    :type stmatrix: numpy.ndarray
+
+    :param offsets: Sample offsets of the windows, in time order
+    :type offsets: array_like
+
+    :param params: Further arguments of func, picklable with nworkers > 1
+    :type params: dict
+
+    :param nworkers: Number of worker processes, None or 1 runs func in the
+                     calling process
+    :type nworkers: int
+
+    :param batchsize: Number of windows per call of func, default is 64 or
+                      fewer, to give each worker at least 4 batches
+    :type batchsize: int
+
+    returns:
+
+    Generator of the results of all windows, in order of offsets.
+    """
+    offsets = np.asarray(offsets)
+    nwin = offsets.size
+    if nwin == 0:
+        return
+
+    if not batchsize:
+        batchsize = 64
+        if nworkers and nworkers > 1:
+            batchsize = min(batchsize, max(1, -(-nwin // (4 * nworkers))))
+    batches = [offsets[i:i + batchsize] for i in range(0, nwin, batchsize)]
+
+    if not nworkers or nworkers <= 1:
+        for batch in batches:
+            for result in func(stmatrix, batch, params):
+                yield result
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    stmatrix = np.ascontiguousarray(stmatrix)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, stmatrix.nbytes))
+    shared = None
+    try:
+        shared = np.ndarray(stmatrix.shape, dtype=stmatrix.dtype, buffer=shm.buf)
+        shared[...] = stmatrix
+
+        with ProcessPoolExecutor(nworkers, initializer=_init_worker,
+                                 initargs=(shm.name, stmatrix.shape,
+                                           stmatrix.dtype.str)) as pool:
+            # Keep at most two batches per worker in flight
+            pending = deque()
+            batches = iter(batches)
+            for batch in batches:
+                pending.append(pool.submit(_run_batch, func, batch, params))
+                if len(pending) >= 2 * nworkers:
+                    break
+
+            while pending:
+                results = pending.popleft().result()
+                for batch in batches:
+                    pending.append(pool.submit(_run_batch, func, batch, params))
+                    break
+                for result in results:
+                    yield result
+    finally:
+        # the buffer can only be released without views on it
+        shared = None
+        shm.close()
+        shm.unlink()
+
+
+def _init_worker(name, shape, dtype):
+    from multiprocessing import shared_memory
+
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+    stmatrix = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    stmatrix.flags.writeable = False
+
+    _worker['shm'] = shm
+    _worker['stmatrix'] = stmatrix
+
+
+def _run_batch(func, offsets, params):
+    return list(func(_worker['stmatrix'], offsets, params))
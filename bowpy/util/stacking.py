@@ -0,0 +1,309 @@
+from __future__ import absolute_import, print_function
+import numpy as np
+from scipy.signal import hilbert
+
+"""
+Stacking kernels for seismological array data: linear, Nth-root and
+phase-weighted stacks along an arbitrary axis of an N-D array, and
+segment_stack for many stacks of consecutive rows at once.
+
+The axis kernels take an optional weights vector (one weight per element
+along the stacking axis) and an out buffer of the shape of the result.
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+_numba_kernel = None
+
+
+def linear_stack(data, axis=0, weights=None, out=None):
+    """
+    Linear (weighted) mean of data along axis.
+
+    :param data: Array of data, that should be stacked.
+    :type data: array_like
+
+    :param axis: Axis to stack over, e.g. the trace axis.
+    :type axis: int
+
+    :param weights: Weight of each element along axis
+    :type weights: array_like
+
+    :param out: Array for the result, shape of data without axis
+    :type out: numpy.ndarray
+
+    returns:
+
+    :param v: Stack
+    :type v: numpy.ndarray
+    """
+    data = np.asarray(data)
+    if weights is None:
+        return np.mean(data, axis=axis, out=out)
+
+    w = _expand_weights(weights, data, axis)
+    v = np.sum(w * data, axis=axis, out=out)
+    v /= w.sum()
+
+    return v
+
+
+def nthroot_stack(data, order, axis=0, weights=None, out=None, engine='numpy'):
+    """
+    Nth-root stack of data along axis,
+
+            v = sign(r) * |r|^N,   r = 1/n sum( sign(x_i) * |x_i|^(1/N) )
+
+    :param data: Array of data, that should be stacked.
+    :type data: array_like
+
+    :param order: Order N of the stack
+    :type order: float
+
+    :param axis: Axis to stack over, e.g. the trace axis.
+    :type axis: int
+
+    :param weights: Weight of each element along axis
+    :type weights: array_like
+
+    :param out: Array for the result, shape of data without axis
+    :type out: numpy.ndarray
+
+    :param engine: 'numpy' or 'numba', the latter uses a jitted loop and requires numba.
+    :type engine: string
+
+    returns:
+
+    :param v: Stack
+    :type v: numpy.ndarray
+
+    Reference: Rost, S. & Thomas, C. (2002). Array seismology: Methods and Applications
+    """
+    data = np.asarray(data, dtype='float')
+    order = float(order)
+
+    if engine in ('numba',):
+        return _nthroot_stack_numba(data, order, axis, weights, out)
+    elif engine not in ('numpy',):
+        msg = "Unknown engine '%s', use 'numpy' or 'numba'" % engine
+        raise IOError(msg)
+
+    dataNth = np.sign(data) * abs(data) ** (1. / order)
+    vNth = linear_stack(dataNth, axis=axis, weights=weights, out=out)
+    if out is None:
+        return np.sign(vNth) * abs(vNth) ** order
+
+    np.multiply(np.sign(out), abs(out) ** order, out=out)
+
+    return out
+
+
+def phase_coherence(data, axis=0, weights=None, time_axis=-1):
+    """
+    Instantaneous phase coherence of data along axis,
+
+            c = | 1/n sum( exp(i * phi_i) ) |
+
+    with phi_i the phase of the analytic signal of each trace along time_axis.
+
+    :param data: Array of data
+    :type data: array_like
+
+    :param axis: Axis to stack over, e.g. the trace axis.
+    :type axis: int
+
+    :param weights: Weight of each element along axis
+    :type weights: array_like
+
+    :param time_axis: Time axis of data
+    :type time_axis: int
+
+    returns:
+
+    :param c: Coherence between 0 and 1, shape of data without axis
+    :type c: numpy.ndarray
+
+    Reference: Schimmel, M. & Paulssen, H. (1997). Noise reduction and detection of weak,
+               coherent signals through phase-weighted stacks, GJI
+    """
+    data = np.asarray(data, dtype='float')
+    analytic = np.exp(1j * np.angle(hilbert(data, axis=time_axis)))
+
+    if weights is None:
+        c = abs(np.mean(analytic, axis=axis))
+    else:
+        w = _expand_weights(weights, data, axis)
+        c = abs(np.sum(w * analytic, axis=axis)) / w.sum()
+
+    return c
+
+
+def phase_weighted_stack(data, order=1, axis=0, weights=None, out=None, time_axis=-1):
+    """
+    Phase-weighted stack of data along axis, the linear stack weighted by the
+    instantaneous phase coherence c to the power of order (see phase_coherence),
+
+            v = 1/n sum( x_i ) * c^order
+
+    :param data: Array of data, that should be stacked.
+    :type data: array_like
+
+    :param order: Power of the coherence
+    :type order: float
+
+    :param axis: Axis to stack over, e.g. the trace axis.
+    :type axis: int
+
+    :param weights: Weight of each element along axis
+    :type weights: array_like
+
+    :param out: Array for the result, shape of data without axis
+    :type out: numpy.ndarray
+
+    :param time_axis: Time axis of data, must differ from axis
+    :type time_axis: int
+
+    returns:
+
+    :param v: Stack
+    :type v: numpy.ndarray
+
+    Reference: Schimmel, M. & Paulssen, H. (1997). Noise reduction and detection of weak,
+               coherent signals through phase-weighted stacks, GJI
+    """
+    data = np.asarray(data, dtype='float')
+    if axis % data.ndim == time_axis % data.ndim:
+        msg = 'axis and time_axis have to differ'
+        raise IOError(msg)
+
+    c = phase_coherence(data, axis=axis, weights=weights, time_axis=time_axis)
+    v = linear_stack(data, axis=axis, weights=weights, out=out)
+    v *= c ** order
+
+    return v
+
+
+def segment_stack(data, offsets, order=None):
+    """
+    Stacks of consecutive segments of rows, data[offsets[k]:offsets[k + 1]]
+    (the last segment ends with data), all at once with np.add.reduceat.
+    Linear for order None, else Nth-root (see nthroot_stack). Empty
+    segments give zeros.
+
+    :param data: Array of data, rows are stacked
+    :type data: array_like, shape (n, ...)
+
+    :param offsets: Start row of each segment, non-decreasing
+    :type offsets: array_like of int
+
+    :param order: Order N of the Nth-root stack, None for a linear stack
+    :type order: float
+
+    returns:
+
+    :param v: Stack of each segment
+    :type v: numpy.ndarray, shape (len(offsets), ...)
+
+    :param fold: Number of rows of each segment
+    :type fold: numpy.ndarray of int
+    """
+    data = np.asarray(data, dtype='float')
+    offsets = np.asarray(offsets, dtype='int')
+    fold = np.diff(np.append(offsets, data.shape[0]))
+    if np.any(fold < 0):
+        msg = 'offsets have to be non-decreasing'
+        raise IOError(msg)
+
+    v = np.zeros((offsets.size,) + data.shape[1:])
+    full = fold > 0
+    if not full.any():
+        return v, fold
+
+    if order is not None:
+        order = float(order)
+        data = np.sign(data) * abs(data) ** (1. / order)
+
+    # reduceat of an empty segment returns a row, reduce the others only
+    shape = (-1,) + (1,) * (data.ndim - 1)
+    v[full] = np.add.reduceat(data, offsets[full], axis=0) / fold[full].reshape(shape)
+
+    if order is not None:
+        v = np.sign(v) * abs(v) ** order
+
+    return v, fold
+
+
+def _expand_weights(weights, data, axis):
+    w = np.asarray(weights, dtype='float')
+    if w.size != data.shape[axis]:
+        msg = 'Number of weights does not match data.shape[axis]'
+        raise IOError(msg)
+    shape = [1] * data.ndim
+    shape[axis] = w.size
+
+    return w.reshape(shape)
+
+
+def _nthroot_kernel(data, weights, order, out):
+    n, m = data.shape
+    root = 1. / order
+    acc = np.zeros(m)
+    for i in range(n):
+        for j in range(m):
+            x = data[i, j]
+            if x > 0:
+                acc[j] += weights[i] * x ** root
+            elif x < 0:
+                acc[j] -= weights[i] * (-x) ** root
+    wsum = 0.
+    for i in range(n):
+        wsum += weights[i]
+    for j in range(m):
+        r = acc[j] / wsum
+        if r >= 0:
+            out[j] = r ** order
+        else:
+            out[j] = -((-r) ** order)
+
+
+def _nthroot_stack_numba(data, order, axis, weights, out):
+    global _numba_kernel
+    if _numba_kernel is None:
+        try:
+            import numba
+        except ImportError:
+            msg = "engine='numba' requires the numba package"
+            raise ImportError(msg)
+        _numba_kernel = numba.njit(cache=True)(_nthroot_kernel)
+
+    data2d = np.moveaxis(data, axis, 0)
+    shape = data2d.shape[1:]
+    data2d = np.ascontiguousarray(data2d.reshape(data2d.shape[0], -1))
+
+    if weights is None:
+        w = np.ones(data2d.shape[0])
+    else:
+        w = np.asarray(weights, dtype='float')
+        if w.size != data2d.shape[0]:
+            msg = 'Number of weights does not match data.shape[axis]'
+            raise IOError(msg)
+
+    v = np.empty(data2d.shape[1])
+    _numba_kernel(data2d, w, order, v)
+    v = v.reshape(shape)
+
+    if out is not None:
+        out[...] = v
+        return out
+
+    return v
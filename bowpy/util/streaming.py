@@ -0,0 +1,350 @@
+from __future__ import absolute_import, print_function
+from collections import deque
+import math
+import warnings
+import numpy as np
+from obspy import Trace
+from scipy.signal.windows import tukey
+
+from bowpy.util.beamformer import capon_inverse, cross_spectral_matrix, \
+    generalized_beamformer, steering_vectors
+from bowpy.util.fft_backend import rfft, fft_length
+
+"""
+Streaming f-k analysis of continuous array data.
+
+Trace chunks, e.g. packets of a SeedLink client or of replay_stream, are
+appended to a StreamingArrayProcessor. Each station is held in a RingBuffer
+of bounded size. The data are cut into segments of one window step; each
+segment is demeaned, tapered and transformed once, and its cross-spectral
+density matrix is kept until it leaves the sliding window. The matrix of a
+window is the sum over its segments (Welch estimate), so consecutive
+windows share the transforms of their overlap. Beam power, backazimuth and
+slowness are returned as soon as a window is complete.
+
+Example:
+            proc = StreamingArrayProcessor(ids, time_shift_table, sll_x,
+                                           sll_y, sl_s, fs, frqlow, frqhigh,
+                                           win_len)
+            for chunk in replay_stream(stream, 1.):
+                for row in proc.append(chunk):
+                    print(row)
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+
+class RingBuffer(object):
+    """
+    FIFO buffer of a fixed number of samples, addressed by absolute sample
+    index.
+
+    :param capacity: Maximum number of samples held
+    :type capacity: int
+
+    :param start: Absolute index of the first sample
+    :type start: int
+    """
+    def __init__(self, capacity, start=0, dtype='f8'):
+        self.capacity = int(capacity)
+        self.start = int(start)
+        self.end = int(start)
+        self._data = np.zeros(self.capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, samples):
+        """
+        Appends samples after the newest sample.
+        """
+        samples = np.asarray(samples)
+        n = samples.size
+        if len(self) + n > self.capacity:
+            msg = 'RingBuffer overflow, %i samples do not fit' % n
+            raise IOError(msg)
+
+        i0 = self.end % self.capacity
+        n0 = min(n, self.capacity - i0)
+        self._data[i0:i0 + n0] = samples[:n0]
+        self._data[:n - n0] = samples[n0:]
+        self.end += n
+
+    def discard(self, index):
+        """
+        Drops all samples before the absolute index.
+        """
+        self.start = max(self.start, min(int(index), self.end))
+
+    def read(self, index, n):
+        """
+        Returns a copy of the n samples starting at the absolute index.
+        """
+        if index < self.start or index + n > self.end:
+            msg = 'Samples %i to %i are not in the buffer' % (index, index + n)
+            raise IOError(msg)
+
+        i0 = index % self.capacity
+        n0 = min(n, self.capacity - i0)
+
+        return np.concatenate((self._data[i0:i0 + n0], self._data[:n - n0]))
+
+
+class StreamingArrayProcessor(object):
+    """
+    Incremental f-k analysis (Bartlett or Capon) of continuous array data,
+    see array_processing in bowpy.misc.Muenster_Array_Seismology.
+
+    :param ids: Trace ids of the stations, in the order of time_shift_table
+    :type ids: list of strings
+
+    :param time_shift_table: Time shifts of the slowness grid, as returned by
+                             get_timeshift
+    :type time_shift_table: numpy.ndarray, shape (nstat, grdpts_x, grdpts_y)
+
+    :param sll_x: slowness x min (lower)
+    :param sll_y: slowness y min (lower)
+    :param sl_s: slowness step
+
+    :param fs: Sampling rate of all traces
+    :type fs: float
+
+    :param frqlow: lower frequency for fk/capon
+    :param frqhigh: higher frequency for fk/capon
+
+    :param win_len: Sliding window length in seconds
+    :type win_len: float
+
+    :param win_frac: Fraction of win_len to step forward, the window is
+                     made of round(1 / win_frac) segments of one step
+    :type win_frac: float
+
+    :param method: 0 == bf, 1 == capon
+    :type method: int
+
+    :param prewhiten: Do prewhitening, values: 1 or 0
+    :type prewhiten: int
+
+    :param diag_load: Diagonal loading of the cross-spectral density matrix
+    :type diag_load: float
+
+    :param starttime: Start of the first window, default is the start of
+                      the first chunk
+    :type starttime: UTCDateTime
+
+    :param buffer_len: Length of the ring buffers in seconds, bounds how far
+                       stations may run ahead of each other, default
+                       10 * win_len
+    :type buffer_len: float
+
+    :param store: Function called with the relative and absolute power map
+                  and the window number of each window
+    :type store: function
+    """
+    BF, CAPON = 0, 1
+
+    def __init__(self, ids, time_shift_table, sll_x, sll_y, sl_s, fs, frqlow,
+                 frqhigh, win_len, win_frac=0.5, method=0, prewhiten=0,
+                 diag_load=0., starttime=None, buffer_len=None, store=None):
+
+        self.ids = list(ids)
+        nstat = len(self.ids)
+        if time_shift_table.shape[0] != nstat:
+            msg = 'time_shift_table does not match the number of ids'
+            raise IOError(msg)
+
+        self.fs = float(fs)
+        self.seglen = int(win_len * fs * win_frac)
+        if self.seglen <= 0:
+            msg = 'Window step too small, increase win_len or win_frac'
+            raise IOError(msg)
+        self.nseg = max(1, int(round(1. / win_frac)))
+        self.nsamp = self.seglen * self.nseg
+
+        # generate plan for rfftr
+        self.nfft = fft_length(self.seglen)
+        deltaf = self.fs / float(self.nfft)
+        nlow = int(frqlow / float(deltaf) + 0.5)
+        nhigh = int(frqhigh / float(deltaf) + 0.5)
+        self.nlow = max(1, nlow)  # avoid using the offset
+        nhigh = min(self.nfft // 2 - 1, nhigh)  # avoid using nyquist
+        self.nf = nhigh - self.nlow + 1  # include upper and lower frequency
+
+        self.steer = steering_vectors(time_shift_table, self.nlow, self.nf,
+                                      deltaf)
+        self.tap = tukey(self.seglen, 0.22)
+
+        self.sll_x, self.sll_y, self.sl_s = sll_x, sll_y, sl_s
+        self.method, self.prewhiten = method, prewhiten
+        self.diag_load = diag_load
+        self.starttime = starttime
+        self.store = store
+
+        if not buffer_len:
+            buffer_len = 10. * win_len
+        capacity = self.seglen + int(buffer_len * self.fs)
+        self.buffers = [None] * nstat
+        self._capacity = capacity
+        self._segments = deque(maxlen=self.nseg)
+        self._next = 0
+        self.count = 0
+
+    def append(self, trace):
+        """
+        Appends a chunk of data of one station and processes all windows that
+        are complete.
+
+        :param trace: Chunk of data, trace.id has to be in ids
+        :type trace: obspy.core.trace.Trace
+
+        returns:
+
+        :param res: One row for each completed window: timestamp, relative
+                    power, absolute power, backazimuth, slowness
+        :type res: list of numpy.ndarray
+        """
+        try:
+            i = self.ids.index(trace.id)
+        except ValueError:
+            msg = 'Trace %s is not part of the array' % trace.id
+            raise IOError(msg)
+
+        if abs(trace.stats.sampling_rate - self.fs) > 1e-6 * self.fs:
+            msg = 'Sampling rate of %s differs from fs' % trace.id
+            raise IOError(msg)
+
+        if self.starttime is None:
+            self.starttime = trace.stats.starttime
+
+        index = int(round((trace.stats.starttime - self.starttime) * self.fs))
+        data = np.asarray(trace.data, dtype='f8')
+
+        buf = self.buffers[i]
+        if buf is None:
+            buf = RingBuffer(self._capacity, start=self._next)
+            self.buffers[i] = buf
+
+        if index > buf.end:
+            # fill gaps with zeros
+            msg = 'Gap of %i samples in %s filled with zeros' % (index - buf.end,
+                                                                 trace.id)
+            warnings.warn(msg)
+            data = np.concatenate((np.zeros(index - buf.end), data))
+        elif index < buf.end:
+            # drop samples that are already buffered or processed
+            data = data[buf.end - index:]
+
+        res = []
+        pos = 0
+        while pos < data.size:
+            free = buf.capacity - len(buf)
+            if free == 0:
+                msg = ('Buffer of %s is full, other stations lag more than '
+                       'buffer_len' % trace.id)
+                raise IOError(msg)
+            buf.append(data[pos:pos + free])
+            pos += free
+            res.extend(self._drain())
+
+        return res
+
+    def _drain(self):
+        res = []
+        while all(buf is not None and buf.end >= self._next + self.seglen
+                  for buf in self.buffers):
+            self._segments.append(self._segment_csd())
+            for buf in self.buffers:
+                buf.discard(self._next + self.seglen)
+            self._next += self.seglen
+
+            if len(self._segments) == self.nseg:
+                res.append(self._window())
+
+        return res
+
+    def _segment_csd(self):
+        dat = np.array([buf.read(self._next, self.seglen)
+                        for buf in self.buffers])
+        dat = (dat - dat.mean(axis=1)[:, np.newaxis]) * self.tap
+        ft = rfft(dat, self.nfft, axis=1)[:, self.nlow:self.nlow + self.nf]
+        R, _dpow = cross_spectral_matrix(ft)
+
+        return R
+
+    def _window(self):
+        nstat = len(self.buffers)
+        R = np.sum(self._segments, axis=0)
+
+        if self.method == self.CAPON:
+            R /= abs(R.sum(axis=0))
+        dpow = nstat * abs(np.diagonal(R.sum(axis=0))).sum()
+        if self.diag_load:
+            idx = np.arange(nstat)
+            load = self.diag_load * R[:, idx, idx].real.mean(axis=1)
+            R[:, idx, idx] += load[:, np.newaxis]
+        if self.method == self.CAPON:
+            # P(f) = 1/(e.H R(f)^-1 e)
+            R = capon_inverse(R, rcond=1e-6, loaded=bool(self.diag_load))
+
+        relpow_map, abspow_map = generalized_beamformer(
+            self.steer, R, method=self.method, prewhiten=self.prewhiten,
+            dpow=dpow)
+
+        ix, iy = np.unravel_index(relpow_map.argmax(), relpow_map.shape)
+        relpow, abspow = relpow_map[ix, iy], abspow_map[ix, iy]
+        if self.store is not None:
+            self.store(relpow_map, abspow_map, self.count)
+        self.count += 1
+
+        # here we compute baz, slow
+        slow_x = self.sll_x + ix * self.sl_s
+        slow_y = self.sll_y + iy * self.sl_s
+
+        slow = np.sqrt(slow_x ** 2 + slow_y ** 2)
+        if slow < 1e-8:
+            slow = 1e-8
+        azimut = 180 * math.atan2(slow_x, slow_y) / math.pi
+        baz = azimut % -360 + 180
+
+        wstart = self.starttime + (self._next - self.nsamp) / self.fs
+
+        return np.array([wstart.timestamp, relpow, abspow, baz, slow])
+
+
+def replay_stream(stream, chunk_len):
+    """
+    Replays a Stream as a sequence of chunks in order of their end time,
+    as a stand-in for a real-time source like SeedLink.
+
+    :param stream: Continuous data of all stations
+    :type stream: obspy.core.stream.Stream
+
+    :param chunk_len: Length of the chunks in seconds
+    :type chunk_len: float
+
+    returns:
+
+    Generator of obspy.core.trace.Trace chunks
+    """
+    chunks = []
+    for tr in stream:
+        n = max(1, int(round(chunk_len * tr.stats.sampling_rate)))
+        for i in range(0, tr.stats.npts, n):
+            tend = tr.stats.starttime + min(i + n, tr.stats.npts) * tr.stats.delta
+            chunks.append((tend.timestamp, tr, i, n))
+
+    chunks.sort(key=lambda c: c[0])
+    for _tend, tr, i, n in chunks:
+        header = tr.stats.copy()
+        header.starttime = tr.stats.starttime + i * tr.stats.delta
+        yield Trace(data=tr.data[i:i + n].copy(), header=header)
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, print_function
+import numpy as np
+from scipy.signal.windows import tukey
+
+from bowpy.util.fft_backend import rfft, irfft, fft_length
+
+"""
+Sub-sample time shifts of many traces in the frequency domain.
+
+The real spectrum of each trace is multiplied by the phase ramp
+exp(-i 2 pi f tau) of its delay tau and transformed back, for a whole
+(traces x time) matrix and a vector of delays in one call. Delays are in
+samples and may be fractional, positive delays shift towards later times.
+Zero padding of the transform avoids that samples shifted out of the
+trace wrap around to its other end.
+
+Example:
+            from bowpy.util.timeshift import fractional_shift
+            data_shift = fractional_shift(data, delays, taper=0.05)
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+
+def fractional_shift(data, delay, nfft=None, pad=True, taper=None):
+    """
+    Shifts each trace of data by its delay in samples.
+
+    :param data: Traces, time along the last axis
+    :type data: array_like, shape (..., npts)
+
+    :param delay: Delay of each trace in samples, broadcastable to
+                  data.shape[:-1]
+    :type delay: float or array_like
+
+    :param nfft: Length of the transform, default is fft_length of npts, plus
+                 the largest delay with pad
+    :type nfft: int
+
+    :param pad: If True, the default nfft is long enough to avoid wrap-around
+    :type pad: bool
+
+    :param taper: Fraction of a Tukey taper applied before shifting, None or 0
+                  for no taper
+    :type taper: float
+
+    returns:
+
+    :param shift_data: Shifted traces
+    :type shift_data: numpy.ndarray, shape (..., npts)
+    """
+    data = np.asarray(data, dtype='float')
+    npts = data.shape[-1]
+    delay = np.asarray(delay, dtype='float')
+
+    if taper:
+        data = data * tukey(npts, taper)
+
+    if not nfft:
+        nmax = int(np.ceil(abs(delay).max())) if pad and delay.size else 0
+        nfft = fft_length(npts + nmax)
+    elif nfft < npts:
+        msg = 'nfft has to be at least the number of samples'
+        raise IOError(msg)
+
+    spec = rfft(data, nfft, axis=-1)
+
+    return irfft(spec * phase_ramp(delay, nfft), nfft, axis=-1)[..., :npts]
+
+
+def phase_ramp(delay, nfft):
+    """
+    Phase ramps exp(-i 2 pi k delay / nfft) of the nfft // 2 + 1 bins of a real
+    transform. The Nyquist bin of an even nfft gets the real part, so that
+    integer delays are exact circular shifts.
+
+    :param delay: Delays in samples
+    :type delay: float or array_like
+
+    :param nfft: Length of the transform
+    :type nfft: int
+
+    returns:
+
+    :param ramp: Phase ramps
+    :type ramp: numpy.ndarray, shape delay.shape + (nfft // 2 + 1,)
+    """
+    delay = np.asarray(delay, dtype='float')
+    k = np.arange(nfft // 2 + 1)
+    ramp = np.exp(-2j * np.pi * delay[..., np.newaxis] * k / float(nfft))
+    if nfft % 2 == 0:
+        ramp[..., -1] = ramp[..., -1].real
+
+    return ramp
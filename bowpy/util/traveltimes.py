@@ -0,0 +1,260 @@
+from __future__ import absolute_import, print_function
+import functools
+import hashlib
+import os
+import tempfile
+import warnings
+import zipfile
+import numpy as np
+
+from obspy.taup import TauPyModel
+
+"""
+Cached travel-time and slowness tables of TauP.
+
+For each model, phase list and source depth a table holds the time and the
+ray parameter (s/deg) of the first arrival on an evenly spaced distance
+grid. Grid points are ray traced only when a requested distance needs
+them. The table is then kept in memory and written to an .npz file in the
+cache directory. Travel times of whole arrays of distances are
+interpolated with cubic Hermite polynomials, using dT/ddelta = p, and ray
+parameters linearly. Distances next to a grid point without an arrival,
+e.g. close to the end of a phase, and between grid points on different
+branches of the first arrival, e.g. at the triplications of the upper
+mantle, are ray traced directly. Distances without an arrival of the
+phases return NaN.
+
+Example:
+            from bowpy.util.traveltimes import travel_times
+            t, p = travel_times(depth, epidist, ['P'], model='ak135')
+
+Author: S. Schneider 2016
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details: http://www.gnu.org/licenses/
+"""
+
+_config = {'cache_dir': os.path.join(os.path.expanduser('~'), '.bowpy', 'taup'),
+           'step': 0.25}
+_tables = {}
+
+# Grid intervals with a larger change of the ray parameter (s/deg per deg of
+# step) or a larger misfit of the trapezoidal rule T1 - T0 = step (p0 + p1) / 2
+# (s) hold a change of the first-arrival branch. Within the branches of ak135
+# both stay below these limits for the default step of 0.25 deg.
+_PTOL = 0.4
+_TTOL = 2e-3
+
+
+@functools.lru_cache(maxsize=8)
+def get_model(model='ak135'):
+    """
+    Returns the TauPyModel of model, loaded only once per model.
+    """
+    return TauPyModel(model)
+
+
+def clear_cache(disk=False):
+    """
+    Empties the tables in memory, and with disk=True the cache directory.
+    """
+    _tables.clear()
+    cache_dir = _config['cache_dir']
+    if disk and cache_dir and os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith(('.npz', '.npz.tmp')):
+                os.remove(os.path.join(cache_dir, name))
+
+
+def set_cache_dir(path=None):
+    """
+    Sets the directory of the table files, None keeps the tables in memory only.
+    """
+    _config['cache_dir'] = path
+
+
+def set_step(step=0.25):
+    """
+    Sets the distance step in degrees of new tables.
+    """
+    if step <= 0:
+        msg = 'step has to be positive'
+        raise IOError(msg)
+    _config['step'] = float(step)
+
+
+def travel_times(depth, distances, phases, model='ak135'):
+    """
+    Time and ray parameter of the first arrival of phases at each distance.
+
+    :param depth: Source depth in km
+    :type depth: float
+
+    :param distances: Epicentral distances in degrees
+    :type distances: float or array_like
+
+    :param phases: Phase names, as phase_list of TauPyModel.get_travel_times
+    :type phases: str or list
+
+    :param model: Name of the TauP model, default is ak135
+    :type model: str
+
+    returns:
+
+    :param time: Travel times in s, NaN without an arrival
+    :type time: numpy.ndarray, shape of distances
+
+    :param ray_param: Ray parameters in s/deg, NaN without an arrival
+    :type ray_param: numpy.ndarray, shape of distances
+    """
+    distances = np.asarray(distances, dtype='float')
+    if np.any(distances < 0) or np.any(distances > 180):
+        msg = 'Distances have to be between 0 and 180 degrees'
+        raise IOError(msg)
+
+    table = _get_table(depth, phases, model)
+    step = table['step']
+
+    x = distances.ravel() / step
+    i0 = np.minimum(np.floor(x).astype('int'), table['time'].size - 2)
+    _fill(table, np.unique(np.concatenate((i0, i0 + 1))))
+
+    t0, t1 = table['time'][i0], table['time'][i0 + 1]
+    p0, p1 = table['ray_param'][i0], table['ray_param'][i0 + 1]
+    s = x - i0
+
+    # Cubic Hermite interpolation with the slopes dT/ddelta = p
+    h00 = (1 + 2 * s) * (1 - s) ** 2
+    h10 = s * (1 - s) ** 2
+    h01 = s ** 2 * (3 - 2 * s)
+    h11 = s ** 2 * (s - 1)
+    time = h00 * t0 + h10 * step * p0 + h01 * t1 + h11 * step * p1
+    ray_param = (1 - s) * p0 + s * p1
+
+    # Exact at grid points, also next to grid points without arrival
+    at0, at1 = s == 0, s == 1
+    time[at0], ray_param[at0] = t0[at0], p0[at0]
+    time[at1], ray_param[at1] = t1[at1], p1[at1]
+
+    # Between grid points that do not both have an arrival, or that lie on
+    # different branches of the first arrival, trace the distance
+    branch = (abs(p1 - p0) > _PTOL * step) | \
+             (abs(t1 - t0 - step * (p0 + p1) / 2.) > _TTOL)
+    edge = ~(at0 | at1) & (branch | ~(np.isfinite(t0) & np.isfinite(t1)))
+    if np.any(edge):
+        time[edge], ray_param[edge] = _direct(table, distances.ravel()[edge])
+
+    return time.reshape(distances.shape), ray_param.reshape(distances.shape)
+
+
+def _get_table(depth, phases, model):
+    if isinstance(phases, str):
+        phases = [phases]
+    phases = tuple(phases)
+    step = _config['step']
+    key = (model, phases, round(float(depth), 3), step)
+
+    if key in _tables:
+        return _tables[key]
+
+    nx = int(round(180. / step)) + 1
+    table = {'key': key, 'step': step, 'depth': key[2],
+             'distance': np.arange(nx) * step,
+             'time': np.full(nx, np.nan), 'ray_param': np.full(nx, np.nan),
+             'done': np.zeros(nx, dtype='bool'), 'direct': {}}
+
+    fname = _table_file(key)
+    if fname and os.path.isfile(fname):
+        try:
+            with np.load(fname) as npz:
+                cached = dict((name, npz[name].copy())
+                              for name in ('time', 'ray_param', 'done'))
+        except (IOError, OSError, ValueError, KeyError,
+                zipfile.BadZipFile) as e:
+            # rebuilt from scratch and overwritten by the next _fill
+            msg = 'Could not read travel-time table %s: %s' % (fname, e)
+            warnings.warn(msg)
+        else:
+            if all(cached[name].size == nx for name in cached):
+                table.update(cached)
+
+    _tables[key] = table
+
+    return table
+
+
+def _fill(table, index):
+    todo = index[~table['done'][index]]
+    if todo.size == 0:
+        return
+
+    model, phases = table['key'][0], table['key'][1]
+    m = get_model(model)
+    for i in todo:
+        arrivals = m.get_travel_times(table['depth'], table['distance'][i],
+                                      phase_list=list(phases))
+        if arrivals:
+            table['time'][i] = arrivals[0].time
+            table['ray_param'][i] = arrivals[0].ray_param_sec_degree
+        table['done'][i] = True
+
+    fname = _table_file(table['key'])
+    if fname:
+        tmpname = None
+        try:
+            if not os.path.isdir(_config['cache_dir']):
+                os.makedirs(_config['cache_dir'])
+            # Write to a temporary file and move it into place, so that other
+            # processes never read a partly written table
+            fd, tmpname = tempfile.mkstemp(suffix='.npz.tmp',
+                                           dir=_config['cache_dir'])
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, time=table['time'], ray_param=table['ray_param'],
+                         done=table['done'])
+            os.replace(tmpname, fname)
+        except (IOError, OSError) as e:
+            if tmpname and os.path.isfile(tmpname):
+                os.remove(tmpname)
+            msg = 'Could not write travel-time table %s: %s' % (fname, e)
+            warnings.warn(msg)
+
+
+def _direct(table, distances):
+    time = np.full(distances.size, np.nan)
+    ray_param = np.full(distances.size, np.nan)
+
+    model, phases = table['key'][0], table['key'][1]
+    direct = table['direct']
+    for i, dist in enumerate(distances):
+        key = round(float(dist), 6)
+        if key not in direct:
+            arrivals = get_model(model).get_travel_times(table['depth'], key,
+                                                         phase_list=list(phases))
+            if arrivals:
+                direct[key] = (arrivals[0].time,
+                               arrivals[0].ray_param_sec_degree)
+            else:
+                direct[key] = (np.nan, np.nan)
+        time[i], ray_param[i] = direct[key]
+
+    return time, ray_param
+
+
+def _table_file(key):
+    cache_dir = _config['cache_dir']
+    if not cache_dir:
+        return None
+    model, phases, depth, step = key
+    digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()[:12]
+    name = '%s_%s_%.3fkm_%s.npz' % (os.path.basename(str(model)),
+                                    '-'.join(phases).replace('^', ''),
+                                    depth, digest)
+
+    return os.path.join(cache_dir, name)